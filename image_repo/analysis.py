@@ -0,0 +1,315 @@
+import abc
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import itertools
+import os
+import threading
+import time
+import weakref
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import IntegrityError
+from django.utils.module_loading import import_string
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+from . import metrics
+from .colors import image_colors
+from .models import AnalysisResult
+from .resilience import CircuitBreaker, CircuitOpenError, TokenBucket, backoff
+
+# process-wide session for the analysis endpoint (see get_session())
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+# httpx clients of the async analysis worker by event loop (see get_async_client())
+_async_clients = weakref.WeakKeyDictionary()
+# visual features requested from Azure by azure_cv_api()
+AZURE_FEATURES = 'Description,Color'
+# shared by the sync and async calls of this process (see resilience.py)
+azure_circuit = CircuitBreaker('azure')
+azure_rate = TokenBucket()
+
+
+def get_analyzer():
+    """Return the analyzer configured in settings.IMAGE_REPO_ANALYZER (a function or an Analyzer class)"""
+    analyzer = import_string(settings.IMAGE_REPO_ANALYZER)
+    return analyzer() if isinstance(analyzer, type) else analyzer
+
+
+def get_async_analyzer():
+    """Return the coroutine function configured in settings.IMAGE_REPO_ASYNC_ANALYZER"""
+    analyzer = import_string(settings.IMAGE_REPO_ASYNC_ANALYZER)
+    # Analyzer classes are used through their analyze_async() method
+    return analyzer().analyze_async if isinstance(analyzer, type) else analyzer
+
+
+def get_session():
+    """Return the pooled keep-alive session shared by all threads of this process"""
+    global _session, _session_pid
+    # a forked worker (gunicorn) must not share sockets with its parent
+    if _session is None or _session_pid != os.getpid():
+        with _session_lock:
+            if _session is None or _session_pid != os.getpid():
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=settings.IMAGE_REPO_ANALYSIS_POOL_SIZE)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                _session, _session_pid = session, os.getpid()
+    return _session
+
+
+def azure_request(features=AZURE_FEATURES):
+    """Return the URL, headers and parameters of an Azure Computer Vision analyze call"""
+    api_key = os.environ['AZURE_CV_KEY']
+    endpoint = os.environ['AZURE_CV_ENDPOINT']
+    req_url = endpoint + "vision/v3.2/analyze"
+    headers = {'Ocp-Apim-Subscription-Key': api_key,
+               'Content-Type': 'application/octet-stream'}
+    params = {'visualFeatures': features}
+    return req_url, headers, params
+
+
+def parse_azure_result(results):
+    """Extract description, tags and colors from the Azure Computer Vision response"""
+    description = results['description']['captions'][0]['text']+'.'
+    tags = '#'+' #'.join(results['description']['tags'])
+    # colors are only there when the Color feature was requested
+    colors = ' '.join(results['color']['dominantColors']).lower() if 'color' in results else ''
+    result_dict = dict()
+    result_dict['description'] = description
+    result_dict['tags'] = tags
+    result_dict['colors'] = colors
+    return result_dict
+
+
+def retry_after(response):
+    """Return the seconds the Retry-After header of the response asks to wait, or None"""
+    try:
+        return float(response.headers.get('Retry-After', ''))
+    except ValueError:
+        return None
+
+
+def azure_answered(response, attempt):
+    """Record an Azure response in the breaker and the rate limit, return (result, seconds before a retry or None)"""
+    if response.status_code == 429 or response.status_code >= 500:
+        print(f'Azure answered {response.status_code}.')
+        azure_circuit.record_failure()
+        wait = retry_after(response)
+        if response.status_code == 429:
+            metrics.incr('azure_throttled')
+            azure_rate.throttle(wait)
+        return None, backoff(attempt, wait)
+    azure_circuit.record_success()
+    azure_rate.recover()
+    try:
+        # other errors are about the image itself, another try wouldn't help
+        response.raise_for_status()
+        return parse_azure_result(response.json()), None
+    except Exception as e:
+        print(e)
+        return None, None
+
+
+def azure_failed(error, attempt):
+    """Record a connection error or timeout in the breaker, return the seconds before a retry"""
+    print(error)
+    azure_circuit.record_failure()
+    return backoff(attempt)
+
+
+def azure_cv_api(img, features=AZURE_FEATURES):
+    """Helper func to call Azure Computer Vision API from the analysis worker"""
+    req_url, headers, params = azure_request(features)
+    for attempt in itertools.count():
+        # while Azure is failing this raises CircuitOpenError right away, the worker keeps the image queued
+        azure_circuit.before_call()
+        time.sleep(azure_rate.reserve())
+        try:
+            with metrics.timed('azure'):
+                response = get_session().post(req_url, headers=headers, params=params, data=img,
+                                              timeout=(settings.IMAGE_REPO_ANALYSIS_CONNECT_TIMEOUT,
+                                                       settings.IMAGE_REPO_ANALYSIS_READ_TIMEOUT))
+        except requests.RequestException as e:
+            result, delay = None, azure_failed(e, attempt)
+        else:
+            result, delay = azure_answered(response, attempt)
+        if delay is None or attempt >= settings.IMAGE_REPO_ANALYSIS_RETRIES:
+            return result
+        time.sleep(delay)
+
+
+def get_async_client():
+    """Return the pooled keep-alive httpx client of the running event loop"""
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = httpx.AsyncClient(
+            timeout=httpx.Timeout(settings.IMAGE_REPO_ANALYSIS_READ_TIMEOUT,
+                                  connect=settings.IMAGE_REPO_ANALYSIS_CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_connections=settings.IMAGE_REPO_ANALYSIS_ASYNC_POOL_SIZE,
+                                max_keepalive_connections=settings.IMAGE_REPO_ANALYSIS_ASYNC_POOL_SIZE),
+        )
+        _async_clients[loop] = client
+    return client
+
+
+async def azure_cv_api_async(img, features=AZURE_FEATURES):
+    """Non-blocking azure_cv_api() for the async analysis worker"""
+    req_url, headers, params = azure_request(features)
+    for attempt in itertools.count():
+        azure_circuit.before_call()
+        await asyncio.sleep(azure_rate.reserve())
+        try:
+            with metrics.timed('azure'):
+                response = await get_async_client().post(req_url, headers=headers, params=params, content=img)
+        except httpx.HTTPError as e:
+            result, delay = None, azure_failed(e, attempt)
+        else:
+            result, delay = azure_answered(response, attempt)
+        if delay is None or attempt >= settings.IMAGE_REPO_ANALYSIS_RETRIES:
+            return result
+        await asyncio.sleep(delay)
+
+
+def refusable(analyze, img):
+    """Return analyze(img), or the CircuitOpenError when the call was refused"""
+    try:
+        return analyze(img)
+    except CircuitOpenError as e:
+        return e
+
+
+class Analyzer(abc.ABC):
+    """
+    Base of the analysis backends that can be set in settings.IMAGE_REPO_ANALYZER.
+
+    Like azure_cv_api(), an analyzer is called with the image bytes and returns
+    {'description': ..., 'tags': ..., 'colors': ...} or None when it failed. It raises
+    resilience.CircuitOpenError when the backend is known to fail and wasn't called,
+    the image then stays in the queue. analyze_batch() returns the error in place of the
+    result of the images it refused, the results of the others are kept.
+    """
+
+    @abc.abstractmethod
+    def __call__(self, img):
+        """Return the result of the image bytes"""
+
+    def analyze_batch(self, images):
+        """Return the results of many images, backends override it to share work between them"""
+        return [refusable(self, img) for img in images]
+
+    async def analyze_async(self, img):
+        """Non-blocking analysis for the async worker (settings.IMAGE_REPO_ASYNC_ANALYZER)"""
+        return await sync_to_async(self, thread_sensitive=False)(img)
+
+
+class AzureAnalyzer(Analyzer):
+    """Description, tags and colors from Azure Computer Vision (azure_cv_api())"""
+
+    def __call__(self, img):
+        return azure_cv_api(img)
+
+    async def analyze_async(self, img):
+        return await azure_cv_api_async(img)
+
+
+class LocalColorAnalyzer(Analyzer):
+    """Dominant colors computed in-process (see colors.py), no description or tags"""
+
+    def __call__(self, img):
+        return self.analyze_batch([img])[0]
+
+    def analyze_batch(self, images):
+        # all pixels of the batch are quantized in one NumPy pass
+        with metrics.timed('local_colors'):
+            colors = image_colors(images)
+        return [{'description': '', 'tags': '', 'colors': value} for value in colors]
+
+
+class HybridAnalyzer(Analyzer):
+    """Description and tags from Azure, colors computed in-process (one Azure feature less to pay for)"""
+
+    def __call__(self, img):
+        return self.combine(azure_cv_api(img, features='Description'), img)
+
+    def analyze_batch(self, images):
+        # the Azure calls of the batch run concurrently on the pooled session
+        with ThreadPoolExecutor(max_workers=settings.IMAGE_REPO_ANALYSIS_POOL_SIZE) as pool:
+            describe = functools.partial(azure_cv_api, features='Description')
+            results = list(pool.map(functools.partial(refusable, describe), images))
+        # failed (None) and refused (CircuitOpenError) images get no colors
+        analyzed = [img for img, result in zip(images, results) if isinstance(result, dict)]
+        colors = iter(LocalColorAnalyzer().analyze_batch(analyzed))
+        return [dict(result, colors=next(colors)['colors']) if isinstance(result, dict) else result
+                for result in results]
+
+    async def analyze_async(self, img):
+        result = await azure_cv_api_async(img, features='Description')
+        return await sync_to_async(self.combine, thread_sensitive=False)(result, img)
+
+    def combine(self, result, img):
+        """Add the local colors of the image to the Azure result"""
+        if result is None:
+            return None
+        return dict(result, colors=LocalColorAnalyzer()(img)['colors'])
+
+
+class AnalysisCache:
+    """Analyzer results keyed by the SHA-256 of the image bytes, with an in-process LRU in front of the database"""
+
+    def __init__(self):
+        self._results = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, content_hash):
+        """Return the cached result for the image content or None"""
+        if not content_hash:
+            return None
+        with self._lock:
+            result = self._results.get(content_hash)
+            if result is not None:
+                self._results.move_to_end(content_hash)
+        if result is not None:
+            metrics.incr('analysis_cache_memory_hits')
+            return result
+        result = (AnalysisResult.objects.filter(content_hash=content_hash)
+                  .values('description', 'tags', 'colors').first())
+        if result is None:
+            metrics.incr('analysis_cache_misses')
+            return None
+        metrics.incr('analysis_cache_db_hits')
+        self._remember(content_hash, result)
+        return result
+
+    def set(self, content_hash, result):
+        """Store the analyzer result in both tiers"""
+        if not content_hash:
+            return
+        fields = {'description': result['description'], 'tags': result['tags'], 'colors': result['colors']}
+        try:
+            AnalysisResult.objects.update_or_create(content_hash=content_hash, defaults=fields)
+        except IntegrityError:
+            # another worker stored the same content first
+            pass
+        self._remember(content_hash, fields)
+
+    def clear(self):
+        """Empty the in-process tier"""
+        with self._lock:
+            self._results.clear()
+
+    def _remember(self, content_hash, result):
+        with self._lock:
+            self._results[content_hash] = result
+            self._results.move_to_end(content_hash)
+            while len(self._results) > settings.IMAGE_REPO_ANALYSIS_CACHE_SIZE:
+                self._results.popitem(last=False)
+
+
+analysis_cache = AnalysisCache()
@@ -0,0 +1,62 @@
+"""
+Read-only JSON listing of a user's images (views.api_images()).
+
+Only the columns of the requested fields are selected, as value rows: no
+model instances are built and no template is rendered. Tags and colors are
+returned as arrays, storage URLs only when asked for (they are signed, see
+storage.CachedURLMixin).
+"""
+from .models import Image
+
+
+def split(value, storage):
+    return value.split()
+
+
+# API field: (column, conversion of the column value or None)
+FIELDS = {
+    'id': ('id', None),
+    'url': ('image', lambda name, storage: storage.url(name)),
+    'srcset': ('derivatives', lambda derivatives, storage: {width: storage.url(name)
+                                                            for width, name in derivatives.items()}),
+    'description': ('description', None),
+    'tags': ('tags', split),
+    'colors': ('colors', split),
+    'status': ('analysis_status', None),
+    # shares of colors.COLOR_NAMES
+    'palette': ('palette', None),
+    'duplicate_of': ('duplicate_of_id', None),
+}
+# the fields returned when none are requested, without the URLs
+DEFAULT_FIELDS = ['id', 'description', 'tags', 'colors', 'status']
+
+
+def parse_fields(value):
+    """Return the fields of a comma-separated `fields` parameter, the default ones when empty"""
+    fields = list(dict.fromkeys(field.strip() for field in value.split(',') if field.strip()))
+    unknown = [field for field in fields if field not in FIELDS]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}. Choose from: {', '.join(FIELDS)}.")
+    return fields or DEFAULT_FIELDS
+
+
+def image_rows(user_id, fields, before, limit):
+    """Return up to `limit` value rows of the user's images older than `before`, and the cursor of the next page"""
+    # the id comes first, the cursor is taken from it
+    columns = list(dict.fromkeys(['id'] + [FIELDS[field][0] for field in fields]))
+    images = Image.objects.filter(user_id=user_id)
+    if before is not None:
+        images = images.filter(id__lt=before)
+    rows = list(images.order_by('-id').values(*columns)[:limit + 1])
+    if len(rows) > limit:
+        return rows[:limit], rows[limit - 1]['id']
+    return rows, None
+
+
+def serialize(rows, fields):
+    """Return the rows as JSON-ready dicts of the fields"""
+    storage = Image.image.field.storage
+    conversions = [(field, *FIELDS[field]) for field in fields]
+    return [{field: convert(row[column], storage) if convert else row[column]
+             for field, column, convert in conversions}
+            for row in rows]
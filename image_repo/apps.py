@@ -1,6 +1,19 @@
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
+
+
+def add_query_timer(sender, connection, **kwargs):
+    # every database query is recorded in the 'db' phase (see metrics.time_query())
+    from .metrics import time_query
+    if time_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(time_query)
 
 
 class ImageRepoConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'image_repo'
+
+    def ready(self):
+        # connect the signals invalidating the cached repo pages and users
+        from . import auth, pagecache  # noqa: F401
+        connection_created.connect(add_query_timer)
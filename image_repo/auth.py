@@ -0,0 +1,65 @@
+"""
+Authentication backend that reads the signed-in user from a cache.
+
+AuthenticationMiddleware loads the user of the session on every request. With
+CachedUserBackend it comes from settings.IMAGE_REPO_USER_CACHE instead of the
+auth_user table. Saving or deleting a user removes the entry, so password
+changes (which end the other sessions) and deactivations apply right away.
+Group and permission changes don't save the user and apply when it expires.
+
+ModelBackend stays in AUTHENTICATION_BACKENDS after CachedUserBackend, so the
+sessions signed in before the mode was turned on (they name ModelBackend) stay
+valid and read the user from the database until the user signs in again.
+"""
+from django.conf import settings
+from django.contrib.auth.backends import ModelBackend
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.core.exceptions import PermissionDenied
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from . import metrics
+
+
+def user_cache_enabled():
+    return settings.IMAGE_REPO_USER_CACHE in settings.CACHES
+
+
+def get_cache():
+    """Return the cache of the signed-in users (settings.IMAGE_REPO_USER_CACHE)"""
+    return caches[settings.IMAGE_REPO_USER_CACHE]
+
+
+def user_key(user_id):
+    return f'user:{user_id}'
+
+
+class CachedUserBackend(ModelBackend):
+    """ModelBackend that loads the users of sessions from the cache"""
+
+    def authenticate(self, request, username=None, password=None, **kwargs):
+        user = super().authenticate(request, username, password, **kwargs)
+        if user is None:
+            # ModelBackend, listed next for the older sessions, would check the password again
+            raise PermissionDenied
+        return user
+
+    def get_user(self, user_id):
+        user = get_cache().get(user_key(user_id))
+        if user is not None:
+            metrics.incr('user_cache_hits')
+            return user
+        metrics.incr('user_cache_misses')
+        user = super().get_user(user_id)
+        if user is not None:
+            get_cache().set(user_key(user_id), user, settings.IMAGE_REPO_USER_CACHE_TIMEOUT)
+        return user
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def user_changed(sender, instance, **kwargs):
+    # the cache is only configured with the high-throughput auth mode
+    if user_cache_enabled():
+        get_cache().delete(user_key(instance.pk))
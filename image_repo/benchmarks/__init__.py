@@ -0,0 +1,7 @@
+"""
+Benchmarks run with `manage.py benchmark <name>`.
+
+Each module exposes add_arguments(parser) and run(command, **options).
+"""
+BENCHMARKS = ['api', 'async_worker', 'auth', 'deletion', 'duplicates', 'export', 'file_cache',
+              'http_client', 'local_colors', 'palettes', 'preprocess', 'upload_inspection', 'url_cache', 'views']
@@ -0,0 +1,51 @@
+"""A page of the library as rendered HTML (repo view without its cache) vs JSON from the API with a few field sets"""
+import statistics
+import time
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from image_repo import pagecache
+from .environment import benchmark_environment
+from .views import grow_library
+
+
+def add_arguments(parser):
+    parser.add_argument('--images', type=int, default=1000, help='number of images in the library')
+    parser.add_argument('--page-size', type=int, default=100, help='images per page of both endpoints')
+    parser.add_argument('--requests', type=int, default=30, help='measured requests per endpoint')
+
+
+def run(command, images=1000, page_size=100, requests=30, **options):
+    with benchmark_environment(), override_settings(IMAGE_REPO_PAGE_SIZE=page_size,
+                                                    IMAGE_REPO_API_PAGE_SIZE=page_size,
+                                                    IMAGE_REPO_UPLOAD_LIMIT=10 ** 9):
+        user = User.objects.create_user(username='benchmark')
+        grow_library(user, images)
+        client = Client()
+        client.force_login(user)
+        endpoints = {
+            # the image list is rendered every time
+            'repo html': (reverse('repo'), {}, lambda: pagecache.bump_version(user.id)),
+            'api default': (reverse('api_images'), {}, None),
+            'api id,tags': (reverse('api_images'), {'fields': 'id,tags'}, None),
+            'api all': (reverse('api_images'), {'fields': 'id,url,srcset,description,tags,colors,status'}, None),
+        }
+        for name, (url, params, prepare) in endpoints.items():
+            prepare = prepare or (lambda: None)
+            prepare()
+            client.get(url, params)
+            timings = []
+            for _ in range(requests):
+                prepare()
+                start = time.perf_counter()
+                resp = client.get(url, params)
+                timings.append(time.perf_counter() - start)
+            prepare()
+            with CaptureQueriesContext(connection) as queries:
+                client.get(url, params)
+            command.stdout.write(f'{name:>12}: median {statistics.median(timings) * 1000:7.2f} ms, '
+                                 f'{len(resp.content) / 1024:7.1f} KiB, {len(queries)} queries')
@@ -0,0 +1,54 @@
+"""Analysis throughput of the threaded worker vs the async worker against a slow stub endpoint"""
+import os
+import time
+from unittest import mock
+
+from asgiref.sync import async_to_sync
+from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+from django.test import override_settings
+
+from image_repo.analysis import analysis_cache
+from image_repo.jobs import run_async_worker, run_worker
+from image_repo.models import AnalysisResult, Image
+from .environment import benchmark_environment, image_bytes
+from .stub_azure import StubAzureServer
+
+
+def add_arguments(parser):
+    parser.add_argument('--images', type=int, default=400, help='number of queued images')
+    parser.add_argument('--latency-ms', type=float, default=500, help='stub endpoint response time')
+    parser.add_argument('--workers', type=int, default=4, help='threads of the threaded worker')
+    parser.add_argument('--concurrency', type=int, default=200, help='concurrent calls of the async worker')
+    parser.add_argument('--rate', type=float, default=10 ** 6,
+                        help='allowed calls per second (the stub has no quota, settings.IMAGE_REPO_ANALYSIS_RATE)')
+
+
+def queue_images(count):
+    """Mark all images as pending again and forget their results"""
+    Image.objects.update(analysis_status=Image.PENDING, analysis_attempts=0)
+    AnalysisResult.objects.all().delete()
+    analysis_cache.clear()
+
+
+def run(command, images=400, latency_ms=500, workers=4, concurrency=200, rate=10 ** 6, **options):
+    with benchmark_environment(), StubAzureServer(latency_ms / 1000) as server, \
+            mock.patch.dict(os.environ, {'AZURE_CV_KEY': 'stub', 'AZURE_CV_ENDPOINT': server.endpoint}), \
+            override_settings(IMAGE_REPO_ANALYSIS_RATE=rate), mock.patch('builtins.print'):
+        user = User.objects.create_user(username='benchmark', password='benchmark')
+        for i in range(images):
+            image = Image(user=user)
+            image.image.save(f'image{i}.png', ContentFile(image_bytes(i)))
+        timings = {}
+        queue_images(images)
+        start = time.perf_counter()
+        run_worker(workers=workers, once=True)
+        timings[f'threads ({workers} workers)'] = time.perf_counter() - start
+        queue_images(images)
+        start = time.perf_counter()
+        async_to_sync(run_async_worker)(concurrency=concurrency, once=True)
+        timings[f'async ({concurrency} concurrent)'] = time.perf_counter() - start
+        analyzed = Image.objects.filter(analysis_status=Image.DONE).count()
+    for name, seconds in timings.items():
+        command.stdout.write(f'{name:>25}: {images / seconds:8.1f} images/s ({seconds:.2f} s)')
+    command.stdout.write(f'{analyzed} of {images} images analyzed by the last run')
@@ -0,0 +1,50 @@
+"""Requests per second and queries of authenticated pages with database sessions vs the cached auth mode"""
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from .environment import benchmark_environment
+
+# the cached mode as configured with IMAGE_REPO_MEMCACHED_SERVERS, a local cache stands in for memcached
+CACHED_AUTH = {
+    'SESSION_ENGINE': 'django.contrib.sessions.backends.cached_db',
+    'SESSION_CACHE_ALIAS': 'sessions',
+    'AUTHENTICATION_BACKENDS': ['image_repo.auth.CachedUserBackend', 'django.contrib.auth.backends.ModelBackend'],
+}
+
+
+def add_arguments(parser):
+    parser.add_argument('--requests', type=int, default=500, help='measured requests per page and mode')
+
+
+def measure(client, url, count):
+    """Return the requests per second and the queries of one request of the page"""
+    # the first request fills the caches
+    client.get(url)
+    start = time.perf_counter()
+    for _ in range(count):
+        client.get(url)
+    elapsed = time.perf_counter() - start
+    with CaptureQueriesContext(connection) as queries:
+        client.get(url)
+    # the log of the connection is cleared when it is opened again
+    return count / elapsed, len(queries)
+
+
+def run(command, requests=500, **options):
+    caches = dict(settings.CACHES, sessions={'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                                             'LOCATION': 'benchmark-sessions'})
+    with benchmark_environment(), override_settings(CACHES=caches):
+        User.objects.create_user(username='benchmark', password='benchmark')
+        for mode, overrides in (('database', {}), ('cached', CACHED_AUTH)):
+            with override_settings(**overrides):
+                client = Client()
+                client.login(username='benchmark', password='benchmark')
+                for name in ('repo', 'search'):
+                    rate, queries = measure(client, reverse(name), requests)
+                    command.stdout.write(f'{mode:>9} {name:>7}: {rate:8.1f} requests/s, {queries} queries')
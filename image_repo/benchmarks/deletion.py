@@ -0,0 +1,68 @@
+"""Deleting a library image by image vs with deletion.delete_images(), against a stub S3 with request latency"""
+import time
+from unittest import mock
+
+from django.contrib.auth.models import User
+
+from image_repo.deletion import delete_images
+from image_repo.models import Image
+from image_repo.storage import S3Storage
+from .environment import benchmark_environment
+
+
+def add_arguments(parser):
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000], help='library sizes')
+    parser.add_argument('--latency', type=float, default=0.01, help='seconds per storage request')
+    parser.add_argument('--one-by-one-max', type=int, default=500,
+                        help='largest library also deleted image by image (one request per file)')
+
+
+def stub_storage(latency):
+    """Return an S3Storage whose requests only wait `latency` seconds, with a counter of the requests"""
+    # signing and key handling are local, the bucket is never contacted
+    storage = S3Storage(access_key='benchmark', secret_key='benchmark', bucket_name='benchmark',
+                        region_name='us-east-2')
+    storage.requests = 0
+
+    def request(*args):
+        storage.requests += 1
+        time.sleep(latency)
+        return {}
+    storage.delete = request
+    storage._delete_batch = request
+    return storage
+
+
+def create_library(user, size):
+    Image.objects.bulk_create(
+        Image(user=user, image=f'{user.username}/image{i}.jpg', analysis_status=Image.DONE,
+              derivatives={'400': f'{user.username}/image{i}_400w.webp', '800': f'{user.username}/image{i}_800w.webp'})
+        for i in range(size))
+
+
+def one_by_one(user):
+    """What deleting every image with its own view would cost"""
+    storage = Image.image.field.storage
+    for image in Image.objects.filter(user=user):
+        for name in [image.image.name, *image.derivatives.values()]:
+            storage.delete(name)
+        image.delete()
+
+
+def run(command, sizes=(100, 1000, 10000), latency=0.01, one_by_one_max=500, **options):
+    with benchmark_environment():
+        user = User.objects.create_user(username='benchmark')
+        storage = stub_storage(latency)
+        with mock.patch.object(Image.image.field, 'storage', storage):
+            for size in sorted(sizes):
+                methods = [('bulk', lambda: delete_images(Image.objects.filter(user=user)))]
+                if size <= one_by_one_max:
+                    methods.insert(0, ('one by one', lambda: one_by_one(user)))
+                for name, delete in methods:
+                    create_library(user, size)
+                    storage.requests = 0
+                    start = time.perf_counter()
+                    delete()
+                    elapsed = time.perf_counter() - start
+                    command.stdout.write(f'{size:>6} images, {name:>10}: {elapsed:7.2f} s, '
+                                         f'{storage.requests} storage requests')
@@ -0,0 +1,56 @@
+"""Near-duplicate lookups in the BK-tree against a linear scan of all hashes of a library"""
+import random
+import statistics
+import time
+
+from image_repo.duplicates import BKTree, hamming
+
+
+def add_arguments(parser):
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000], help='library sizes')
+    parser.add_argument('--queries', type=int, default=200, help='measured lookups per size')
+    parser.add_argument('--radius', type=int, default=4, help='maximum number of different bits of a match')
+
+
+def library(size, rng):
+    """Return [(hash, id)] of random 64-bit hashes, every tenth one a near copy of an earlier hash"""
+    hashes = []
+    for i in range(size):
+        if i % 10 == 9:
+            value = hashes[rng.randrange(i - 1)][0] ^ (1 << rng.randrange(64))
+        else:
+            value = rng.getrandbits(64)
+        hashes.append((value, i))
+    return hashes
+
+
+def lookup_ms(search, queries):
+    """Return the p50 time in ms of search() over the queries"""
+    timings = []
+    for query in queries:
+        start = time.perf_counter()
+        search(query)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings) * 1000
+
+
+def run(command, sizes=(100, 1000, 10000), queries=200, radius=4, **options):
+    rng = random.Random(0)
+    for size in sizes:
+        hashes = library(size, rng)
+        start = time.perf_counter()
+        tree = BKTree(hashes)
+        build = time.perf_counter() - start
+        # half the queries have a match, like uploads of copies
+        query_hashes = [hashes[rng.randrange(size)][0] ^ (1 << rng.randrange(64)) if i % 2 else rng.getrandbits(64)
+                        for i in range(queries)]
+        for query in query_hashes:
+            if tree.search(query, radius) != sorted((hamming(query, value), image_id)
+                                                    for value, image_id in hashes
+                                                    if hamming(query, value) <= radius):
+                raise AssertionError(f'the tree and the scan disagree on {query:x}')
+        tree_ms = lookup_ms(lambda query: tree.search(query, radius), query_hashes)
+        scan_ms = lookup_ms(lambda query: [image_id for value, image_id in hashes
+                                           if hamming(query, value) <= radius], query_hashes)
+        command.stdout.write(f'{size:>8} images: build {build * 1000:8.1f} ms, lookup p50 {tree_ms:8.3f} ms '
+                             f'(linear scan {scan_ms:8.3f} ms, {scan_ms / tree_ms:6.1f}x)')
@@ -0,0 +1,38 @@
+"""Temporary database and storage for benchmarks, set up like the tests in image_repo/tests.py"""
+from contextlib import contextmanager
+from io import BytesIO
+import shutil
+import tempfile
+
+from django.core.files.storage import FileSystemStorage
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+from PIL import Image as PILImage
+
+from image_repo.models import Image
+
+
+@contextmanager
+def benchmark_environment():
+    """Run the block against a test database and a temporary FileSystemStorage"""
+    setup_test_environment()
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0)
+    media_root = tempfile.mkdtemp()
+    storage = Image.image.field.storage
+    Image.image.field.storage = FileSystemStorage(location=media_root)
+    try:
+        yield
+    finally:
+        Image.image.field.storage = storage
+        shutil.rmtree(media_root)
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+
+
+def image_bytes(seed, size=(64, 64), format='PNG'):
+    """Return a small image whose content (and hash) is different for every seed"""
+    img = PILImage.new('RGB', size, (seed % 256, seed // 256 % 256, seed // 65536 % 256))
+    output = BytesIO()
+    img.save(output, format)
+    return output.getvalue()
@@ -0,0 +1,44 @@
+"""Throughput and peak memory of the export worker building the library archive at several library sizes"""
+import os
+import time
+import tracemalloc
+
+from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+
+from image_repo.export import build_export
+from image_repo.models import Export, Image
+from .environment import benchmark_environment
+
+
+def add_arguments(parser):
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 500], help='library sizes')
+    parser.add_argument('--file-size', type=int, default=512, help='size of the stored files in KiB')
+
+
+def grow_library(user, size, file_size):
+    """Store files until the user has `size` images"""
+    storage = Image.image.field.storage
+    for i in range(Image.objects.filter(user=user).count(), size):
+        # random bytes, the export doesn't look into the files
+        name = storage.save(f'{user.username}/export{i}.jpg', ContentFile(os.urandom(file_size)))
+        Image.objects.create(image=name, user=user, description='A benchmark image.', tags='#benchmark',
+                             colors='white', analysis_status=Image.DONE)
+
+
+def run(command, sizes=(10, 100, 500), file_size=512, **options):
+    with benchmark_environment():
+        user = User.objects.create_user(username='benchmark')
+        for size in sorted(sizes):
+            grow_library(user, size, file_size * 1024)
+            tracemalloc.start()
+            start = time.perf_counter()
+            # what the worker does with a claimed export, the archive is written to storage
+            export = Export.objects.create(user=user, status=Export.PROCESSING)
+            build_export(export)
+            elapsed = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            written = Image.image.field.storage.size(export.archive)
+            command.stdout.write(f'{size:>6} images: {written / 2 ** 20:8.1f} MiB in {elapsed:6.2f} s '
+                                 f'({written / 2 ** 20 / elapsed:7.1f} MiB/s), peak {peak / 2 ** 20:6.1f} MiB allocated')
@@ -0,0 +1,65 @@
+"""Repeated reads of stored images with and without the local file cache, against a bucket with request latency"""
+import os
+import shutil
+import tempfile
+import time
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.test import override_settings
+
+from image_repo.storage import FileCacheMixin
+
+
+def add_arguments(parser):
+    parser.add_argument('--images', type=int, default=100, help='number of stored images')
+    parser.add_argument('--reads', type=int, default=5, help='reads of every image')
+    parser.add_argument('--file-size', type=int, default=512, help='size of the images in KiB')
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds per bucket request')
+
+
+class SlowStorage(FileSystemStorage):
+    """Stand-in for the bucket, every request waits `latency` seconds"""
+
+    def __init__(self, latency, **kwargs):
+        super().__init__(**kwargs)
+        self.latency = latency
+        self.requests = 0
+
+    def request(self):
+        self.requests += 1
+        time.sleep(self.latency)
+
+    def exists(self, name):
+        self.request()
+        return super().exists(name)
+
+    def _open(self, name, mode='rb'):
+        self.request()
+        return super()._open(name, mode)
+
+
+class CachedSlowStorage(FileCacheMixin, SlowStorage):
+    pass
+
+
+def run(command, images=100, reads=5, file_size=512, latency=0.02, **options):
+    directory = tempfile.mkdtemp()
+    location = os.path.join(directory, 'bucket')
+    try:
+        with override_settings(IMAGE_REPO_FILE_CACHE_DIR=os.path.join(directory, 'cache')):
+            names = [FileSystemStorage(location=location).save(f'benchmark/image{i}.jpg',
+                                                               ContentFile(os.urandom(file_size * 1024)))
+                     for i in range(images)]
+            for name, storage in (('bucket', SlowStorage(latency, location=location)),
+                                  ('file cache', CachedSlowStorage(latency, location=location))):
+                start = time.perf_counter()
+                for _ in range(reads):
+                    for stored in names:
+                        with storage.open(stored, 'rb') as file:
+                            file.read()
+                elapsed = time.perf_counter() - start
+                command.stdout.write(f'{name:>10}: {images * reads} reads in {elapsed:6.2f} s, '
+                                     f'{storage.requests} bucket requests')
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,47 @@
+"""Latency of a new connection per analysis (bare requests.post) vs the pooled session"""
+import os
+import statistics
+import time
+from unittest import mock
+
+from django.test import override_settings
+import requests
+
+from image_repo import analysis
+from .stub_azure import StubAzureServer
+
+
+def add_arguments(parser):
+    parser.add_argument('--calls', type=int, default=200, help='number of analysis calls per client')
+    parser.add_argument('--latency-ms', type=float, default=5, help='stub server processing time')
+    parser.add_argument('--handshake-ms', type=float, default=20, help='stub server cost of a new connection')
+
+
+def timed_calls(count, data):
+    timings = []
+    for _ in range(count):
+        start = time.perf_counter()
+        if analysis.azure_cv_api(data) is None:
+            raise RuntimeError('analysis call failed')
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def run(command, calls=200, latency_ms=5, handshake_ms=20, **options):
+    data = os.urandom(64 * 1024)
+    # the stub has no quota, the calls aren't spaced
+    with StubAzureServer(latency_ms / 1000, handshake_ms / 1000) as server, \
+            mock.patch.dict(os.environ, {'AZURE_CV_KEY': 'stub', 'AZURE_CV_ENDPOINT': server.endpoint}), \
+            override_settings(IMAGE_REPO_ANALYSIS_RATE=10 ** 6):
+        # a fresh session for every call behaves like the old bare requests.post
+        with mock.patch.object(analysis, 'get_session', requests_session):
+            fresh = timed_calls(calls, data)
+        pooled = timed_calls(calls, data)
+    for name, timings in (('new connection', fresh), ('pooled session', pooled)):
+        command.stdout.write(f'{name:>15}: mean {statistics.mean(timings) * 1000:.2f} ms, '
+                             f'median {statistics.median(timings) * 1000:.2f} ms')
+    command.stdout.write(f'speedup: {statistics.mean(fresh) / statistics.mean(pooled):.2f}x')
+
+
+def requests_session():
+    return requests.Session()
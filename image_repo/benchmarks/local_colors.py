@@ -0,0 +1,46 @@
+"""Images per second per core of the local color analyzer, one by one and in batches"""
+from io import BytesIO
+import time
+
+from PIL import Image as PILImage
+
+from image_repo.analysis import LocalColorAnalyzer
+
+
+def add_arguments(parser):
+    parser.add_argument('--images', type=int, default=200, help='number of analyzed images')
+    parser.add_argument('--side', type=int, default=1024, help='longest side of the images (as sent to analyzers)')
+    parser.add_argument('--batch-size', type=int, default=50, help='images per analyze_batch() call')
+
+
+def corpus(count, side):
+    """Return `count` different JPEGs shaped like the analysis copies"""
+    images = []
+    for i in range(count):
+        # a gradient under noise, tinted differently for every image
+        img = PILImage.linear_gradient('L').resize((side, side * 3 // 4)).convert('RGB')
+        noise = PILImage.effect_noise(img.size, 40).convert('RGB')
+        img = PILImage.blend(PILImage.blend(img, noise, 0.4), PILImage.new('RGB', img.size, (i * 37 % 256, 90, 160)),
+                             0.3)
+        output = BytesIO()
+        img.save(output, 'JPEG', quality=85)
+        images.append(output.getvalue())
+    return images
+
+
+def run(command, images=200, side=1024, batch_size=50, **options):
+    corpus_images = corpus(images, side)
+    analyzer = LocalColorAnalyzer()
+    analyzer(corpus_images[0])
+    # CPU time of all threads of the process, so the rate is per core
+    start = time.process_time()
+    for img in corpus_images:
+        analyzer(img)
+    single = time.process_time() - start
+    start = time.process_time()
+    for i in range(0, images, batch_size):
+        analyzer.analyze_batch(corpus_images[i:i + batch_size])
+    batched = time.process_time() - start
+    for name, seconds in (('one by one', single), (f'batches of {batch_size}', batched)):
+        command.stdout.write(f'{name:>15}: {images / seconds:8.1f} images/s per core '
+                             f'({seconds / images * 1000:.2f} ms CPU per {side}px image)')
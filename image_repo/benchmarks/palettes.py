@@ -0,0 +1,52 @@
+"""Top-k palette similarity queries on the NumPy index vs comparing with every palette in Python"""
+import math
+import time
+
+import numpy as np
+
+from image_repo.colors import COLOR_NAMES
+from image_repo.palettes import SIMILARITIES, PaletteIndex
+
+
+def add_arguments(parser):
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000, 100000],
+                        help='numbers of indexed palettes')
+    parser.add_argument('--queries', type=int, default=100, help='queries per size')
+    parser.add_argument('--count', type=int, default=20, help='images returned per query')
+    parser.add_argument('--python-max', type=int, default=10000,
+                        help='largest index also searched in plain Python')
+
+
+def python_search(palettes, vector, count):
+    """The distances of palettes.PaletteIndex.search() computed one palette at a time"""
+    similarities = SIMILARITIES.tolist()
+    found = []
+    for palette, image_id in palettes:
+        difference = [a - b for a, b in zip(palette, vector)]
+        squared = sum(difference[i] * similarities[i][j] * difference[j]
+                      for i in range(len(difference)) for j in range(len(difference)))
+        found.append((math.sqrt(max(squared, 0)), image_id))
+    return sorted(found)[:count]
+
+
+def run(command, sizes=(100, 1000, 10000, 100000), queries=100, count=20, python_max=10000, **options):
+    random = np.random.default_rng(0)
+    for size in sizes:
+        # a few colors per image, like real palettes
+        vectors = random.dirichlet(np.full(len(COLOR_NAMES), 0.3), size=size + queries).astype(np.float32)
+        palettes = [(vector.tolist(), image_id) for image_id, vector in enumerate(vectors[:size])]
+        start = time.perf_counter()
+        index = PaletteIndex()
+        for vector, image_id in palettes:
+            index.add(vector, image_id)
+        built = time.perf_counter() - start
+        methods = [('numpy', index.search)]
+        if size <= python_max:
+            methods.append(('python', lambda vector, count: python_search(palettes, vector, count)))
+        for name, search in methods:
+            start = time.perf_counter()
+            for vector in vectors[size:]:
+                search(vector.tolist(), count)
+            elapsed = time.perf_counter() - start
+            command.stdout.write(f'{size:>7} palettes, {name:>6}: {elapsed / queries * 1000:8.2f} ms per query'
+                                 + (f', index built by add() in {built * 1000:.1f} ms' if name == 'numpy' else ''))
@@ -0,0 +1,50 @@
+"""CPU time and bytes sent to the analyzer with and without downscaling"""
+from io import BytesIO
+from pathlib import Path
+import time
+
+from PIL import Image as PILImage
+
+from image_repo.imaging import prepare_for_analysis
+
+# (width, height, format) of the generated corpus
+SIZES = [(640, 480, 'JPEG'), (1920, 1080, 'JPEG'), (4000, 3000, 'JPEG'), (6000, 4000, 'JPEG'),
+         (1200, 1200, 'PNG'), (3000, 2000, 'PNG')]
+
+
+def add_arguments(parser):
+    parser.add_argument('--corpus', help='directory with images to use instead of the generated ones')
+    parser.add_argument('--repeat', type=int, default=3, help='number of runs over the corpus')
+
+
+def generated_corpus():
+    corpus = []
+    for width, height, format in SIZES:
+        # noise on top of a gradient compresses like a photo, not like a flat color
+        img = PILImage.linear_gradient('L').resize((width, height)).convert('RGB')
+        noise = PILImage.effect_noise((width, height), 40).convert('RGB')
+        img = PILImage.blend(img, noise, 0.5)
+        output = BytesIO()
+        img.save(output, format, quality=95)
+        corpus.append((f'{width}x{height}.{format.lower()}', output.getvalue()))
+    return corpus
+
+
+def run(command, corpus=None, repeat=3, **options):
+    if corpus:
+        images = [(path.name, path.read_bytes()) for path in sorted(Path(corpus).iterdir()) if path.is_file()]
+    else:
+        images = generated_corpus()
+    total_original = total_sent = total_cpu = 0
+    for name, data in images:
+        start = time.process_time()
+        for _ in range(repeat):
+            sent = prepare_for_analysis(data)
+        cpu = (time.process_time() - start) / repeat
+        total_original += len(data)
+        total_sent += len(sent)
+        total_cpu += cpu
+        command.stdout.write(f'{name:>20}: {len(data) / 1024:9.0f} KB -> {len(sent) / 1024:7.0f} KB, '
+                             f'{cpu * 1000:7.1f} ms CPU')
+    command.stdout.write(f'{"total":>20}: {total_original / 1024:9.0f} KB -> {total_sent / 1024:7.0f} KB '
+                         f'({total_sent / total_original:.1%} sent), {total_cpu * 1000:7.1f} ms CPU')
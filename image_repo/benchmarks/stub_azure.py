@@ -0,0 +1,71 @@
+"""Local stand-in for the Azure Computer Vision analyze endpoint"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+import time
+
+RESULT = {
+    'description': {'captions': [{'text': 'a stub image', 'confidence': 0.9}], 'tags': ['stub', 'image']},
+    'color': {'dominantColors': ['White', 'Black']},
+}
+
+
+class StubAzureHandler(BaseHTTPRequestHandler):
+    # keep connections alive like the real endpoint
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately, avoid delayed ACK stalls on reused connections
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        # runs once per connection, stands in for the TCP + TLS handshake cost
+        time.sleep(self.server.handshake_delay)
+        super().setup()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        time.sleep(self.server.latency)
+        with self.server.lock:
+            status = self.server.errors.pop(0) if self.server.errors else 200
+            self.server.calls += 1
+        body = json.dumps(RESULT if status == 200 else {'error': {'code': str(status)}}).encode()
+        self.send_response(status)
+        if status == 429:
+            self.send_header('Retry-After', '0')
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubAzureServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # the default backlog of 5 drops connections when hundreds arrive at once
+    request_queue_size = 1024
+
+    def __init__(self, latency=0.0, handshake_delay=0.0, errors=()):
+        super().__init__(('127.0.0.1', 0), StubAzureHandler)
+        self.latency = latency
+        self.handshake_delay = handshake_delay
+        # status codes answered to the first calls, like 429 or 503
+        self.errors = list(errors)
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def handle_error(self, request, client_address):
+        # clients that timed out close the connection before the response is written
+        pass
+
+    @property
+    def endpoint(self):
+        return f'http://127.0.0.1:{self.server_address[1]}/'
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
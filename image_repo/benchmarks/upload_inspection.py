@@ -0,0 +1,58 @@
+"""Time and peak memory of checking uploads with a Pillow pass vs the streaming inspection"""
+import hashlib
+import time
+import tracemalloc
+
+from django import forms
+from django.core.files.uploadedfile import SimpleUploadedFile
+
+from image_repo.forms import SniffedImageField
+from image_repo.uploadhandlers import UploadInspector
+from .preprocess import generated_corpus
+
+# chunk size of the upload handlers
+CHUNK_SIZE = 64 * 1024
+
+
+def add_arguments(parser):
+    parser.add_argument('--repeat', type=int, default=5, help='number of checks per image')
+
+
+def pillow_check(name, data):
+    """Hash the chunks and validate with forms.ImageField, like uploads were checked before"""
+    hasher = hashlib.sha256()
+    for start in range(0, len(data), CHUNK_SIZE):
+        hasher.update(data[start:start + CHUNK_SIZE])
+    forms.ImageField().clean(SimpleUploadedFile(name, data))
+
+
+def inspected_check(name, data):
+    """Inspect the chunks and validate with forms.SniffedImageField"""
+    inspector = UploadInspector()
+    for start in range(0, len(data), CHUNK_SIZE):
+        inspector.update(data[start:start + CHUNK_SIZE])
+    file = SimpleUploadedFile(name, data)
+    file.image_info = inspector.image_info
+    SniffedImageField().clean(file)
+
+
+def measure(check, name, data, repeat):
+    """Return the mean time in ms and the peak of allocated KB of the check"""
+    # the first check imports the Pillow plugins
+    check(name, data)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        check(name, data)
+    elapsed = (time.perf_counter() - start) / repeat
+    tracemalloc.start()
+    check(name, data)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed * 1000, peak / 1024
+
+
+def run(command, repeat=5, **options):
+    for name, data in generated_corpus():
+        results = [measure(check, name, data, repeat) for check in (pillow_check, inspected_check)]
+        command.stdout.write(f'{name:>20} ({len(data) / 1024:6.0f} KB): ' + ', '.join(
+            f'{label} {ms:7.2f} ms {kb:7.0f} KB peak' for label, (ms, kb) in zip(('pillow', 'inspected'), results)))
@@ -0,0 +1,51 @@
+"""repo.html render time with signed URLs generated on every render vs cached"""
+import statistics
+import time
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.template.loader import render_to_string
+from storages.backends.s3boto3 import S3Boto3Storage
+
+from image_repo.models import Image
+from image_repo.storage import S3Storage
+
+
+def add_arguments(parser):
+    parser.add_argument('--images', type=int, default=500, help='number of images in the library')
+    parser.add_argument('--repeat', type=int, default=10, help='number of renders per storage')
+
+
+def render_times(storage, images, repeat):
+    timings = []
+    with mock.patch.object(Image.image.field, 'storage', storage):
+        for image in images:
+            # unsaved instances still have a FieldFile, bound to the patched storage
+            image.image.storage = storage
+        for _ in range(repeat):
+            start = time.perf_counter()
+            render_to_string('image_repo/repo.html', {'images': images})
+            timings.append(time.perf_counter() - start)
+    return timings
+
+
+def run(command, images=500, repeat=10, **options):
+    # signing is done locally, the bucket is never contacted
+    credentials = {'access_key': 'benchmark', 'secret_key': 'benchmark', 'bucket_name': 'benchmark',
+                   'region_name': 'us-east-2', 'querystring_expire': 1800}
+    user = User(username='benchmark')
+    library = [Image(id=i, user=user, image=f'benchmark/image{i}.png', description='A benchmark image.',
+                     tags='#benchmark #image', colors='white black', analysis_status=Image.DONE,
+                     derivatives={'400': f'benchmark/image{i}_400w.webp', '800': f'benchmark/image{i}_800w.webp'})
+               for i in range(images)]
+    cache.clear()
+    signed = render_times(S3Boto3Storage(**credentials), library, repeat)
+    cached_storage = S3Storage(**credentials)
+    # the first render fills the cache, the following ones are what a repeat view costs
+    render_times(cached_storage, library, 1)
+    cached = render_times(cached_storage, library, repeat)
+    for name, timings in (('signed', signed), ('cached', cached)):
+        command.stdout.write(f'{name}: mean {statistics.mean(timings) * 1000:.1f} ms, '
+                             f'median {statistics.median(timings) * 1000:.1f} ms per render of {images} images')
+    command.stdout.write(f'speedup: {statistics.mean(signed) / statistics.mean(cached):.2f}x')
@@ -0,0 +1,146 @@
+"""Latency, queries and allocations of the main views at several library sizes, checked against a baseline"""
+import json
+import os
+import statistics
+import time
+import tracemalloc
+
+from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import CommandError
+from django.db import connection
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from image_repo import pagecache
+from image_repo.models import Image
+from image_repo.search import index_image
+from .environment import benchmark_environment, image_bytes
+
+# results the checks compare against, written with --save-baseline
+BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+
+def add_arguments(parser):
+    parser.add_argument('--sizes', type=int, nargs='+', default=[0, 100, 1000], help='library sizes')
+    parser.add_argument('--requests', type=int, default=30, help='measured requests per endpoint and size')
+    parser.add_argument('--baseline', default=BASELINE, help='baseline file')
+    parser.add_argument('--save-baseline', action='store_true', help='store the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.5,
+                        help='allowed relative growth of the p50 latency and allocations over the baseline')
+
+
+def stub_analyzer(img):
+    """Analyzer that answers right away, uploads must not wait for it anyway"""
+    return {'description': 'a benchmark image.', 'tags': '#benchmark', 'colors': 'white'}
+
+
+def endpoints(user):
+    """Return {name: (function making one request, function called before it or None)} of the measured views"""
+    client = Client()
+    client.force_login(user)
+    anonymous = Client()
+    uploads = iter(range(10 ** 9))
+
+    def upload():
+        file = SimpleUploadedFile(f'upload{next(uploads)}.png', image_bytes(next(uploads)))
+        return client.post(reverse('repo'), {'image': file})
+
+    return {
+        'sign_in': (lambda: anonymous.post(reverse('signin'), {'username': 'benchmark', 'password': 'benchmark'}),
+                    None),
+        # the image list is rendered every time
+        'repo': (lambda: client.get(reverse('repo')), lambda: pagecache.bump_version(user.id)),
+        'repo_cached': (lambda: client.get(reverse('repo')), None),
+        'search': (lambda: client.get(reverse('search'), {'q': 'benchmark #image'}), None),
+        'upload': (upload, None),
+    }
+
+
+def measure(request, prepare, count):
+    """Return p50 and p99 latency in ms, the query count and the peak of allocated KiB of the request"""
+    prepare = prepare or (lambda: None)
+    # the first request fills caches and imports modules
+    prepare()
+    request()
+    timings = []
+    for _ in range(count):
+        prepare()
+        start = time.perf_counter()
+        request()
+        timings.append(time.perf_counter() - start)
+    prepare()
+    with CaptureQueriesContext(connection) as queries:
+        request()
+    # the log of the connection is cleared when it is opened again
+    query_count = len(queries)
+    prepare()
+    tracemalloc.start()
+    request()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {
+        'p50_ms': round(statistics.median(timings) * 1000, 2),
+        'p99_ms': round(statistics.quantiles(timings, n=100)[98] * 1000, 2),
+        'queries': query_count,
+        'alloc_kib': round(peak / 1024, 1),
+    }
+
+
+def grow_library(user, size):
+    """Add analyzed images (without files) until the user has `size` images"""
+    missing = max(size - Image.objects.filter(user=user).count(), 0)
+    Image.objects.bulk_create([Image(image=f'{user.username}/library{i}.png', user=user,
+                                     description='A benchmark image.', tags='#benchmark #image',
+                                     colors='white black', analysis_status=Image.DONE)
+                               for i in range(missing)])
+    # the images are found by search like analyzed ones
+    # (bulk_create() doesn't set the ids of the new rows on every database)
+    for image in Image.objects.filter(user=user).order_by('-id')[:missing]:
+        index_image(image)
+    # bulk_create() doesn't send post_save
+    pagecache.bump_version(user.id)
+
+
+def regressions(results, baseline, tolerance):
+    """Return descriptions of the results that are worse than the baseline"""
+    found = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        # query counts are exact, timings and allocations vary between runs, and
+        # the p99 of a few dozen requests is too noisy to be checked
+        if result['queries'] > base['queries']:
+            found.append(f"{name}: {result['queries']} queries, baseline {base['queries']}")
+        for metric in ('p50_ms', 'alloc_kib'):
+            if result[metric] > base[metric] * (1 + tolerance):
+                found.append(f'{name}: {metric} {result[metric]}, baseline {base[metric]}')
+    return found
+
+
+def run(command, sizes=(0, 100, 1000), requests=30, baseline=BASELINE, save_baseline=False, tolerance=0.5,
+        **options):
+    results = {}
+    with benchmark_environment(), override_settings(IMAGE_REPO_UPLOAD_LIMIT=10 ** 9,
+                                                    IMAGE_REPO_ANALYZER='image_repo.benchmarks.views.stub_analyzer'):
+        user = User.objects.create_user(username='benchmark', password='benchmark')
+        for size in sorted(sizes):
+            grow_library(user, size)
+            for name, (request, prepare) in endpoints(user).items():
+                results[f'{name}@{size}'] = result = measure(request, prepare, requests)
+                command.stdout.write(f"{name + '@' + str(size):>20}: p50 {result['p50_ms']:8.2f} ms, "
+                                     f"p99 {result['p99_ms']:8.2f} ms, {result['queries']:3} queries, "
+                                     f"{result['alloc_kib']:9.1f} KiB")
+    if save_baseline:
+        with open(baseline, 'w') as file:
+            json.dump(results, file, indent=2, sort_keys=True)
+            file.write('\n')
+        command.stdout.write(f'baseline saved to {baseline}')
+    elif os.path.exists(baseline):
+        with open(baseline) as file:
+            found = regressions(results, json.load(file), tolerance)
+        if found:
+            raise CommandError('regressions over the baseline:\n' + '\n'.join(found))
+        command.stdout.write('no regressions over the baseline')
@@ -0,0 +1,105 @@
+"""
+Dominant colors computed locally with NumPy (see analysis.LocalColorAnalyzer).
+
+Pixels of a downsampled copy are quantized to the nearest color of a fixed
+palette, the same color names Azure Computer Vision returns, so results of
+both backends can be mixed in search. The shares of all palette colors are
+also kept as a vector per image (Image.palette, see palettes.py).
+"""
+from io import BytesIO
+
+from django.conf import settings
+import numpy as np
+from PIL import Image as PILImage
+
+from .imaging import flatten
+
+# (name, RGB) prototypes of the Azure color names, some names have several shades
+PALETTE = [
+    ('black', (15, 15, 15)), ('black', (45, 40, 40)),
+    ('grey', (128, 128, 128)), ('grey', (185, 185, 185)), ('grey', (80, 85, 90)),
+    ('white', (245, 245, 245)),
+    ('red', (200, 30, 30)), ('red', (130, 20, 25)),
+    ('orange', (240, 140, 30)),
+    ('yellow', (240, 220, 50)),
+    ('green', (60, 160, 60)), ('green', (30, 80, 30)), ('green', (150, 190, 90)),
+    ('teal', (0, 128, 128)),
+    ('blue', (40, 90, 210)), ('blue', (20, 35, 100)), ('blue', (130, 180, 230)),
+    ('purple', (120, 50, 150)),
+    ('pink', (240, 150, 180)),
+    ('brown', (120, 75, 40)), ('brown', (190, 150, 110)),
+]
+COLOR_NAMES = list(dict.fromkeys(name for name, rgb in PALETTE))
+_prototypes = np.array([rgb for name, rgb in PALETTE], dtype=np.float32)
+_prototype_names = np.array([COLOR_NAMES.index(name) for name, rgb in PALETTE], dtype=np.uint8)
+# nearest prototype = argmax(2 p.c - |c|^2), one matrix product for all pixels
+_weights = 2 * _prototypes.T
+_offsets = (_prototypes ** 2).sum(axis=1)
+# pixels quantized per matrix product, the (pixels, prototypes) scores stay a few dozen KiB
+QUANTIZE_BLOCK = 256
+
+
+def image_pixels(img):
+    """Return the (n, 3) RGB pixels of a downsampled copy of an opened image"""
+    size = settings.IMAGE_REPO_LOCAL_COLOR_SAMPLE_SIDE
+    scale = min(size / img.width, size / img.height)
+    if scale < 1:
+        # like thumbnail(), without changing the image
+        img = img.resize((max(1, round(img.width * scale)), max(1, round(img.height * scale))),
+                         PILImage.BICUBIC, reducing_gap=2.0)
+    return np.asarray(flatten(img)).reshape(-1, 3)
+
+
+def sample_pixels(file):
+    """Return the (n, 3) RGB pixels of a downsampled copy of the image file"""
+    size = settings.IMAGE_REPO_LOCAL_COLOR_SAMPLE_SIDE
+    with PILImage.open(file) as img:
+        # the JPEG decoder scales down while decoding
+        img.draft('RGB', (size, size))
+        return image_pixels(img)
+
+
+def nearest_colors(pixels):
+    """Return the index in COLOR_NAMES of the color of every (n, 3) RGB pixel"""
+    names = np.empty(len(pixels), dtype=np.uint8)
+    for start in range(0, len(pixels), QUANTIZE_BLOCK):
+        scores = pixels[start:start + QUANTIZE_BLOCK].astype(np.float32) @ _weights
+        scores -= _offsets
+        names[start:start + QUANTIZE_BLOCK] = _prototype_names[scores.argmax(axis=1)]
+    return names
+
+
+def color_counts(samples):
+    """Return an (images, colors) array of the number of pixels of every palette color in every sample"""
+    names = nearest_colors(np.concatenate(samples))
+    ends = np.cumsum([len(sample) for sample in samples])[:-1]
+    return np.array([np.bincount(sample_names, minlength=len(COLOR_NAMES)) for sample_names in np.split(names, ends)])
+
+
+def dominant_colors(counts):
+    """Return the colors string (like Image.colors) of a row of color_counts()"""
+    shares = counts / max(counts.sum(), 1)
+    order = np.argsort(-shares, kind='stable')[:settings.IMAGE_REPO_LOCAL_COLORS]
+    return ' '.join(COLOR_NAMES[i] for i in order if shares[i] >= settings.IMAGE_REPO_LOCAL_COLOR_MIN_SHARE)
+
+
+def image_colors(images):
+    """Return the dominant colors of every image (bytes), quantized in one vectorized pass"""
+    if not images:
+        return []
+    return [dominant_colors(counts) for counts in color_counts([sample_pixels(BytesIO(data)) for data in images])]
+
+
+def palette_shares(counts):
+    """Return the palette (like Image.palette) of a row of color_counts()"""
+    return [round(float(share), 4) for share in counts / max(counts.sum(), 1)]
+
+
+def palette_vector(file):
+    """Return the share of every color of COLOR_NAMES in the image file, the value of Image.palette"""
+    return palette_shares(color_counts([sample_pixels(file)])[0])
+
+
+def image_palette(img):
+    """Return the palette of a decoded image (see imaging.decode())"""
+    return palette_shares(color_counts([image_pixels(img)])[0])
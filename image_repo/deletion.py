@@ -0,0 +1,78 @@
+"""
+Deleting many images at once.
+
+The rows are locked and go with one QuerySet.delete() while the Image signals are muted (the
+users' cached pages are invalidated once afterwards), and the originals and
+derivatives with batched storage deletes: S3Storage.delete_many() sends up to
+1000 keys per request, several requests at a time.
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from . import metrics, pagecache
+from .models import Image
+
+
+def stored_names(name, derivatives):
+    """Return the storage names of an original and its derivatives"""
+    return [name, *derivatives.values()]
+
+
+def delete_stored_files(storage, names):
+    """Delete stored files, with batched requests when the storage has them, return the names that failed"""
+    if hasattr(storage, 'delete_many'):
+        return storage.delete_many(names)
+    failed = []
+    with ThreadPoolExecutor(max_workers=settings.IMAGE_REPO_DELETE_WORKERS) as pool:
+        for name, error in zip(names, pool.map(delete_file, [storage] * len(names), names)):
+            if error is not None:
+                print(f'{name}: {error}')
+                failed.append(name)
+    return failed
+
+
+def delete_file(storage, name):
+    """Delete one stored file, return the error or None (runs in a pool thread)"""
+    try:
+        storage.delete(name)
+    except Exception as e:
+        return e
+
+
+def delete_images(images, exports=None):
+    """
+    Delete the images of a queryset with their files, search labels and cache entries, return how many.
+
+    `exports` are deleted with their archives too, when the whole library goes.
+    """
+    storage = Image.image.field.storage
+    user_ids = set()
+    # the versions of the users read below are bumped once the rows are gone
+    with pagecache.bulk_changes(user_ids), transaction.atomic():
+        # the rows are locked and deleted by id, so the files deleted are those of the deleted rows,
+        # images added or changed meanwhile are left alone
+        rows = list(images.select_for_update().values_list('id', 'user_id', 'image', 'derivatives'))
+        if not rows:
+            return 0
+        user_ids.update(user_id for image_id, user_id, image, derivatives in rows)
+        names = [name for image_id, user_id, image, derivatives in rows for name in stored_names(image, derivatives)]
+        # labels cascade, near-duplicates of the images lose their duplicate_of
+        count = Image.objects.filter(id__in=[image_id for image_id, *rest in rows]).delete()[1].get(
+            Image._meta.label, 0)
+        if exports is not None:
+            # exports still queued or being built have no archive yet
+            exports = exports.select_for_update().exclude(archive='')
+            names += exports.values_list('archive', flat=True)
+            exports.delete()
+    # the rows go first: a failed storage request leaves files nothing points to, not broken images
+    with metrics.timed('storage'):
+        failed = delete_stored_files(storage, names)
+    if failed:
+        print(f'{len(failed)} files could not be deleted: {failed[:10]}')
+    if hasattr(storage, 'url_cache_key'):
+        # signed URLs of the files, the cached pages are invalidated by their new version
+        cache.delete_many([storage.url_cache_key(name) for name in names])
+    return count
@@ -0,0 +1,128 @@
+"""
+Near-duplicate detection with perceptual hashes.
+
+Every image gets a 64-bit DCT hash (Image.phash) that stays within a few bits
+for resized or recompressed copies. The hashes of a user are kept in an
+in-process BK-tree, rebuilt from the database when the user's images changed
+(the version of pagecache.py), so a lookup doesn't scan the library.
+"""
+from django.conf import settings
+import numpy as np
+from PIL import Image as PILImage, ImageOps
+
+from .imaging import flatten
+from .indexes import UserIndexes
+from .models import Image
+
+# side of the grayscale copy transformed by the DCT, the hash keeps its 8x8 lowest frequencies
+HASH_SIDE = 32
+_dct = np.array([[np.cos(np.pi * (2 * n + 1) * k / (2 * HASH_SIDE)) for n in range(HASH_SIDE)]
+                 for k in range(HASH_SIDE)], dtype=np.float32) * np.sqrt(2 / HASH_SIDE)
+_dct[0] /= np.sqrt(2)
+
+
+def perceptual_hash(file):
+    """Return the 64-bit perceptual hash of an image file, as a signed integer like Image.phash"""
+    with PILImage.open(file) as img:
+        # the JPEG decoder scales down while decoding, copies rotated with EXIF hash the same
+        img.draft('RGB', (HASH_SIDE * 2, HASH_SIDE * 2))
+        return image_hash(flatten(ImageOps.exif_transpose(img)))
+
+
+def image_hash(img):
+    """Return the perceptual hash of a decoded upright RGB image (see imaging.decode())"""
+    pixels = np.asarray(img.convert('L').resize((HASH_SIDE, HASH_SIDE), PILImage.LANCZOS), dtype=np.float32)
+    low = (_dct @ pixels @ _dct.T)[:8, :8].ravel()
+    # the average brightness (first coefficient) would dominate the median
+    bits = low > np.median(low[1:])
+    value = int.from_bytes(np.packbits(bits).tobytes(), 'big')
+    # stored in a signed 64-bit column
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def hamming(a, b):
+    """Return the number of different bits of two hashes"""
+    return bin((a ^ b) & 0xFFFFFFFFFFFFFFFF).count('1')
+
+
+class BKTree:
+    """Metric tree of hashes under the Hamming distance, searching visits only a few branches"""
+
+    def __init__(self, items=()):
+        # node: [hash, image ids with this hash, {distance: child node}]
+        self.root = None
+        for value, image_id in items:
+            self.add(value, image_id)
+
+    def add(self, value, image_id):
+        if self.root is None:
+            self.root = [value, [image_id], {}]
+            return
+        node = self.root
+        while True:
+            distance = hamming(value, node[0])
+            if distance == 0:
+                node[1].append(image_id)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [value, [image_id], {}]
+                return
+            node = child
+
+    def search(self, value, radius):
+        """Return [(distance, image id)] of the hashes within `radius`, nearest first"""
+        found = []
+        nodes = [self.root] if self.root is not None else []
+        while nodes:
+            node = nodes.pop()
+            distance = hamming(value, node[0])
+            if distance <= radius:
+                found.extend((distance, image_id) for image_id in node[1])
+            # by the triangle inequality, matches are only below children in this range
+            nodes.extend(child for edge, child in node[2].items() if distance - radius <= edge <= distance + radius)
+        return sorted(found)
+
+
+def build_index(user_id):
+    return BKTree(Image.objects.filter(user_id=user_id, phash__isnull=False).values_list('phash', 'id'))
+
+
+# BK-trees of the users' hashes
+indexes = UserIndexes(build_index, 'IMAGE_REPO_DUPLICATE_INDEX_USERS')
+
+
+def search_index(user_id, value, radius, version=None):
+    """Return [(distance, image id)] of the user's hashes within `radius` of the hash"""
+    tree = indexes.get(user_id, version)
+    # add_to_index() may change the tree meanwhile
+    with indexes.lock:
+        return tree.search(value, radius)
+
+
+def add_to_index(image, version):
+    """Add a just saved image to the user's tree if it was built at `version`, instead of rebuilding it"""
+    if image.phash is not None:
+        indexes.update(image.user_id, version, lambda tree: tree.add(image.phash, image.id),
+                       getattr(image, 'list_version', None))
+
+
+def similar_images(image, radius=None):
+    """Return the user's other images within `radius` bits of the image's hash, nearest first"""
+    if image.phash is None:
+        return []
+    radius = settings.IMAGE_REPO_SIMILAR_DISTANCE if radius is None else radius
+    ids = [image_id for distance, image_id in search_index(image.user_id, image.phash, radius)
+           if image_id != image.id]
+    images = Image.objects.in_bulk(ids)
+    # in_bulk() loses the order of the ids
+    return [images[image_id] for image_id in ids if image_id in images]
+
+
+def find_duplicate(image, version=None):
+    """Return the user's nearest image that is a near-duplicate of the (new) image, or None"""
+    if image.phash is None:
+        return None
+    matches = search_index(image.user_id, image.phash, settings.IMAGE_REPO_DUPLICATE_DISTANCE, version)
+    ids = [image_id for distance, image_id in matches if image_id != image.id]
+    return Image.objects.filter(id=ids[0]).first() if ids else None
@@ -0,0 +1,182 @@
+"""
+ZIP export of a user's library, built by the worker of `manage.py export_libraries`.
+
+Users queue an export (views.export()) and are redirected to the stored
+archive once it is built. The web process never writes the archive: under
+ASGI, Django 3.2 iterates streaming responses in the event loop, where the
+storage reads and queries would block every other request.
+
+The archive is written in chunks: the originals are copied into it as the
+storage reads of the next few images finish on a thread pool, and a CSV
+manifest of the analysis results is added last. Only the files read ahead
+and one page of rows are held in memory, whatever the size of the library.
+"""
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import csv
+from datetime import timedelta
+import io
+import posixpath
+import tempfile
+import time
+import zipfile
+
+from django.conf import settings
+from django.core.files import File
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .deletion import delete_stored_files
+from .models import Export, Image
+
+# the archives are stored in this folder of the user's folder, views.image_file() serves both
+EXPORTS_FOLDER = 'exports'
+# columns of manifest.csv
+MANIFEST_FIELDS = ['file', 'description', 'tags', 'colors']
+
+
+class ZipStream:
+    """Write-only file the ZIP is written to, pop() returns what was written since the last call"""
+
+    def __init__(self):
+        self.parts = []
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b''.join(self.parts)
+        self.parts = []
+        return data
+
+
+def read_file(storage, name):
+    """Return the chunks of a stored file (runs in a pool thread)"""
+    with storage.open(name, 'rb') as file:
+        return list(file.chunks(settings.IMAGE_REPO_EXPORT_CHUNK_SIZE))
+
+
+def library_pages(user_id, fields):
+    """Yield the user's images oldest first as pages of value rows, by keyset over the ids"""
+    last_id = 0
+    while True:
+        page = list(Image.objects.filter(user_id=user_id, id__gt=last_id).order_by('id')
+                    .values_list('id', *fields)[:settings.IMAGE_REPO_EXPORT_PAGE_SIZE])
+        if not page:
+            return
+        last_id = page[-1][0]
+        yield page
+
+
+def zip_library(user_id):
+    """Yield the bytes of a ZIP of the user's originals and manifest.csv"""
+    reads = ThreadPoolExecutor(max_workers=settings.IMAGE_REPO_EXPORT_PREFETCH)
+    storage = Image.image.field.storage
+    date_time = time.localtime()[:6]
+    stream = ZipStream()
+    # the originals are already compressed
+    archive = zipfile.ZipFile(stream, 'w', zipfile.ZIP_STORED)
+    try:
+        # reads of the next images run while the current one is written
+        ahead = deque()
+        for page in library_pages(user_id, ['image']):
+            for image_id, name in page:
+                ahead.append((name, reads.submit(read_file, storage, name)))
+                while len(ahead) > settings.IMAGE_REPO_EXPORT_PREFETCH or (ahead and ahead[0][1].done()):
+                    yield from write_file(archive, stream, date_time, *ahead.popleft())
+        while ahead:
+            yield from write_file(archive, stream, date_time, *ahead.popleft())
+        info = zipfile.ZipInfo('manifest.csv', date_time)
+        info.compress_type = zipfile.ZIP_DEFLATED
+        with archive.open(info, 'w') as entry, io.TextIOWrapper(entry, encoding='utf-8', newline='') as text:
+            writer = csv.writer(text)
+            writer.writerow(MANIFEST_FIELDS)
+            for page in library_pages(user_id, ['image', 'description', 'tags', 'colors']):
+                writer.writerows((posixpath.basename(name), *values) for image_id, name, *values in page)
+                text.flush()
+                yield stream.pop()
+        archive.close()
+        yield stream.pop()
+    finally:
+        # also when the archive isn't finished, the reads left are not waited for
+        reads.shutdown(wait=False)
+
+
+def write_file(archive, stream, date_time, name, future):
+    """Copy a read file into the archive, yield the archive bytes chunk by chunk"""
+    try:
+        chunks = future.result()
+    except Exception as e:
+        # the rest of the library is still exported, the file stays listed in the manifest
+        print(e)
+        return
+    info = zipfile.ZipInfo(posixpath.basename(name), date_time)
+    info.file_size = sum(len(chunk) for chunk in chunks)
+    with archive.open(info, 'w') as entry:
+        for chunk in chunks:
+            entry.write(chunk)
+            yield stream.pop()
+    yield stream.pop()
+
+
+def request_export(user):
+    """Queue an export of the user's library unless one is waiting already, return it"""
+    waiting = Export.objects.filter(user=user, status__in=[Export.PENDING, Export.PROCESSING]).first()
+    return waiting or Export.objects.create(user=user)
+
+
+def claim_export():
+    """Mark the oldest pending export as processing and return it, None when there is none"""
+    # exports stuck in processing belong to a worker that was killed
+    stale = timezone.now() - timedelta(seconds=settings.IMAGE_REPO_EXPORT_TIMEOUT)
+    with transaction.atomic():
+        export = (Export.objects.select_for_update(skip_locked=True)
+                  .filter(Q(status=Export.PENDING) | Q(status=Export.PROCESSING, started__lt=stale))
+                  .order_by('id').first())
+        if export is not None:
+            export.status = Export.PROCESSING
+            export.started = timezone.now()
+            export.save(update_fields=['status', 'started'])
+    return export
+
+
+def build_export(export):
+    """Write the ZIP of the user's library to storage, the user's earlier archives are deleted"""
+    storage = Image.image.field.storage
+    username = export.user.username
+    # spooled to a local file, so big libraries aren't held in memory
+    with tempfile.TemporaryFile() as file:
+        for part in zip_library(export.user_id):
+            file.write(part)
+        file.seek(0)
+        export.archive = storage.save(f'{username}/{EXPORTS_FOLDER}/{username}-image-repo.zip', File(file))
+    export.status = Export.DONE
+    export.save(update_fields=['archive', 'status'])
+    earlier = Export.objects.filter(user_id=export.user_id, id__lt=export.id)
+    delete_stored_files(storage, [name for name in earlier.values_list('archive', flat=True) if name])
+    earlier.delete()
+
+
+def run_export_worker(once=False, poll_interval=None):
+    """Build queued exports until there are none left (once=True) or forever, return the number built"""
+    poll_interval = settings.IMAGE_REPO_EXPORT_POLL_INTERVAL if poll_interval is None else poll_interval
+    built = 0
+    while True:
+        export = claim_export()
+        if export is None:
+            if once:
+                return built
+            time.sleep(poll_interval)
+            continue
+        try:
+            build_export(export)
+            built += 1
+        except Exception as e:
+            print(e)
+            export.status = Export.FAILED
+            export.save(update_fields=['status'])
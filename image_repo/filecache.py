@@ -0,0 +1,135 @@
+"""
+Local disk cache of stored files (see storage.FileCacheMixin).
+
+Copies are kept in IMAGE_REPO_FILE_CACHE_DIR under a hash of the storage name
+and the least recently used ones are removed when they add up to more than
+IMAGE_REPO_FILE_CACHE_SIZE bytes. Stored files are never overwritten
+(AWS_S3_FILE_OVERWRITE = False), so a copy stays valid until the file is
+deleted.
+
+The processes of a server share the directory. A hit sets the access time of
+the copy, and a process rescans the directory after writing RESCAN_SHARE of
+the limit, evicting by the directory total in access order. Between scans the
+copies of the other processes are not counted, so the directory holds at most
+the limit plus RESCAN_SHARE of it per writing process. Partial copies left by
+a killed process are removed by the scans once they are STALE_TEMP_AGE old.
+"""
+from collections import OrderedDict
+import hashlib
+import os
+import tempfile
+import threading
+import time
+
+# share of the limit a process writes before it rescans the directory
+RESCAN_SHARE = 0.1
+# seconds since the last write after which a partial copy belongs to a killed process
+STALE_TEMP_AGE = 3600
+
+
+class FileCache:
+    """Size-bounded LRU directory of file copies keyed by storage name"""
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        # path: size, least recently used first
+        self._entries = OrderedDict()
+        self.size = 0
+        # bytes written since the last scan
+        self.written = 0
+        os.makedirs(directory, exist_ok=True)
+        with self._lock:
+            self._rescan()
+
+    def path(self, name):
+        return os.path.join(self.directory, hashlib.sha256(name.encode()).hexdigest())
+
+    def get(self, name):
+        """Return the path of the copy of `name`, None when there is none"""
+        path = self.path(name)
+        try:
+            stat = os.stat(path)
+            # the access time orders the copies of all processes when the directory is scanned,
+            # the modification time stays the one of the ETag (views.image_file())
+            os.utime(path, ns=(time.time_ns(), stat.st_mtime_ns))
+        except FileNotFoundError:
+            self.discard(name)
+            return None
+        with self._lock:
+            if path not in self._entries:
+                # written by another process
+                self._entries[path] = stat.st_size
+                self.size += stat.st_size
+            self._entries.move_to_end(path)
+        return path
+
+    def put(self, name, chunks):
+        """Store the chunks as the copy of `name`, return its path"""
+        path = self.path(name)
+        # readers never see a partial copy: it is written under a temporary name first
+        fd, temp = tempfile.mkstemp(dir=self.directory, prefix='.', suffix='.tmp')
+        size = 0
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                for chunk in chunks:
+                    file.write(chunk)
+                    size += len(chunk)
+            os.replace(temp, path)
+        except BaseException:
+            os.unlink(temp)
+            raise
+        with self._lock:
+            self.size += size - self._entries.pop(path, 0)
+            self._entries[path] = size
+            self.written += size
+            if self.written >= self.max_size * RESCAN_SHARE:
+                self._rescan()
+            else:
+                self._evict()
+        return path
+
+    def discard(self, name):
+        """Remove the copy of `name` if there is one"""
+        path = self.path(name)
+        with self._lock:
+            self.size -= self._entries.pop(path, 0)
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+    def _rescan(self):
+        # called with the lock held, counts the copies of all processes, least recently used first
+        files = []
+        stale = time.time() - STALE_TEMP_AGE
+        with os.scandir(self.directory) as found:
+            for entry in found:
+                try:
+                    stat = entry.stat()
+                    if entry.name.startswith('.'):
+                        # partial copies don't count, those no process writes to anymore are removed
+                        if entry.name.endswith('.tmp') and stat.st_mtime < stale:
+                            os.unlink(entry.path)
+                        continue
+                except FileNotFoundError:
+                    # evicted or renamed by another process
+                    continue
+                files.append((stat.st_atime_ns, entry.path, stat.st_size))
+        files.sort()
+        self._entries = OrderedDict((path, size) for atime, path, size in files)
+        self.size = sum(self._entries.values())
+        self.written = 0
+        self._evict()
+
+    def _evict(self):
+        # called with the lock held, the newest copy stays even when it is bigger than the cache
+        while self.size > self.max_size and len(self._entries) > 1:
+            path, size = self._entries.popitem(last=False)
+            self.size -= size
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                # evicted by another process
+                pass
@@ -1,5 +1,26 @@
 from django import forms
+from PIL import Image as PILImage
+
+
+class MultipleFileInput(forms.ClearableFileInput):
+    # let users pick several images at once (see views.save_bulk_upload())
+    allow_multiple_selected = True
+
+
+class SniffedImageField(forms.ImageField):
+    """ImageField that uses the format read by the upload handler instead of decoding the file again"""
+
+    def to_python(self, data):
+        info = getattr(data, 'image_info', None)
+        if info is None:
+            # files that didn't go through uploadhandlers.InspectingMixin
+            return super().to_python(data)
+        # the checks of FileField (empty files, names), not the Pillow pass of ImageField
+        file = forms.FileField.to_python(self, data)
+        if file is not None:
+            file.content_type = PILImage.MIME.get(info.format)
+        return file
 
 
 class ImageForm(forms.Form):
-    image = forms.ImageField()
+    image = SniffedImageField(widget=MultipleFileInput(attrs={'multiple': True}))
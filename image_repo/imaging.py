@@ -0,0 +1,99 @@
+"""Pillow helpers for analysis copies and derivatives (the stored original is never changed)"""
+from collections import namedtuple
+from io import BytesIO
+import os
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from PIL import Image as PILImage, ImageOps
+
+# EXIF tag holding the camera orientation
+EXIF_ORIENTATION = 0x0112
+
+# format and dimensions of an image read from its header (see sniff_image())
+ImageInfo = namedtuple('ImageInfo', ['format', 'width', 'height'])
+
+
+def sniff_image(header):
+    """Return the ImageInfo of the first bytes of an image file, None if they aren't (enough of) an image"""
+    try:
+        # opening only parses the header, the pixels are not decoded
+        with PILImage.open(BytesIO(header)) as img:
+            return ImageInfo(img.format, img.width, img.height)
+    except PILImage.DecompressionBombError:
+        raise
+    except Exception:
+        return None
+
+
+def prepare_for_analysis(data):
+    """Return a bounded-size copy of the image (bytes or a file) for the analyzer"""
+    max_side = settings.IMAGE_REPO_ANALYSIS_MAX_SIDE
+    # files are decoded as they are read, big ones are never held in memory whole
+    file = BytesIO(data) if isinstance(data, bytes) else data
+    size = len(data) if isinstance(data, bytes) else file.size
+    with PILImage.open(file) as img:
+        # small images in a format the analyzer accepts are sent as they are
+        if (size <= settings.IMAGE_REPO_ANALYSIS_MAX_BYTES and max(img.size) <= max_side
+                and img.format in ('JPEG', 'PNG', 'GIF', 'BMP')):
+            if isinstance(data, bytes):
+                return data
+            file.seek(0)
+            return file.read()
+        # let the JPEG decoder scale down while decoding instead of decoding the full image
+        img.draft('RGB', (max_side, max_side))
+        img.thumbnail((max_side, max_side), reducing_gap=2.0)
+        img = flatten(img)
+        output = BytesIO()
+        img.save(output, settings.IMAGE_REPO_ANALYSIS_FORMAT, quality=settings.IMAGE_REPO_ANALYSIS_QUALITY)
+        return output.getvalue()
+
+
+def flatten(img):
+    """Convert the image to RGB, putting transparent parts on a white background"""
+    if img.mode in ('RGBA', 'LA', 'PA') or (img.mode == 'P' and 'transparency' in img.info):
+        img = img.convert('RGBA')
+        background = PILImage.new('RGB', img.size, 'white')
+        background.paste(img, mask=img.getchannel('A'))
+        return background
+    return img.convert('RGB') if img.mode != 'RGB' else img
+
+
+def decode(file):
+    """
+    Return the image file decoded upright in RGB and the widths of its derivatives, widest first.
+
+    The JPEG decoder scales down to the widest derivative while decoding.
+    """
+    with PILImage.open(file) as img:
+        width, height = img.size
+        # browsers rotate the original using EXIF, the copies are saved already rotated
+        if img.getexif().get(EXIF_ORIENTATION) in (5, 6, 7, 8):
+            width, height = height, width
+        widths = sorted((w for w in settings.IMAGE_REPO_DERIVATIVE_WIDTHS if w < width), reverse=True)
+        # images narrower than all widths get one copy in the derivative format
+        widths = widths or [width]
+        img.draft('RGB', (widths[0], widths[0]))
+        return flatten(ImageOps.exif_transpose(img)), widths
+
+
+def make_derivatives(img, widths):
+    """Yield (width, copy) of the decoded image (see decode()) downscaled to every width"""
+    # every copy is made from the previous (bigger) one, not from the original
+    for width in widths:
+        img = img.resize((width, max(1, round(img.height * width / img.width))), PILImage.LANCZOS,
+                         reducing_gap=3.0)
+        yield width, img
+
+
+def save_derivatives(image, img, widths):
+    """Store derivatives of the decoded image next to the original in image.derivatives, return the smallest"""
+    root = os.path.splitext(image.image.name)[0]
+    extension = settings.IMAGE_REPO_DERIVATIVE_FORMAT.lower()
+    storage = image.image.storage
+    image.derivatives = {}
+    for width, copy in make_derivatives(img, widths):
+        output = BytesIO()
+        copy.save(output, settings.IMAGE_REPO_DERIVATIVE_FORMAT, quality=settings.IMAGE_REPO_DERIVATIVE_QUALITY)
+        image.derivatives[str(width)] = storage.save(f'{root}_{width}w.{extension}', ContentFile(output.getvalue()))
+    return copy
@@ -0,0 +1,58 @@
+"""
+In-process indexes of the users' images (duplicates.py, palettes.py).
+
+An index is built from the database the first time it is needed and kept
+while the user's list version (see pagecache.py) stays the same, so uploads
+change the cached index instead of rebuilding it.
+"""
+from collections import OrderedDict
+import threading
+
+from django.conf import settings
+
+from . import pagecache
+
+
+class UserIndexes:
+    """
+    In-process LRU of per-user indexes built from the database, rebuilt when the
+    user's images changed (their version) unless the change was applied to them.
+    """
+
+    def __init__(self, build, max_users_setting):
+        # build(user_id) returns the index of the user's current images
+        self.build = build
+        self.max_users_setting = max_users_setting
+        # held while an index is read or changed
+        self.lock = threading.Lock()
+        # user id: (version, index), least recently used first
+        self._entries = OrderedDict()
+
+    def get(self, user_id, version=None):
+        """Return the index of the user's images, rebuilt when they changed (the version, read if not given)"""
+        version = version or pagecache.get_version(user_id)
+        with self.lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[0] == version:
+                self._entries.move_to_end(user_id)
+                return entry[1]
+        index = self.build(user_id)
+        with self.lock:
+            self._entries[user_id] = (version, index)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > getattr(settings, self.max_users_setting):
+                self._entries.popitem(last=False)
+        return index
+
+    def update(self, user_id, version, change, new_version=None):
+        """
+        Call change(index) if the user's index was built at `version`, the version
+        before the saved change, and mark it built at `new_version`, the one the
+        change set (read if not given).
+        """
+        new_version = new_version or pagecache.get_version(user_id)
+        with self.lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[0] == version:
+                change(entry[1])
+                self._entries[user_id] = (new_version, entry[1])
@@ -0,0 +1,307 @@
+"""
+Background analysis queue.
+
+Uploads are saved right away with a pending analysis state, and the worker
+started by `manage.py analyze_images` fills in description, tags and colors.
+The Image table itself is the queue: rows are claimed with SELECT ... FOR UPDATE
+SKIP LOCKED so several workers can run side by side.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import timedelta
+import hashlib
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from . import pagecache
+from .analysis import analysis_cache, azure_circuit, get_analyzer, get_async_analyzer
+from .imaging import prepare_for_analysis
+from .models import Image
+from .resilience import CircuitOpenError
+from .search import index_image
+
+
+def claim_images(limit):
+    """Mark up to `limit` pending images as processing and return them"""
+    # images stuck in processing belong to a worker that was killed
+    stale = timezone.now() - timedelta(seconds=settings.IMAGE_REPO_ANALYSIS_TIMEOUT)
+    with transaction.atomic():
+        ids = list(Image.objects.select_for_update(skip_locked=True)
+                   .filter(Q(analysis_status=Image.PENDING) |
+                           Q(analysis_status=Image.PROCESSING, analysis_started__lt=stale))
+                   .order_by('id').values_list('id', flat=True)[:limit])
+        Image.objects.filter(id__in=ids).update(analysis_status=Image.PROCESSING,
+                                                analysis_attempts=F('analysis_attempts') + 1,
+                                                analysis_started=timezone.now())
+    return list(Image.objects.filter(id__in=ids).order_by('id'))
+
+
+def read_for_analysis(image):
+    """Read the stored image and return the bytes sent to the analyzer (no database access)"""
+    with image.image.open('rb') as file:
+        # images uploaded before hashing was added get their hash here
+        if not image.content_hash:
+            hasher = hashlib.sha256()
+            for chunk in file.chunks():
+                hasher.update(chunk)
+            image.content_hash = hasher.hexdigest()
+            file.seek(0)
+        # the analyzer gets a downscaled copy, so big images are analyzed too
+        # (the storage file knows its size, the FieldFile would ask the storage)
+        return prepare_for_analysis(file.file)
+
+
+def analyze_image(image, analyzer):
+    """Read the stored image and run the analyzer on it (runs in a worker thread)"""
+    return analyzer(read_for_analysis(image))
+
+
+def update_image(image, fields):
+    """Save the fields of a claimed image, return False if the image was deleted in the meantime"""
+    # Image.save(update_fields=...) raises when the row is gone, and a deleted
+    # image must not stop the worker or leave the rest of its batch processing
+    if not Image.objects.filter(pk=image.pk).update(**{field: getattr(image, field) for field in fields}):
+        return False
+    # update() sends no post_save, the cached pages are invalidated here
+    pagecache.bump_version(image.user_id)
+    return True
+
+
+def save_result(image, result):
+    """Store the analyzer result, or put the image back in the queue if it failed"""
+    if result is not None:
+        image.set_analysis(result)
+    elif image.analysis_attempts >= settings.IMAGE_REPO_ANALYSIS_MAX_ATTEMPTS:
+        image.analysis_status = Image.FAILED
+    else:
+        image.analysis_status = Image.PENDING
+    if update_image(image, ['description', 'tags', 'colors', 'analysis_status', 'content_hash']) and \
+            result is not None:
+        index_image(image)
+
+
+def release_images(images):
+    """Put claimed images back in the queue without counting the attempt, the analyzer wasn't called"""
+    Image.objects.filter(id__in=[image.id for image in images]).update(
+        analysis_status=Image.PENDING, analysis_attempts=F('analysis_attempts') - 1)
+
+
+def group_images(images):
+    """Save the images with cached results and return the rest grouped by content"""
+    # images with cached results are done right away, images
+    # with the same content are analyzed only once
+    groups = {}
+    for image in images:
+        result = analysis_cache.get(image.content_hash)
+        if result is not None:
+            save_result(image, result)
+        else:
+            groups.setdefault(image.content_hash or image.pk, []).append(image)
+    return list(groups.values())
+
+
+def save_group_result(group, result):
+    """Cache the result of a group of images with the same content and save it for all of them"""
+    if result is not None:
+        analysis_cache.set(group[0].content_hash, result)
+    for image in group:
+        save_result(image, result)
+
+
+def process_images(images, pool, analyzer=None):
+    """Analyze claimed images concurrently on the pool, saving results as they arrive, return how many were analyzed"""
+    analyzer = analyzer or get_analyzer()
+    refused = 0
+    futures = {pool.submit(analyze_image, group[0], analyzer): group for group in group_images(images)}
+    # database writes stay in the calling thread, only storage reads
+    # and analyzer calls run in the pool
+    for future in as_completed(futures):
+        try:
+            result = future.result()
+        except CircuitOpenError:
+            release_images(futures[future])
+            refused += len(futures[future])
+            continue
+        except Exception as e:
+            print(e)
+            result = None
+        save_group_result(futures[future], result)
+    return len(images) - refused
+
+
+def process_batch(images, pool, analyzer=None):
+    """Analyze claimed images with one analyze_batch() call of the analyzer (reads run on the pool), return how many"""
+    analyzer = analyzer or get_analyzer()
+    refused = []
+    groups = group_images(images)
+
+    def read(group):
+        try:
+            return read_for_analysis(group[0])
+        except Exception as e:
+            print(e)
+            return None
+
+    data = list(pool.map(read, groups))
+    readable = [(group, img) for group, img in zip(groups, data) if img is not None]
+    try:
+        results = analyzer.analyze_batch([img for group, img in readable])
+    except CircuitOpenError as e:
+        # the analyzer refused the whole batch
+        results = [e] * len(readable)
+    except Exception as e:
+        print(e)
+        results = [None] * len(readable)
+    for (group, img), result in zip(readable, results):
+        if isinstance(result, CircuitOpenError):
+            # only the refused images go back to the queue, the results paid for are kept
+            refused.extend(group)
+        else:
+            save_group_result(group, result)
+    if refused:
+        release_images(refused)
+    for group, img in zip(groups, data):
+        if img is None:
+            save_group_result(group, None)
+    return len(images) - len(refused)
+
+
+def run_worker(workers=None, batch_size=None, once=False, poll_interval=None, analyzer=None, batch=None):
+    """Process the queue until it is empty (once=True) or forever, return the number of processed images"""
+    workers = workers or settings.IMAGE_REPO_ANALYSIS_WORKERS
+    batch_size = batch_size or workers * 2
+    poll_interval = settings.IMAGE_REPO_ANALYSIS_POLL_INTERVAL if poll_interval is None else poll_interval
+    analyzer = analyzer or get_analyzer()
+    batch = settings.IMAGE_REPO_ANALYSIS_BATCH if batch is None else batch
+    # plain analyzer functions have no batch mode
+    process = process_batch if batch and hasattr(analyzer, 'analyze_batch') else process_images
+    processed = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while True:
+            # while Azure is failing the images wait in the queue
+            time.sleep(azure_circuit.retry_after())
+            images = claim_images(batch_size)
+            if images:
+                done = process(images, pool, analyzer)
+                processed += done
+                if not done:
+                    # all images were refused, the analyzer's backend is failing
+                    if once:
+                        return processed
+                    time.sleep(poll_interval)
+            elif once:
+                return processed
+            else:
+                time.sleep(poll_interval)
+
+
+def reanalysis_candidates(older_than=None):
+    """Return the images whose analysis failed or came back empty, and those analyzed before `older_than`"""
+    query = Q(analysis_status=Image.FAILED) | Q(analysis_status=Image.DONE, description='')
+    if older_than is not None:
+        # images analyzed before the queue existed have no analysis_started
+        query |= Q(analysis_status=Image.DONE) & (Q(analysis_started__lt=older_than) |
+                                                   Q(analysis_started__isnull=True))
+    return Image.objects.filter(query)
+
+
+def save_reanalysis(image, result):
+    """Store a new analyzer result of the image, return whether there was one"""
+    if result is None:
+        # a failed image stays failed, an outdated one keeps its old result
+        update_image(image, ['content_hash'])
+        return False
+    image.set_analysis(result)
+    image.analysis_started = timezone.now()
+    if not update_image(image, ['description', 'tags', 'colors', 'analysis_status', 'analysis_started',
+                                'content_hash']):
+        return False
+    index_image(image)
+    # later uploads of the same content get the new result too
+    analysis_cache.set(image.content_hash, result)
+    return True
+
+
+def reanalyze_images(images, pool, analyzer=None):
+    """Analyze the images again on the pool without the analysis cache, return the new results and refused images"""
+    analyzer = analyzer or get_analyzer()
+    futures = {pool.submit(analyze_image, image, analyzer): image for image in images}
+    succeeded = 0
+    refused = []
+    for future in as_completed(futures):
+        try:
+            result = future.result()
+        except CircuitOpenError:
+            refused.append(futures[future])
+            continue
+        except Exception as e:
+            print(e)
+            result = None
+        succeeded += save_reanalysis(futures[future], result)
+    return succeeded, refused
+
+
+def save_group_results(results):
+    """Save the (group, result) pairs of a batch"""
+    for group, result in results:
+        save_group_result(group, result)
+
+
+async def process_images_async(images, semaphore, analyzer):
+    """Analyze claimed images concurrently on the event loop, at most `semaphore` at a time"""
+    refused = []
+
+    async def analyze_group(group):
+        async with semaphore:
+            try:
+                # storage reads and resizing block, they run in threads
+                data = await sync_to_async(read_for_analysis, thread_sensitive=False)(group[0])
+                return group, await analyzer(data)
+            except CircuitOpenError:
+                refused.extend(group)
+                return None
+            except Exception as e:
+                print(e)
+                return group, None
+
+    groups = await sync_to_async(group_images)(images)
+    results = await asyncio.gather(*(analyze_group(group) for group in groups))
+    # the database is only used from the worker coroutine, not from the gathered tasks
+    await sync_to_async(save_group_results)([result for result in results if result is not None])
+    if refused:
+        await sync_to_async(release_images)(refused)
+    return len(images) - len(refused)
+
+
+async def run_async_worker(concurrency=None, batch_size=None, once=False, poll_interval=None, analyzer=None):
+    """
+    Like run_worker(), but with a non-blocking analyzer (settings.IMAGE_REPO_ASYNC_ANALYZER).
+
+    Hundreds of analysis calls can wait on a slow endpoint in one process without a thread each.
+    """
+    concurrency = concurrency or settings.IMAGE_REPO_ANALYSIS_ASYNC_CONCURRENCY
+    batch_size = batch_size or concurrency * 2
+    poll_interval = settings.IMAGE_REPO_ANALYSIS_POLL_INTERVAL if poll_interval is None else poll_interval
+    analyzer = analyzer or get_async_analyzer()
+    semaphore = asyncio.Semaphore(concurrency)
+    processed = 0
+    while True:
+        await asyncio.sleep(azure_circuit.retry_after())
+        images = await sync_to_async(claim_images)(batch_size)
+        if images:
+            done = await process_images_async(images, semaphore, analyzer)
+            processed += done
+            if not done:
+                # all images were refused, the analyzer's backend is failing
+                if once:
+                    return processed
+                await asyncio.sleep(poll_interval)
+        elif once:
+            return processed
+        else:
+            await asyncio.sleep(poll_interval)
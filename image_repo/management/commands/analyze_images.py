@@ -0,0 +1,39 @@
+from asgiref.sync import async_to_sync
+from django.core.management.base import BaseCommand
+from django.utils.module_loading import import_string
+
+from image_repo import metrics
+from image_repo.jobs import run_async_worker, run_worker
+
+
+class Command(BaseCommand):
+    help = 'Run the background worker that analyzes pending images'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, help='number of images analyzed concurrently')
+        parser.add_argument('--async', action='store_true', dest='use_async',
+                            help='analyze with the non-blocking client on an event loop instead of threads')
+        parser.add_argument('--concurrency', type=int, help='number of images analyzed concurrently with --async')
+        parser.add_argument('--batch-size', type=int, help='number of images claimed from the queue at once')
+        parser.add_argument('--poll-interval', type=float, help='seconds to wait when the queue is empty')
+        parser.add_argument('--once', action='store_true', help='exit when the queue is empty')
+        parser.add_argument('--batch', action='store_true', default=None,
+                            help='analyze the claimed images with one batch call (Analyzer classes only)')
+        parser.add_argument('--analyzer', help='dotted path to an analyzer, overrides settings.IMAGE_REPO_ANALYZER '
+                                               '(IMAGE_REPO_ASYNC_ANALYZER with --async)')
+
+    def handle(self, *args, **options):
+        analyzer = import_string(options['analyzer']) if options['analyzer'] else None
+        if options['use_async']:
+            processed = async_to_sync(run_async_worker)(
+                concurrency=options['concurrency'], batch_size=options['batch_size'], once=options['once'],
+                poll_interval=options['poll_interval'], analyzer=analyzer)
+        else:
+            processed = run_worker(workers=options['workers'], batch_size=options['batch_size'],
+                                   once=options['once'], poll_interval=options['poll_interval'],
+                                   analyzer=analyzer, batch=options['batch'])
+        self.stdout.write(f'Analyzed {processed} images.')
+        counters = metrics.counters()
+        self.stdout.write('Analysis cache: {} memory hits, {} database hits, {} misses.'.format(
+            counters.get('analysis_cache_memory_hits', 0), counters.get('analysis_cache_db_hits', 0),
+            counters.get('analysis_cache_misses', 0)))
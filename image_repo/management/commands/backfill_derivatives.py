@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+
+from image_repo.imaging import decode, save_derivatives
+from image_repo.models import Image
+
+
+class Command(BaseCommand):
+    help = 'Create the srcset derivatives of images uploaded before they existed'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100, help='number of images loaded at once')
+
+    def handle(self, *args, **options):
+        # every image is saved as soon as its derivatives are stored,
+        # so a stopped run resumes with the images that are left
+        last_id = 0
+        done = failed = 0
+        while True:
+            images = list(Image.objects.filter(derivatives={}, id__gt=last_id)
+                          .order_by('id')[:options['batch_size']])
+            if not images:
+                break
+            for image in images:
+                last_id = image.id
+                try:
+                    with image.image.open('rb') as file:
+                        save_derivatives(image, *decode(file))
+                    image.save(update_fields=['derivatives'])
+                    done += 1
+                except Exception as e:
+                    self.stderr.write(f'{image}: {e}')
+                    failed += 1
+        self.stdout.write(f'Created derivatives of {done} images, {failed} failed.')
@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand
+
+from image_repo import pagecache
+from image_repo.duplicates import perceptual_hash
+from image_repo.models import Image
+
+
+class Command(BaseCommand):
+    help = 'Compute the perceptual hashes of images uploaded before they existed'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100, help='number of images loaded at once')
+
+    def handle(self, *args, **options):
+        # every batch is saved as soon as its hashes are computed,
+        # so a stopped run resumes with the images that are left
+        last_id = 0
+        done = failed = 0
+        while True:
+            images = list(Image.objects.filter(phash__isnull=True, id__gt=last_id)
+                          .order_by('id')[:options['batch_size']])
+            if not images:
+                break
+            hashed = []
+            for image in images:
+                last_id = image.id
+                try:
+                    with image.image.open('rb') as file:
+                        image.phash = perceptual_hash(file)
+                    hashed.append(image)
+                    done += 1
+                except Exception as e:
+                    self.stderr.write(f'{image}: {e}')
+                    failed += 1
+            Image.objects.bulk_update(hashed, ['phash'])
+            # bulk_update() doesn't send post_save, the hash indexes are rebuilt on the next lookup
+            for user_id in {image.user_id for image in hashed}:
+                pagecache.bump_version(user_id)
+        self.stdout.write(f'Computed perceptual hashes of {done} images, {failed} failed.')
@@ -0,0 +1,19 @@
+from importlib import import_module
+
+from django.core.management.base import BaseCommand
+
+from image_repo.benchmarks import BENCHMARKS
+
+
+class Command(BaseCommand):
+    help = 'Run one of the image_repo benchmarks'
+
+    def add_arguments(self, parser):
+        subparsers = parser.add_subparsers(dest='benchmark', required=True)
+        for name in BENCHMARKS:
+            module = import_module(f'image_repo.benchmarks.{name}')
+            module.add_arguments(subparsers.add_parser(name, help=module.__doc__))
+
+    def handle(self, *args, **options):
+        module = import_module(f"image_repo.benchmarks.{options.pop('benchmark')}")
+        module.run(self, **options)
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from image_repo.export import run_export_worker
+
+
+class Command(BaseCommand):
+    help = 'Run the background worker that builds the ZIP exports users asked for'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--poll-interval', type=float, help='seconds to wait when no export is queued')
+        parser.add_argument('--once', action='store_true', help='exit when no export is queued')
+
+    def handle(self, *args, **options):
+        built = run_export_worker(once=options['once'], poll_interval=options['poll_interval'])
+        self.stdout.write(f'Built {built} exports.')
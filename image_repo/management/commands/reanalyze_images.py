@@ -0,0 +1,92 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import json
+import os
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from django.utils.module_loading import import_string
+
+from image_repo.analysis import azure_circuit
+from image_repo.jobs import reanalysis_candidates, reanalyze_images
+
+
+def parse_older_than(value):
+    """Return the aware datetime of an --older-than date or datetime"""
+    moment = parse_datetime(value)
+    if moment is None:
+        date = parse_date(value)
+        if date is None:
+            raise CommandError(f'Invalid date: {value}')
+        moment = datetime.combine(date, datetime.min.time())
+    return timezone.make_aware(moment) if timezone.is_naive(moment) else moment
+
+
+class Command(BaseCommand):
+    help = 'Analyze failed, empty or outdated images again, resuming where a stopped run left off'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, help='number of images analyzed concurrently (threads)')
+        parser.add_argument('--batch-size', type=int, help='number of images loaded and checkpointed at once')
+        parser.add_argument('--older-than', help='also analyze images analyzed before this date (YYYY-MM-DD[ HH:MM])')
+        parser.add_argument('--checkpoint', default='reanalyze_images.json',
+                            help='file recording the progress of the run')
+        parser.add_argument('--restart', action='store_true', help='ignore the checkpoint of a previous run')
+        parser.add_argument('--analyzer', help='dotted path to an analyzer, overrides settings.IMAGE_REPO_ANALYZER')
+
+    def handle(self, *args, **options):
+        workers = options['workers'] or settings.IMAGE_REPO_ANALYSIS_WORKERS
+        batch_size = options['batch_size'] or workers * 4
+        older_than = parse_older_than(options['older_than']) if options['older_than'] else None
+        analyzer = import_string(options['analyzer']) if options['analyzer'] else None
+        checkpoint = self.load_checkpoint(options['checkpoint'], options['older_than'], options['restart'])
+        candidates = reanalysis_candidates(older_than)
+        start = time.perf_counter()
+        processed = 0
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            while True:
+                # keyset over the ids, a resumed run skips everything before the checkpoint
+                images = list(candidates.filter(id__gt=checkpoint['last_id']).order_by('id')[:batch_size])
+                if not images:
+                    break
+                succeeded, refused = reanalyze_images(images, pool, analyzer)
+                checkpoint['succeeded'] += succeeded
+                checkpoint['processed'] += len(images) - len(refused)
+                # the batch is saved, a run stopped from here on doesn't analyze it again;
+                # images refused while Azure was failing are tried again (the others are no
+                # longer candidates)
+                checkpoint['last_id'] = min(image.id for image in refused) - 1 if refused else images[-1].id
+                self.save_checkpoint(options['checkpoint'], checkpoint)
+                processed += len(images) - len(refused)
+                if refused:
+                    self.stdout.write(f'Azure is failing, waiting {azure_circuit.retry_after():.0f} s.')
+                    time.sleep(azure_circuit.retry_after())
+                self.stdout.write(f"{checkpoint['processed']} images, {checkpoint['succeeded']} analyzed, "
+                                  f'{processed / (time.perf_counter() - start):.1f} images/s')
+        # the run is complete, the next one starts from the beginning
+        if os.path.exists(options['checkpoint']):
+            os.remove(options['checkpoint'])
+        elapsed = time.perf_counter() - start
+        self.stdout.write(f"Analyzed {checkpoint['succeeded']} of {checkpoint['processed']} images again, "
+                          f"{checkpoint['processed'] - checkpoint['succeeded']} failed "
+                          f'({processed / elapsed if elapsed else 0:.1f} images/s in this run).')
+
+    def load_checkpoint(self, path, criteria, restart):
+        """Return the progress of a previous run with the same criteria, or of a new one"""
+        if not restart and os.path.exists(path):
+            with open(path) as file:
+                checkpoint = json.load(file)
+            if checkpoint.get('older_than') == criteria:
+                self.stdout.write(f"Resuming after image {checkpoint['last_id']}.")
+                return checkpoint
+            self.stdout.write('The checkpoint is of a run with other options, starting over.')
+        return {'older_than': criteria, 'last_id': 0, 'processed': 0, 'succeeded': 0}
+
+    def save_checkpoint(self, path, checkpoint):
+        # written next to the checkpoint and renamed, so a kill never leaves half a file
+        with open(f'{path}.tmp', 'w') as file:
+            json.dump(checkpoint, file)
+        os.replace(f'{path}.tmp', path)
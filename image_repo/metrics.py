@@ -0,0 +1,127 @@
+"""
+Process-wide counters and timing histograms for the image_repo internals.
+
+Code wrapped in timed(phase) (database queries, Azure calls, storage writes,
+URL signing, rendering) is recorded in a histogram, and added to the phase
+totals of the current request when timing.TimingMiddleware is collecting them.
+Everything is served in Prometheus text format by views.metrics_view().
+"""
+import bisect
+from collections import Counter
+from contextlib import contextmanager
+import contextvars
+import threading
+import time
+
+# upper bounds in seconds of the histogram buckets
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_counters = Counter()
+# (name, labels) -> observations per bucket (the last one is +Inf) followed by their sum
+_histograms = {}
+_lock = threading.Lock()
+# {phase: [seconds, calls]} of the current request (see start_request())
+_request_timings = contextvars.ContextVar('image_repo_request_timings', default=None)
+
+
+def incr(name, value=1):
+    """Increase the counter `name` by `value`"""
+    with _lock:
+        _counters[name] += value
+
+
+def counters():
+    """Return a snapshot of all counters"""
+    with _lock:
+        return dict(_counters)
+
+
+def ratio(hits, misses):
+    """Return the share of the `hits` counter in hits + misses, None before the first event"""
+    with _lock:
+        total = _counters[hits] + _counters[misses]
+        return _counters[hits] / total if total else None
+
+
+def observe(name, value, **labels):
+    """Record `value` in the histogram `name` with the given labels"""
+    key = (name, tuple(sorted(labels.items())))
+    index = bisect.bisect_left(BUCKETS, value)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [0] * (len(BUCKETS) + 1) + [0.0]
+        histogram[index] += 1
+        histogram[-1] += value
+
+
+def histograms():
+    """Return a snapshot of all histograms"""
+    with _lock:
+        return {key: list(histogram) for key, histogram in _histograms.items()}
+
+
+def start_request():
+    """Collect the phase timings of the current request, return them"""
+    # sync_to_async() runs its function in a copy of the context, which holds this same
+    # dict, so those phases are added; threads of other pools only feed the histograms
+    timings = {}
+    return timings, _request_timings.set(timings)
+
+
+def end_request(token):
+    _request_timings.reset(token)
+
+
+def add_time(phase, seconds):
+    """Record `seconds` spent in `phase`"""
+    observe('image_repo_phase_seconds', seconds, phase=phase)
+    timings = _request_timings.get()
+    if timings is not None:
+        with _lock:
+            total = timings.setdefault(phase, [0.0, 0])
+            total[0] += seconds
+            total[1] += 1
+
+
+@contextmanager
+def timed(phase):
+    """Record the time spent in the with block in `phase`"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_time(phase, time.perf_counter() - start)
+
+
+def time_query(execute, sql, params, many, context):
+    """Database execute wrapper recording the queries in the 'db' phase (see apps.ImageRepoConfig.ready())"""
+    with timed('db'):
+        return execute(sql, params, many, context)
+
+
+def format_labels(labels):
+    return ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                    for name, value in labels)
+
+
+def prometheus_text():
+    """Return the counters and histograms of this process in Prometheus text format"""
+    lines = []
+    for name, value in sorted(counters().items()):
+        lines.append(f'# TYPE image_repo_{name}_total counter')
+        lines.append(f'image_repo_{name}_total {value}')
+    snapshot = histograms()
+    for name in sorted({name for name, labels in snapshot}):
+        lines.append(f'# TYPE {name} histogram')
+        for (histogram_name, labels), histogram in sorted(snapshot.items()):
+            if histogram_name != name:
+                continue
+            # Prometheus buckets count all observations up to their bound
+            count = 0
+            for bound, observations in zip(BUCKETS + ('+Inf',), histogram):
+                count += observations
+                lines.append(f'{name}_bucket{{{format_labels(labels + (("le", bound),))}}} {count}')
+            lines.append(f'{name}_sum{{{format_labels(labels)}}} {histogram[-1]}')
+            lines.append(f'{name}_count{{{format_labels(labels)}}} {count}')
+    return '\n'.join(lines) + '\n'
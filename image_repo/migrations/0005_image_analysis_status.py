@@ -0,0 +1,36 @@
+# Generated by Django 3.2 on 2026-10-17 00:19
+
+from django.db import migrations, models
+
+
+def mark_analyzed_images(apps, schema_editor):
+    # images uploaded before the queue existed were analyzed in the request,
+    # only the ones without a description are left for the worker
+    Image = apps.get_model('image_repo', 'Image')
+    Image.objects.exclude(description='').update(analysis_status='done')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('image_repo', '0004_remove_image_result'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='analysis_attempts',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='analysis_started',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='analysis_status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('processing', 'Processing'), ('done', 'Done'), ('failed', 'Failed')], db_index=True, default='pending', max_length=10),
+        ),
+        migrations.RunPython(mark_analyzed_images, migrations.RunPython.noop),
+    ]
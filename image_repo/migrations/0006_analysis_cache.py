@@ -0,0 +1,28 @@
+# Generated by Django 3.2 on 2026-10-17 00:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('image_repo', '0005_image_analysis_status'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AnalysisResult',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('content_hash', models.CharField(max_length=64, unique=True)),
+                ('description', models.CharField(blank=True, default='', max_length=200)),
+                ('tags', models.CharField(blank=True, default='', max_length=250)),
+                ('colors', models.CharField(blank=True, default='', max_length=50)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='content_hash',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=64),
+        ),
+    ]
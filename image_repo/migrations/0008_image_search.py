@@ -0,0 +1,63 @@
+# Generated by Django 3.2 on 2026-10-17 00:27
+
+from django.conf import settings
+import django.contrib.postgres.search
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def create_search_index(apps, schema_editor):
+    # GIN indexes are Postgres only, tests on SQLite search without it
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute('CREATE INDEX image_search_vector_gin ON image_repo_image USING gin (search_vector)')
+
+
+def index_images(apps, schema_editor):
+    # same as search.index_image() for the images analyzed so far
+    Image = apps.get_model('image_repo', 'Image')
+    ImageLabel = apps.get_model('image_repo', 'ImageLabel')
+    for image in Image.objects.exclude(description='').iterator():
+        tags = dict.fromkeys(tag.lower() for tag in image.tags.replace('#', ' ').split())
+        colors = dict.fromkeys(color.lower() for color in image.colors.split())
+        ImageLabel.objects.bulk_create(
+            [ImageLabel(image=image, user_id=image.user_id, kind='tag', value=tag[:50]) for tag in tags] +
+            [ImageLabel(image=image, user_id=image.user_id, kind='color', value=color[:50]) for color in colors])
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute("UPDATE image_repo_image SET search_vector = to_tsvector('english', description)")
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute('DROP INDEX IF EXISTS image_search_vector_gin')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('image_repo', '0007_image_derivatives'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(blank=True, editable=False, null=True),
+        ),
+        migrations.CreateModel(
+            name='ImageLabel',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('tag', 'Tag'), ('color', 'Color')], max_length=5)),
+                ('value', models.CharField(max_length=50)),
+                ('image', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='labels', to='image_repo.image')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='imagelabel',
+            index=models.Index(fields=['user', 'kind', 'value', 'image'], name='image_label_search_idx'),
+        ),
+        migrations.RunPython(create_search_index, drop_search_index),
+        migrations.RunPython(index_images, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 3.2 on 2026-10-17 00:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('image_repo', '0008_image_search'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='image',
+            index=models.Index(fields=['user', '-id'], name='image_user_id_desc_idx'),
+        ),
+    ]
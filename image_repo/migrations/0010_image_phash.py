@@ -0,0 +1,24 @@
+# Generated by Django 3.2 on 2026-10-17 01:02
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('image_repo', '0009_image_user_id_desc_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='duplicate_of',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='duplicates', to='image_repo.image'),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='phash',
+            field=models.BigIntegerField(blank=True, editable=False, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2 on 2026-10-17 01:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('image_repo', '0010_image_phash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='palette',
+            field=models.JSONField(blank=True, editable=False, null=True),
+        ),
+    ]
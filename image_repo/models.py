@@ -1,4 +1,5 @@
 from django.contrib.auth.models import User
+from django.contrib.postgres.search import SearchVectorField
 from django.db import models
 
 
@@ -8,6 +9,18 @@ def save_image(instance, filename):
 
 
 class Image(models.Model):
+    # analysis states of the image
+    PENDING = 'pending'
+    PROCESSING = 'processing'
+    DONE = 'done'
+    FAILED = 'failed'
+    ANALYSIS_STATUSES = [
+        (PENDING, 'Pending'),
+        (PROCESSING, 'Processing'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    ]
+
     image = models.ImageField(upload_to=save_image)
     # image description extracted from the result
     description = models.CharField(max_length=200, blank=True, default='')
@@ -17,7 +30,111 @@ class Image(models.Model):
     colors = models.CharField(max_length=50, blank=True, default='')
     # the associated user
     user = models.ForeignKey(User, on_delete=models.CASCADE)
+    # state of the background analysis job (see jobs.py)
+    analysis_status = models.CharField(max_length=10, choices=ANALYSIS_STATUSES, default=PENDING, db_index=True)
+    # number of times a worker picked the image up
+    analysis_attempts = models.PositiveSmallIntegerField(default=0)
+    # when a worker last picked the image up, used to recover jobs of killed workers
+    analysis_started = models.DateTimeField(null=True, blank=True)
+    # SHA-256 of the image bytes, key of the analysis cache
+    content_hash = models.CharField(max_length=64, blank=True, default='', db_index=True)
+    # storage names of the downscaled copies by width (see imaging.save_derivatives())
+    derivatives = models.JSONField(blank=True, default=dict)
+    # full-text search vector of the description, Postgres only (see search.py)
+    search_vector = SearchVectorField(null=True, blank=True, editable=False)
+    # 64-bit perceptual hash, close for resized or recompressed copies (see duplicates.py)
+    phash = models.BigIntegerField(null=True, blank=True, editable=False)
+    # share of every color of colors.COLOR_NAMES in the image, compared by color similarity (see palettes.py)
+    palette = models.JSONField(null=True, blank=True, editable=False)
+    # an earlier image of the user this one is a near-duplicate of
+    duplicate_of = models.ForeignKey('self', null=True, blank=True, on_delete=models.SET_NULL,
+                                     related_name='duplicates')
+
+    class Meta:
+        indexes = [
+            # a user's library newest first, used for keyset pagination (see views.get_page())
+            models.Index(fields=['user', '-id'], name='image_user_id_desc_idx'),
+        ]
 
     def __str__(self):
         # display image paths in admin
         return self.image.name
+
+    def set_analysis(self, result):
+        """Fill in an analyzer result (see analysis.azure_cv_api())"""
+        self.description = result['description'].capitalize()
+        self.tags = result['tags']
+        self.colors = result['colors']
+        self.analysis_status = self.DONE
+
+    @property
+    def analysis_pending(self):
+        return self.analysis_status in (self.PENDING, self.PROCESSING)
+
+    def srcset(self):
+        """Return the srcset attribute value listing all derivatives"""
+        storage = self.image.storage
+        return ', '.join(f'{storage.url(name)} {width}w'
+                         for width, name in sorted(self.derivatives.items(), key=lambda item: int(item[0])))
+
+
+class ImageLabel(models.Model):
+    """A single tag or color of an image, indexed for search (see search.py)"""
+    TAG = 'tag'
+    COLOR = 'color'
+    KINDS = [
+        (TAG, 'Tag'),
+        (COLOR, 'Color'),
+    ]
+
+    image = models.ForeignKey(Image, on_delete=models.CASCADE, related_name='labels')
+    # copied from the image so a search never has to join the whole image table
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    kind = models.CharField(max_length=5, choices=KINDS)
+    value = models.CharField(max_length=50)
+
+    class Meta:
+        indexes = [
+            # covers the image ids of a user's images with a given label
+            models.Index(fields=['user', 'kind', 'value', 'image'], name='image_label_search_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.kind}: {self.value}'
+
+
+class Export(models.Model):
+    """A ZIP of a user's library built by the export worker (see export.py)"""
+    # states of the export job
+    PENDING = 'pending'
+    PROCESSING = 'processing'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUSES = [
+        (PENDING, 'Pending'),
+        (PROCESSING, 'Processing'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    ]
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    status = models.CharField(max_length=10, choices=STATUSES, default=PENDING, db_index=True)
+    # when a worker picked the export up, used to recover jobs of killed workers
+    started = models.DateTimeField(null=True, blank=True)
+    # storage name of the archive once it is built
+    archive = models.CharField(max_length=255, blank=True, default='')
+
+    def __str__(self):
+        return self.archive or f'{self.status} export'
+
+
+class AnalysisResult(models.Model):
+    """Analysis result shared by all images with the same content (see analysis.AnalysisCache)"""
+    # SHA-256 of the analyzed image bytes
+    content_hash = models.CharField(max_length=64, unique=True)
+    description = models.CharField(max_length=200, blank=True, default='')
+    tags = models.CharField(max_length=250, blank=True, default='')
+    colors = models.CharField(max_length=50, blank=True, default='')
+
+    def __str__(self):
+        return self.content_hash
@@ -0,0 +1,90 @@
+"""
+Per-user cache of the rendered image list of the repo page.
+
+The list only changes when one of the user's images is saved or deleted, so
+the cache keys contain a per-user version that the Image signals replace.
+Entries of old versions are never read again and simply expire.
+"""
+from contextlib import contextmanager
+from contextvars import ContextVar
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from . import metrics
+from .models import Image
+
+# set by bulk_changes(), the Image signals don't bump versions one by one meanwhile
+_bulk = ContextVar('bulk_changes', default=False)
+
+
+def get_cache():
+    """Return the cache of the rendered lists (settings.IMAGE_REPO_PAGE_CACHE)"""
+    return caches[settings.IMAGE_REPO_PAGE_CACHE]
+
+
+def version_key(user_id):
+    return f'repo_version:{user_id}'
+
+
+def get_version(user_id):
+    """Return the current list version of the user"""
+    # a new random version is set when the key is missing (or evicted),
+    # so lists rendered before can't be mistaken for current ones
+    return get_cache().get_or_set(version_key(user_id), lambda: uuid.uuid4().hex,
+                                  settings.IMAGE_REPO_PAGE_VERSION_TIMEOUT)
+
+
+def bump_version(user_id):
+    """Invalidate all cached lists of the user, return the new version"""
+    version = uuid.uuid4().hex
+    get_cache().set(version_key(user_id), version, settings.IMAGE_REPO_PAGE_VERSION_TIMEOUT)
+    return version
+
+
+@contextmanager
+def bulk_changes(user_ids):
+    """Change many images of the users, their versions are bumped once when done"""
+    token = _bulk.set(True)
+    try:
+        yield
+    finally:
+        _bulk.reset(token)
+        # also after an error, some changes may have been committed
+        for user_id in user_ids:
+            bump_version(user_id)
+
+
+def get_or_render(user_id, page, render, version=None):
+    """
+    Return the cached list of the user's page, calling render() on a miss.
+
+    `version` is the one a change of the caller just set (Image.list_version),
+    nothing was cached under it yet.
+    """
+    cache = get_cache()
+    key = f'repo_images:{user_id}:{version or get_version(user_id)}:{page}'
+    html = None if version else cache.get(key)
+    if html is not None:
+        metrics.incr('repo_cache_hits')
+        return html
+    metrics.incr('repo_cache_misses')
+    html = render()
+    # the list contains signed image URLs, it must expire before they do
+    cache.set(key, html, settings.IMAGE_REPO_PAGE_CACHE_TIMEOUT)
+    return html
+
+
+@receiver(post_save, sender=Image)
+@receiver(post_delete, sender=Image)
+def image_changed(sender, instance, **kwargs):
+    # bulk_create() and QuerySet.update() don't send signals, only the
+    # analysis state (pending -> processing) is changed that way, the
+    # worker's results bump the version themselves (jobs.update_image())
+    if _bulk.get():
+        return
+    # the caller applies its own change at this version without reading it back
+    instance.list_version = bump_version(instance.user_id)
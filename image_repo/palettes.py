@@ -0,0 +1,113 @@
+"""
+Color similarity search over palette vectors.
+
+Image.palette holds the share of every color of colors.COLOR_NAMES in the
+image. Two palettes are compared with a quadratic-form distance whose color
+similarities come from the CIELAB distances of the colors, so a red image is
+closer to an orange one than to a blue one. The vectors of a user are kept in
+one NumPy array per user (see indexes.UserIndexes) and a query computes the
+distances to all of them at once.
+"""
+from django.conf import settings
+import numpy as np
+
+from .colors import COLOR_NAMES, PALETTE
+from .indexes import UserIndexes
+from .models import Image
+
+# CIELAB distance at which two colors are about a third (1/e) alike
+SIMILARITY_SCALE = 40
+
+
+def rgb_to_lab(rgb):
+    """Return the CIELAB coordinates (D65) of an (n, 3) array of sRGB colors"""
+    linear = rgb / 255
+    linear = np.where(linear > 0.04045, ((linear + 0.055) / 1.055) ** 2.4, linear / 12.92)
+    xyz = linear @ np.array([[0.4124, 0.3576, 0.1805],
+                             [0.2126, 0.7152, 0.0722],
+                             [0.0193, 0.1192, 0.9505]]).T / [0.95047, 1.0, 1.08883]
+    f = np.where(xyz > (6 / 29) ** 3, np.cbrt(xyz), xyz / (3 * (6 / 29) ** 2) + 4 / 29)
+    return np.stack([116 * f[:, 1] - 16, 500 * (f[:, 0] - f[:, 1]), 200 * (f[:, 1] - f[:, 2])], axis=1)
+
+
+def color_similarities():
+    """Return the (colors, colors) matrix of similarities between the palette colors, 1 on the diagonal"""
+    # the shades of a name are averaged
+    rgb = np.array([np.mean([shade for name, shade in PALETTE if name == color], axis=0) for color in COLOR_NAMES])
+    lab = rgb_to_lab(rgb)
+    distances = np.linalg.norm(lab[:, None] - lab[None], axis=2)
+    # a Gaussian of the distances is positive definite, so the palette distances are metric
+    return np.exp(-(distances / SIMILARITY_SCALE) ** 2).astype(np.float32)
+
+
+SIMILARITIES = color_similarities()
+
+
+class PaletteIndex:
+    """Palette vectors of a user's images in one array, searched with a few matrix operations"""
+
+    def __init__(self, items=()):
+        items = list(items)
+        self.size = len(items)
+        # grown by doubling, add() is amortized O(1)
+        capacity = max(self.size, 16)
+        self.ids = np.zeros(capacity, dtype=np.int64)
+        self.vectors = np.zeros((capacity, len(COLOR_NAMES)), dtype=np.float32)
+        if items:
+            self.vectors[:self.size] = [vector for vector, image_id in items]
+            self.ids[:self.size] = [image_id for vector, image_id in items]
+
+    def add(self, vector, image_id):
+        if self.size == len(self.ids):
+            self.ids = np.resize(self.ids, 2 * self.size)
+            self.vectors = np.resize(self.vectors, (2 * self.size, len(COLOR_NAMES)))
+        self.ids[self.size] = image_id
+        self.vectors[self.size] = vector
+        self.size += 1
+
+    def search(self, vector, count):
+        """Return [(distance, image id)] of the `count` nearest palettes, nearest first"""
+        if not self.size:
+            return []
+        differences = self.vectors[:self.size] - np.asarray(vector, dtype=np.float32)
+        # sqrt(d A d) for every row d at once, the differences between similar colors weigh less
+        distances = np.sqrt(np.maximum(((differences @ SIMILARITIES) * differences).sum(axis=1), 0))
+        count = min(count, self.size)
+        nearest = np.argpartition(distances, count - 1)[:count]
+        nearest = nearest[np.argsort(distances[nearest], kind='stable')]
+        return [(float(distances[i]), int(self.ids[i])) for i in nearest]
+
+
+def build_index(user_id):
+    return PaletteIndex(Image.objects.filter(user_id=user_id, palette__isnull=False).values_list('palette', 'id'))
+
+
+# palette vectors of the users' images
+indexes = UserIndexes(build_index, 'IMAGE_REPO_PALETTE_INDEX_USERS')
+
+
+def search_index(user_id, vector, count):
+    """Return [(distance, image id)] of the user's `count` palettes nearest to the vector"""
+    index = indexes.get(user_id)
+    # add_to_index() may change the arrays meanwhile
+    with indexes.lock:
+        return index.search(vector, count)
+
+
+def add_to_index(image, version):
+    """Add a just saved image to the user's index if it was built at `version`, instead of rebuilding it"""
+    if image.palette is not None:
+        indexes.update(image.user_id, version, lambda index: index.add(image.palette, image.id),
+                       getattr(image, 'list_version', None))
+
+
+def similar_palettes(image, count=None):
+    """Return the user's other images with the palettes nearest to the image's, nearest first"""
+    if image.palette is None:
+        return []
+    count = settings.IMAGE_REPO_PAGE_SIZE if count is None else count
+    ids = [image_id for distance, image_id in search_index(image.user_id, image.palette, count + 1)
+           if image_id != image.id][:count]
+    images = Image.objects.in_bulk(ids)
+    # in_bulk() loses the order of the ids
+    return [images[image_id] for image_id in ids if image_id in images]
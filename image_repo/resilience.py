@@ -0,0 +1,202 @@
+"""
+Protection of the analysis worker against a failing or throttling endpoint.
+
+CircuitBreaker stops the calls after repeated failures: while it is open they
+raise CircuitOpenError right away, and after IMAGE_REPO_CIRCUIT_RESET_TIMEOUT a
+single probe call decides whether it closes again. TokenBucket spaces the
+calls of the process to its share of the provider's quota and slows down
+while the provider answers 429.
+backoff() is the jittered delay between the retries of a failed call.
+"""
+import asyncio
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+
+class CircuitOpenError(Exception):
+    """The endpoint is failing, the call was not made"""
+
+
+def backoff(attempt, retry_after=None):
+    """Return the seconds to wait before retry number `attempt` + 1, at least what the endpoint asked for"""
+    # "full jitter": retries of many workers don't hit the endpoint at the same moments
+    delay = random.uniform(0, min(settings.IMAGE_REPO_ANALYSIS_BACKOFF_MAX,
+                                  settings.IMAGE_REPO_ANALYSIS_BACKOFF * 2 ** attempt))
+    return max(delay, retry_after or 0)
+
+
+def update_shared(update):
+    """Run an update of the shared cache, in a thread when called from an event loop (the cache is the database)"""
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        update()
+    else:
+        loop.run_in_executor(None, update)
+
+
+class CircuitBreaker:
+    """Per-process breaker of the calls to one endpoint, its state is shared for /metrics/"""
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+    STATES = [CLOSED, OPEN, HALF_OPEN]
+
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Close the circuit and forget the failures"""
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self.opened_at = 0.0
+            # when the probe of the half-open circuit was let through, None before
+            self.probe_started = None
+
+    def before_call(self):
+        """Raise CircuitOpenError unless a call may be made now"""
+        reset_timeout = settings.IMAGE_REPO_CIRCUIT_RESET_TIMEOUT
+        with self._lock:
+            now = time.monotonic()
+            changed = self.state == self.OPEN and now - self.opened_at >= reset_timeout
+            if changed:
+                self.state = self.HALF_OPEN
+            allowed = self.state == self.CLOSED
+            # a single probe at a time, another one if it never reported back
+            if self.state == self.HALF_OPEN and (self.probe_started is None or
+                                                 now - self.probe_started >= reset_timeout):
+                self.probe_started = now
+                allowed = True
+        if changed:
+            self.publish()
+        if not allowed:
+            self.count('rejections')
+            raise CircuitOpenError(f'The {self.name} circuit is open.')
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            changed = self.state != self.CLOSED
+            if changed:
+                self.state = self.CLOSED
+                self.probe_started = None
+        if changed:
+            self.publish()
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            # a failed probe opens the circuit again right away
+            changed = (self.state == self.HALF_OPEN or
+                       self.state == self.CLOSED and self.failures >= settings.IMAGE_REPO_CIRCUIT_FAILURES)
+            if changed:
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+                self.probe_started = None
+        if changed:
+            self.count('opened')
+            self.publish()
+
+    def retry_after(self):
+        """Return the seconds until calls may be let through again, 0 when they are"""
+        reset_timeout = settings.IMAGE_REPO_CIRCUIT_RESET_TIMEOUT
+        with self._lock:
+            now = time.monotonic()
+            if self.state == self.OPEN:
+                return max(reset_timeout - (now - self.opened_at), 0)
+            if self.state == self.HALF_OPEN and self.probe_started is not None:
+                # checked again every second until the probe reports back
+                return min(max(reset_timeout - (now - self.probe_started), 0), 1)
+            return 0
+
+    def key(self, name):
+        return f'circuit:{self.name}:{name}'
+
+    def publish(self):
+        """Store the state in the shared cache, the workers' breakers are served by the web processes"""
+        state = self.state
+        print(f'The {self.name} circuit is {state}.')
+
+        def update():
+            try:
+                caches[settings.IMAGE_REPO_CIRCUIT_CACHE].set(self.key('state'), state, None)
+            except Exception as e:
+                print(e)
+        update_shared(update)
+
+    def count(self, name):
+        """Increase the shared counter `name` (not atomic with every cache backend, close enough for metrics)"""
+        def update():
+            cache = caches[settings.IMAGE_REPO_CIRCUIT_CACHE]
+            try:
+                cache.add(self.key(name), 0, None)
+                cache.incr(self.key(name))
+            except Exception as e:
+                print(e)
+        update_shared(update)
+
+    def prometheus_text(self):
+        """Return the shared state and counters in Prometheus text format"""
+        values = caches[settings.IMAGE_REPO_CIRCUIT_CACHE].get_many(
+            [self.key('state'), self.key('opened'), self.key('rejections')])
+        state = values.get(self.key('state'), self.CLOSED)
+        name = f'image_repo_{self.name}_circuit'
+        lines = [f'# TYPE {name}_state gauge']
+        lines += [f'{name}_state{{state="{value}"}} {int(value == state)}' for value in self.STATES]
+        for counter in ('opened', 'rejections'):
+            lines.append(f'# TYPE {name}_{counter}_total counter')
+            lines.append(f'{name}_{counter}_total {values.get(self.key(counter), 0)}')
+        return '\n'.join(lines) + '\n'
+
+
+class TokenBucket:
+    """
+    Spaces calls to settings.IMAGE_REPO_ANALYSIS_RATE per second with bursts of
+    IMAGE_REPO_ANALYSIS_BURST calls, the rate is halved at every 429 and grows back with successes.
+
+    The bucket is per process: the rate and burst are split between the
+    IMAGE_REPO_ANALYSIS_PROCESSES workers, so together they stay within the quota.
+    """
+    # the rate never drops below this share of the configured one
+    MIN_SCALE = 1 / 16
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.scale = 1.0
+            # earliest moment of the next call when no burst is left (virtual scheduling)
+            self.next_call = 0.0
+            self.paused_until = 0.0
+
+    def reserve(self):
+        """Take a token, return the seconds to wait before making the call"""
+        with self._lock:
+            now = time.monotonic()
+            processes = settings.IMAGE_REPO_ANALYSIS_PROCESSES
+            interval = processes / (settings.IMAGE_REPO_ANALYSIS_RATE * self.scale)
+            burst = max(settings.IMAGE_REPO_ANALYSIS_BURST // processes, 1)
+            start = max(self.next_call, now - (burst - 1) * interval, self.paused_until)
+            self.next_call = start + interval
+            return max(start - now, 0)
+
+    def throttle(self, retry_after=None):
+        """Slow down after a 429, no call is made for `retry_after` seconds"""
+        with self._lock:
+            self.scale = max(self.scale / 2, self.MIN_SCALE)
+            if retry_after:
+                self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+
+    def recover(self):
+        """Speed up again after a successful call"""
+        with self._lock:
+            self.scale = min(self.scale + self.MIN_SCALE, 1.0)
@@ -0,0 +1,52 @@
+"""
+Search over a user's library by description, tags and colors.
+
+Tags and colors are stored as ImageLabel rows with a (user, kind, value, image)
+index. Descriptions use Postgres full-text search over Image.search_vector with
+a GIN index. SQLite (tests) falls back to matching every word of the query.
+"""
+from django.contrib.postgres.search import SearchQuery, SearchVector
+from django.db import connection
+
+from .models import Image, ImageLabel
+
+# text search configuration of the description vectors
+SEARCH_CONFIG = 'english'
+
+
+def parse_tags(tags):
+    """Return the tag values of an Image.tags string ('#dog #grass' -> ['dog', 'grass'])"""
+    return [tag.lower() for tag in tags.replace('#', ' ').split()]
+
+
+def parse_colors(colors):
+    """Return the color values of an Image.colors string"""
+    return [color.lower() for color in colors.split()]
+
+
+def index_image(image):
+    """Replace the search labels and vector of an analyzed image"""
+    ImageLabel.objects.filter(image=image).delete()
+    labels = [ImageLabel(image=image, user_id=image.user_id, kind=ImageLabel.TAG, value=tag[:50])
+              for tag in dict.fromkeys(parse_tags(image.tags))]
+    labels += [ImageLabel(image=image, user_id=image.user_id, kind=ImageLabel.COLOR, value=color[:50])
+               for color in dict.fromkeys(parse_colors(image.colors))]
+    ImageLabel.objects.bulk_create(labels)
+    if connection.vendor == 'postgresql':
+        Image.objects.filter(pk=image.pk).update(search_vector=SearchVector('description', config=SEARCH_CONFIG))
+
+
+def search_images(user, query='', tags=(), colors=()):
+    """Return the user's images matching the description query and having all tags and colors"""
+    images = Image.objects.filter(user=user)
+    for kind, values in ((ImageLabel.TAG, tags), (ImageLabel.COLOR, colors)):
+        for value in values:
+            images = images.filter(id__in=ImageLabel.objects.filter(user=user, kind=kind, value=value.lower())
+                                   .values('image_id'))
+    if query:
+        if connection.vendor == 'postgresql':
+            images = images.filter(search_vector=SearchQuery(query, config=SEARCH_CONFIG))
+        else:
+            for word in query.split():
+                images = images.filter(description__icontains=word)
+    return images.order_by('-id')
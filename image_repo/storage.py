@@ -0,0 +1,219 @@
+"""Storage backends used for uploaded images (settings.DEFAULT_FILE_STORAGE)"""
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import posixpath
+import re
+import uuid
+
+from django.conf import settings
+from django.core import signing
+from django.core.cache import cache
+from django.core.files import File
+from django.urls import reverse
+
+from . import metrics
+from .filecache import FileCache
+from storages.backends.s3boto3 import S3Boto3Storage
+
+# salt of the tokens that authorize local direct uploads (see views.direct_upload_local())
+DIRECT_UPLOAD_SALT = 'image_repo.direct_upload'
+# folder of the direct uploads waiting for confirmation, as <folder>/<username>/<random>/<filename>
+DIRECT_UPLOAD_STAGING = 'direct-uploads'
+# the most keys a DeleteObjects request may contain
+S3_DELETE_BATCH = 1000
+
+
+class CachedURLMixin:
+    """
+    Reuse a signed URL until it is close to expiring instead of signing it on every render.
+
+    Stable URLs also let browsers cache the images between page views.
+    """
+
+    def url(self, name, *args, **kwargs):
+        # URLs with custom parameters or expiry are signed every time
+        if args or kwargs:
+            return super().url(name, *args, **kwargs)
+        key = self.url_cache_key(name)
+        url = cache.get(key)
+        if url is None:
+            with metrics.timed('sign'):
+                url = super().url(name)
+            cache.set(key, url, settings.AWS_QUERYSTRING_EXPIRE - settings.IMAGE_REPO_URL_CACHE_MARGIN)
+        return url
+
+    def url_cache_key(self, name):
+        return f'image_repo:url:{name}'
+
+
+@functools.lru_cache(maxsize=None)
+def get_file_cache(directory, max_size):
+    """Return the process' disk cache of stored files in `directory`"""
+    return FileCache(directory, max_size)
+
+
+class FileCacheMixin:
+    """
+    Read stored files through a local LRU disk cache (see filecache.py), files read again cost no request.
+
+    The cache is off when settings.IMAGE_REPO_FILE_CACHE_SIZE is 0. With
+    IMAGE_REPO_PROXY_IMAGES, URLs point to views.image_file(), which serves the cached copies.
+    """
+
+    @property
+    def file_cache(self):
+        if not settings.IMAGE_REPO_FILE_CACHE_SIZE:
+            return None
+        return get_file_cache(settings.IMAGE_REPO_FILE_CACHE_DIR, settings.IMAGE_REPO_FILE_CACHE_SIZE)
+
+    def cached_path(self, name):
+        """Return the path of a local copy of the stored file, fetched on a miss, None when the cache is off"""
+        file_cache = self.file_cache
+        if file_cache is None:
+            return None
+        path = file_cache.get(name)
+        if path is not None:
+            metrics.incr('file_cache_hits')
+            return path
+        metrics.incr('file_cache_misses')
+        # reading a missing object fails only once it is downloaded, with a backend-specific error
+        if not self.exists(name):
+            raise FileNotFoundError(name)
+        with super()._open(name, 'rb') as file:
+            return file_cache.put(name, file.chunks())
+
+    def _open(self, name, mode='rb'):
+        path = self.cached_path(name) if mode == 'rb' else None
+        if path is not None:
+            try:
+                return File(open(path, 'rb'), name=name)
+            except FileNotFoundError:
+                # evicted by another process meanwhile
+                pass
+        return super()._open(name, mode)
+
+    def discard_cached(self, names):
+        file_cache = self.file_cache
+        if file_cache is not None:
+            for name in names:
+                file_cache.discard(name)
+
+    def delete(self, name):
+        super().delete(name)
+        self.discard_cached([name])
+
+    def url(self, name, *args, **kwargs):
+        if settings.IMAGE_REPO_PROXY_IMAGES and self.file_cache is not None and not (args or kwargs):
+            return reverse('image_file', args=[name])
+        return super().url(name, *args, **kwargs)
+
+
+class S3Storage(FileCacheMixin, CachedURLMixin, S3Boto3Storage):
+    """S3 storage with cached presigned URLs and files"""
+
+    def presigned_post(self, name, max_size, expire):
+        """Return the URL and form fields that let a browser upload `name` straight to the bucket"""
+        return self.bucket.meta.client.generate_presigned_post(
+            Bucket=self.bucket_name,
+            Key=self._normalize_name(self._clean_name(name)),
+            Conditions=[['content-length-range', 1, max_size]],
+            ExpiresIn=expire,
+        )
+
+    def copy(self, name, new_name):
+        """Copy a stored file to `new_name` inside the bucket, without downloading it"""
+        self.bucket.meta.client.copy_object(
+            Bucket=self.bucket_name,
+            Key=self._normalize_name(self._clean_name(new_name)),
+            CopySource={'Bucket': self.bucket_name, 'Key': self._normalize_name(self._clean_name(name))},
+        )
+
+    def delete_many(self, names):
+        """Delete files with one request per S3_DELETE_BATCH names, return the names that failed"""
+        keys = {self._normalize_name(self._clean_name(name)): name for name in names}
+        batches = [list(keys)[i:i + S3_DELETE_BATCH] for i in range(0, len(keys), S3_DELETE_BATCH)]
+        with ThreadPoolExecutor(max_workers=settings.IMAGE_REPO_DELETE_WORKERS) as pool:
+            responses = list(pool.map(self._delete_batch, batches))
+        self.discard_cached(names)
+        failed = []
+        for response in responses:
+            for error in response.get('Errors', []):
+                print(f"{error['Key']}: {error.get('Message')}")
+                failed.append(keys[error['Key']])
+        return failed
+
+    def _delete_batch(self, keys):
+        # quiet mode: only the keys that could not be deleted are listed
+        return self.bucket.meta.client.delete_objects(
+            Bucket=self.bucket_name,
+            Delete={'Objects': [{'Key': key} for key in keys], 'Quiet': True},
+        )
+
+
+def local_path(storage, name):
+    """Return the path of a local copy of the stored file, None when the storage can't provide one"""
+    if hasattr(storage, 'cached_path'):
+        return storage.cached_path(name)
+    try:
+        return storage.path(name)
+    except NotImplementedError:
+        return None
+
+
+def open_local(storage, name):
+    """Open a local copy of the stored file for reading, None when the storage can't provide one"""
+    for attempt in range(2):
+        path = local_path(storage, name)
+        if path is None:
+            return None
+        try:
+            return open(path, 'rb')
+        except FileNotFoundError:
+            # a cached copy evicted by another process meanwhile is fetched again
+            if attempt:
+                raise
+
+
+def move(storage, name, new_name):
+    """Move a stored file to the available name `new_name`, return the name it got"""
+    if hasattr(storage, 'copy'):
+        storage.copy(name, new_name)
+    else:
+        with storage.open(name, 'rb') as file:
+            new_name = storage.save(new_name, file)
+    storage.delete(name)
+    return new_name
+
+
+def staging_name(username, filename):
+    """Return a new key for a direct upload of `filename`, nobody else's upload gets it"""
+    return posixpath.join(DIRECT_UPLOAD_STAGING, username, uuid.uuid4().hex, filename)
+
+
+def is_staging_name(name, username):
+    """Return True if `name` is a key staging_name() could have given the user"""
+    return re.fullmatch(rf'{DIRECT_UPLOAD_STAGING}/{re.escape(username)}/[0-9a-f]{{32}}/(?!\.\.?$)[^/]+', name) is not None
+
+
+def presigned_post(storage, name):
+    """
+    Return {'url': ..., 'fields': {...}} for a browser upload of `name` that bypasses the app servers.
+
+    Storages without presigned POSTs (FileSystemStorage in development and tests)
+    get an equivalent signed form posted to views.direct_upload_local().
+    """
+    max_size = settings.IMAGE_REPO_MAX_UPLOAD_SIZE
+    expire = settings.IMAGE_REPO_DIRECT_UPLOAD_EXPIRE
+    if hasattr(storage, 'presigned_post'):
+        return storage.presigned_post(name, max_size, expire)
+    token = signing.dumps({'key': name, 'max_size': max_size}, salt=DIRECT_UPLOAD_SALT)
+    return {'url': reverse('direct_upload_local'), 'fields': {'key': name, 'token': token}}
+
+
+def check_direct_upload_token(token, key):
+    """Return the maximum size of a local direct upload if the token authorizes `key`, otherwise None"""
+    try:
+        data = signing.loads(token, salt=DIRECT_UPLOAD_SALT, max_age=settings.IMAGE_REPO_DIRECT_UPLOAD_EXPIRE)
+    except signing.BadSignature:
+        return None
+    return data['max_size'] if data['key'] == key else None
@@ -6,3 +6,11 @@ register = template.Library()
 @register.filter(name='split')
 def split(str, key):
     return str.split(key)
+
+
+@register.simple_tag(takes_context=True)
+def page_url(context, before):
+    # keep the search parameters when moving to the next page
+    params = context['request'].GET.copy()
+    params['before'] = before
+    return '?' + params.urlencode()
@@ -1,17 +1,75 @@
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO, StringIO
+import json
+import os
 import shutil
 import tempfile
+import time
+import zipfile
+from unittest import mock
 
+from asgiref.sync import async_to_sync
 from django.contrib.auth.models import User
 from django.core.files.storage import FileSystemStorage
 from django.core.files.uploadedfile import SimpleUploadedFile
 from django.conf import settings
-from django.test import Client, TestCase
+from django.core.cache import cache, caches
+from django.core.management import call_command
+from django.db import connection
+from django.test import Client, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from PIL import Image as PILImage
 
-from .forms import ImageForm
-from .models import Image
+from . import analysis, auth, duplicates, export, filecache, metrics, pagecache, palettes
+from .benchmarks import auth as auth_benchmark
+from .benchmarks.stub_azure import StubAzureServer
+from .colors import COLOR_NAMES, palette_vector
+from .forms import ImageForm, SniffedImageField
+from .imaging import prepare_for_analysis
+from .jobs import claim_images, process_images, run_async_worker, run_worker
+from .models import AnalysisResult, Export, Image, ImageLabel
+from .resilience import CircuitBreaker, CircuitOpenError
+from .search import index_image, search_images
+from .filecache import FileCache
+from .storage import CachedURLMixin, FileCacheMixin, S3Storage
+from .uploadhandlers import UploadInspector
+from .uploads import store_file
 
 
+def fake_analyzer(img):
+    """Local stand-in for analysis.azure_cv_api() used in tests"""
+    return {'description': 'a test image.', 'tags': '#test #image', 'colors': 'white black'}
+
+
+async def fake_async_analyzer(img):
+    """Local stand-in for analysis.azure_cv_api_async() used in tests"""
+    return fake_analyzer(img)
+
+
+def failing_analyzer(img):
+    """Analyzer that fails like analysis.azure_cv_api() does when Azure is unavailable"""
+    return None
+
+
+class CachedURLFileSystemStorage(CachedURLMixin, FileSystemStorage):
+    """File system storage with the URL cache of storage.S3Storage"""
+
+
+class CachedFileSystemStorage(FileCacheMixin, FileSystemStorage):
+    """File system storage with the file cache of storage.S3Storage"""
+
+
+# the shared caches of the deployment, the tests use local ones unless they check the culling
+DATABASE_PAGE_CACHE = settings.CACHES['pages']
+DATABASE_CIRCUIT_CACHE = settings.CACHES['circuit']
+
+
+@override_settings(CACHES=dict(settings.CACHES,
+                               pages={'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'pages'},
+                               circuit={'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                                        'LOCATION': 'circuit'}))
 class ImageRepoTestCase(TestCase):
     def setUp(self):
         """Set up tests by creating an signing in a user and getting an image"""
@@ -24,6 +82,13 @@ class ImageRepoTestCase(TestCase):
         self.client.login(username='user1', password='Password')
         with open('image_repo/test_data/test.png', 'rb') as file:
             self.upload_image = SimpleUploadedFile('test.png', file.read())
+        # results cached in memory by previous tests are gone from the database
+        analysis.analysis_cache.clear()
+        analysis.azure_circuit.reset()
+        analysis.azure_rate.reset()
+        cache.clear()
+        pagecache.get_cache().clear()
+        caches[settings.IMAGE_REPO_CIRCUIT_CACHE].clear()
 
     def tearDown(self):
         """Clean up resources from setup and tests"""
@@ -138,3 +203,1146 @@ class ImageRepoTestCase(TestCase):
         """Test if image gets uploaded in views.repo()"""
         resp = self.client.post(reverse('repo'), data={'image': self.upload_image})
         self.assertEqual(resp.status_code, 200)
+
+    def test_image_upload_pending(self):
+        """Test if uploaded image is saved with a pending analysis in views.repo()"""
+        self.client.post(reverse('repo'), data={'image': self.upload_image})
+        new_img = Image.objects.get(user=self.user1)
+        self.assertEqual(new_img.analysis_status, Image.PENDING)
+        self.assertEqual(new_img.description, '')
+
+    # JOBS
+    @override_settings(IMAGE_REPO_ANALYZER='image_repo.tests.fake_analyzer')
+    def test_run_worker(self):
+        """Test if the worker fills in the analysis of pending images (jobs.run_worker())"""
+        for _ in range(3):
+            self.upload_image.seek(0)
+            Image.objects.create(image=self.upload_image, user=self.user1)
+        self.assertEqual(run_worker(workers=2, once=True), 3)
+        for new_img in Image.objects.filter(user=self.user1):
+            self.assertEqual(new_img.analysis_status, Image.DONE)
+            self.assertEqual(new_img.description, 'A test image.')
+            self.assertEqual(new_img.tags, '#test #image')
+            self.assertEqual(new_img.colors, 'white black')
+
+    def test_run_worker_deleted_image(self):
+        """Test if an image deleted while it was analyzed doesn't stop the rest of the batch (jobs.process_images())"""
+        for _ in range(3):
+            self.upload_image.seek(0)
+            Image.objects.create(image=self.upload_image, user=self.user1)
+        images = claim_images(3)
+        # the row goes, its file is still there for the analyzer
+        Image.objects.filter(pk=images[1].pk).delete()
+        with ThreadPoolExecutor() as pool:
+            self.assertEqual(process_images(images, pool, fake_analyzer), 3)
+        self.assertEqual(list(Image.objects.values_list('analysis_status', flat=True)), [Image.DONE] * 2)
+        self.assertFalse(ImageLabel.objects.filter(image_id=images[1].pk).exists())
+
+    @override_settings(IMAGE_REPO_ANALYSIS_MAX_ATTEMPTS=2)
+    def test_run_worker_failure(self):
+        """Test if failed analysis is retried and then marked as failed (jobs.run_worker())"""
+        new_img = Image.objects.create(image=self.upload_image, user=self.user1)
+        self.assertEqual(run_worker(once=True, analyzer=failing_analyzer), 2)
+        new_img.refresh_from_db()
+        self.assertEqual(new_img.analysis_status, Image.FAILED)
+        self.assertEqual(new_img.analysis_attempts, 2)
+
+    def test_analyze_images_command(self):
+        """Test if the worker command drains the queue (commands.analyze_images)"""
+        Image.objects.create(image=self.upload_image, user=self.user1)
+        call_command('analyze_images', once=True, analyzer='image_repo.tests.fake_analyzer', stdout=StringIO())
+        self.assertFalse(Image.objects.exclude(analysis_status=Image.DONE).exists())
+
+    # REANALYSIS
+    def create_analyzed_states(self):
+        """Create a failed, an empty, an analyzed and a pending image, return them"""
+        images = []
+        for status, description in ((Image.FAILED, ''), (Image.DONE, ''), (Image.DONE, 'An old result.'),
+                                    (Image.PENDING, '')):
+            self.upload_image.seek(0)
+            images.append(Image.objects.create(image=self.upload_image, user=self.user1, analysis_status=status,
+                                               description=description))
+        return images
+
+    def test_reanalyze_images_command(self):
+        """Test if failed, empty and outdated images are analyzed again (commands.reanalyze_images)"""
+        failed, empty, analyzed, pending = self.create_analyzed_states()
+        checkpoint = os.path.join(settings.MEDIA_ROOT, 'checkpoint.json')
+        call_command('reanalyze_images', analyzer='image_repo.tests.fake_analyzer', checkpoint=checkpoint,
+                     stdout=StringIO())
+        for image in (failed, empty):
+            image.refresh_from_db()
+            self.assertEqual(image.description, 'A test image.')
+        analyzed.refresh_from_db()
+        self.assertEqual(analyzed.description, 'An old result.')
+        self.assertEqual(Image.objects.get(id=pending.id).analysis_status, Image.PENDING)
+        self.assertFalse(os.path.exists(checkpoint))
+        # images analyzed before the date are outdated
+        call_command('reanalyze_images', analyzer='image_repo.tests.fake_analyzer', checkpoint=checkpoint,
+                     older_than='2100-01-01', stdout=StringIO())
+        analyzed.refresh_from_db()
+        self.assertEqual(analyzed.description, 'A test image.')
+
+    def test_reanalyze_images_resume(self):
+        """Test if a stopped run resumes after its checkpoint (commands.reanalyze_images)"""
+        failed, empty, analyzed, pending = self.create_analyzed_states()
+        checkpoint = os.path.join(settings.MEDIA_ROOT, 'checkpoint.json')
+        with open(checkpoint, 'w') as file:
+            json.dump({'older_than': None, 'last_id': failed.id, 'processed': 1, 'succeeded': 0}, file)
+        output = StringIO()
+        call_command('reanalyze_images', analyzer='image_repo.tests.fake_analyzer', checkpoint=checkpoint,
+                     batch_size=1, stdout=output)
+        self.assertEqual(Image.objects.get(id=failed.id).analysis_status, Image.FAILED)
+        self.assertEqual(Image.objects.get(id=empty.id).description, 'A test image.')
+        self.assertIn('Analyzed 1 of 2 images again, 1 failed', output.getvalue())
+
+    # ANALYSIS
+    def test_azure_cv_api(self):
+        """Test if analysis result is parsed and the connection is reused (analysis.azure_cv_api())"""
+        with StubAzureServer() as server, \
+                mock.patch.dict(os.environ, {'AZURE_CV_KEY': 'key', 'AZURE_CV_ENDPOINT': server.endpoint}):
+            result = analysis.azure_cv_api(b'image')
+            self.assertEqual(result, {'description': 'a stub image.', 'tags': '#stub #image',
+                                      'colors': 'white black'})
+            self.assertIsNotNone(analysis.azure_cv_api(b'image'))
+        self.assertIs(analysis.get_session(), analysis.get_session())
+
+    @override_settings(IMAGE_REPO_ANALYSIS_READ_TIMEOUT=0.1)
+    def test_azure_cv_api_timeout(self):
+        """Test if a slow analysis endpoint can't hang the worker (analysis.azure_cv_api())"""
+        with StubAzureServer(latency=1) as server, \
+                mock.patch.dict(os.environ, {'AZURE_CV_KEY': 'key', 'AZURE_CV_ENDPOINT': server.endpoint}):
+            with mock.patch('builtins.print'):
+                self.assertIsNone(analysis.azure_cv_api(b'image'))
+
+    # RESILIENCE
+    def azure_server(self, **kwargs):
+        """Return a stub Azure server, azure_cv_api() calls it inside the with block"""
+        server = StubAzureServer(**kwargs)
+        patcher = mock.patch.dict(os.environ, {'AZURE_CV_KEY': 'key', 'AZURE_CV_ENDPOINT': server.endpoint})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return server
+
+    @override_settings(IMAGE_REPO_ANALYSIS_BACKOFF=0)
+    def test_azure_cv_api_retries(self):
+        """Test if throttled and failed calls are retried and slow the calls down (analysis.azure_cv_api())"""
+        with self.azure_server(errors=[429, 503]) as server, mock.patch('builtins.print'):
+            self.assertEqual(analysis.azure_cv_api(b'image')['tags'], '#stub #image')
+            self.assertEqual(server.calls, 3)
+            self.assertLess(analysis.azure_rate.scale, 1)
+            server.errors = [503, 503, 503]
+            self.assertIsNone(analysis.azure_cv_api(b'image'))
+            self.assertEqual(server.calls, 6)
+
+    @override_settings(IMAGE_REPO_ANALYSIS_RETRIES=0, IMAGE_REPO_CIRCUIT_FAILURES=2,
+                       IMAGE_REPO_CIRCUIT_RESET_TIMEOUT=0.05)
+    def test_circuit_breaker(self):
+        """Test if calls fail fast while Azure fails and one probe closes the circuit (resilience.CircuitBreaker)"""
+        with self.azure_server(errors=[503, 503]) as server, mock.patch('builtins.print'):
+            self.assertIsNone(analysis.azure_cv_api(b'image'))
+            self.assertIsNone(analysis.azure_cv_api(b'image'))
+            with self.assertRaises(CircuitOpenError):
+                analysis.azure_cv_api(b'image')
+            self.assertEqual(server.calls, 2)
+            self.assertGreater(analysis.azure_circuit.retry_after(), 0)
+            time.sleep(0.05)
+            # the probe is let through, other calls wait for its answer
+            analysis.azure_circuit.before_call()
+            with self.assertRaises(CircuitOpenError):
+                analysis.azure_cv_api(b'image')
+            analysis.azure_circuit.record_success()
+            self.assertIsNotNone(analysis.azure_cv_api(b'image'))
+        self.client.force_login(User.objects.create_user(username='staff', is_staff=True))
+        text = self.client.get(reverse('metrics')).content.decode()
+        self.assertIn('image_repo_azure_circuit_state{state="closed"} 1', text)
+        self.assertIn('image_repo_azure_circuit_opened_total 1', text)
+        self.assertIn('image_repo_azure_circuit_rejections_total 2', text)
+
+    def test_circuit_state_not_culled(self):
+        """Test if the shared circuit state outlives the page cache culling (resilience.CircuitBreaker.publish())"""
+        small_pages = dict(DATABASE_PAGE_CACHE, OPTIONS={'MAX_ENTRIES': 50, 'CULL_FREQUENCY': 3})
+        with override_settings(CACHES=dict(settings.CACHES, pages=small_pages, circuit=DATABASE_CIRCUIT_CACHE)), \
+                mock.patch('builtins.print'):
+            call_command('createcachetable', stdout=StringIO())
+            circuit = CircuitBreaker('test')
+            circuit.state = CircuitBreaker.OPEN
+            circuit.publish()
+            for user_id in range(400):
+                pagecache.bump_version(user_id)
+            self.assertIn('image_repo_test_circuit_state{state="open"} 1', circuit.prometheus_text())
+
+    @override_settings(IMAGE_REPO_ANALYSIS_RATE=100, IMAGE_REPO_ANALYSIS_BURST=2)
+    def test_token_bucket(self):
+        """Test if calls are spaced to the rate after a burst and paused after a 429 (resilience.TokenBucket)"""
+        bucket = analysis.azure_rate
+        self.assertEqual([bucket.reserve() for _ in range(2)], [0, 0])
+        self.assertAlmostEqual(bucket.reserve(), 0.01, places=2)
+        bucket.throttle(retry_after=1)
+        self.assertGreater(bucket.reserve(), 0.9)
+        # two workers share the quota
+        bucket.reset()
+        with override_settings(IMAGE_REPO_ANALYSIS_PROCESSES=2):
+            self.assertEqual(bucket.reserve(), 0)
+            self.assertAlmostEqual(bucket.reserve(), 0.02, places=2)
+
+    def test_analyzer_abstract(self):
+        """Test if analyzers must implement the analysis of one image (analysis.Analyzer)"""
+        with self.assertRaises(TypeError):
+            analysis.Analyzer()
+
+    def test_run_worker_circuit_open(self):
+        """Test if images refused by an open circuit stay queued without using an attempt (jobs.run_worker())"""
+        Image.objects.create(image=self.upload_image, user=self.user1)
+        analyzer = mock.Mock(side_effect=CircuitOpenError)
+        self.assertEqual(run_worker(once=True, analyzer=analyzer), 0)
+        new_img = Image.objects.get()
+        self.assertEqual((new_img.analysis_status, new_img.analysis_attempts), (Image.PENDING, 0))
+
+    # ANALYZERS
+    def solid_image(self, color):
+        """Return PNG bytes of an image of one color"""
+        output = BytesIO()
+        PILImage.new('RGB', (100, 60), color).save(output, 'PNG')
+        return output.getvalue()
+
+    def test_local_color_analyzer(self):
+        """Test if dominant colors are computed locally, one by one or in a batch (analysis.LocalColorAnalyzer)"""
+        analyzer = analysis.LocalColorAnalyzer()
+        self.assertEqual(analyzer(self.solid_image('red')), {'description': '', 'tags': '', 'colors': 'red'})
+        images = [self.solid_image('navy'), self.upload_image.file.getvalue(), self.solid_image('orange')]
+        self.assertEqual([result['colors'] for result in analyzer.analyze_batch(images)],
+                         [analyzer(img)['colors'] for img in images])
+        self.assertEqual(analyzer.analyze_batch([]), [])
+
+    def test_hybrid_analyzer(self):
+        """Test if only captions and tags are asked from Azure (analysis.HybridAnalyzer)"""
+        azure_result = {'description': 'a red square.', 'tags': '#red', 'colors': ''}
+        analyzer = analysis.HybridAnalyzer()
+        with mock.patch('image_repo.analysis.azure_cv_api', return_value=azure_result) as azure_cv_api:
+            self.assertEqual(analyzer(self.solid_image('red')), dict(azure_result, colors='red'))
+            azure_cv_api.assert_called_once_with(mock.ANY, features='Description')
+            self.assertEqual(analyzer.analyze_batch([self.solid_image('green')])[0]['colors'], 'green')
+            azure_cv_api.return_value = None
+            self.assertEqual(analyzer.analyze_batch([self.solid_image('green')]), [None])
+        with mock.patch('image_repo.analysis.azure_cv_api_async', return_value=azure_result):
+            self.assertEqual(async_to_sync(analyzer.analyze_async)(self.solid_image('red'))['colors'], 'red')
+
+    @override_settings(IMAGE_REPO_ANALYZER='image_repo.analysis.LocalColorAnalyzer')
+    def test_run_worker_batch(self):
+        """Test if the worker can analyze the claimed images in one batch (jobs.process_batch())"""
+        Image.objects.create(image=SimpleUploadedFile('red.png', self.solid_image('red')), user=self.user1)
+        Image.objects.create(image=SimpleUploadedFile('blue.png', self.solid_image('navy')), user=self.user1)
+        with mock.patch.object(analysis.LocalColorAnalyzer, 'analyze_batch',
+                               autospec=True, side_effect=analysis.LocalColorAnalyzer.analyze_batch) as batch:
+            self.assertEqual(run_worker(workers=2, once=True, batch=True), 2)
+        self.assertEqual(batch.call_count, 1)
+        self.assertEqual(list(Image.objects.order_by('id').values_list('colors', flat=True)), ['red', 'blue'])
+
+    @override_settings(IMAGE_REPO_ANALYZER='image_repo.analysis.HybridAnalyzer')
+    def test_run_worker_batch_refused(self):
+        """Test if only the images refused by an open circuit go back to the queue (jobs.process_batch())"""
+        Image.objects.create(image=SimpleUploadedFile('red.png', self.solid_image('red')), user=self.user1)
+        Image.objects.create(image=SimpleUploadedFile('blue.png', self.solid_image('navy')), user=self.user1)
+
+        def azure_cv_api(img, features):
+            # the circuit opens after the red image was analyzed
+            if PILImage.open(BytesIO(img)).convert('RGB').getpixel((0, 0)) != (255, 0, 0):
+                raise CircuitOpenError
+            return {'description': 'a red square.', 'tags': '#red', 'colors': ''}
+        with mock.patch('image_repo.analysis.azure_cv_api', side_effect=azure_cv_api):
+            self.assertEqual(run_worker(workers=2, once=True, batch=True), 1)
+        states = Image.objects.order_by('id').values_list('analysis_status', 'colors', 'analysis_attempts')
+        self.assertEqual(list(states), [(Image.DONE, 'red', 1), (Image.PENDING, '', 0)])
+
+    # ANALYSIS CACHE
+    def test_upload_content_hash(self):
+        """Test if the upload is hashed while streaming in (uploadhandlers.InspectingMixin)"""
+        self.client.post(reverse('repo'), data={'image': self.upload_image})
+        new_img = Image.objects.get(user=self.user1)
+        self.assertEqual(new_img.content_hash, hashlib.sha256(self.upload_image.file.getvalue()).hexdigest())
+
+    def test_analysis_cache(self):
+        """Test if cached results are found in memory and in the database (analysis.AnalysisCache())"""
+        before = metrics.counters()
+        self.assertIsNone(analysis.analysis_cache.get('abc'))
+        analysis.analysis_cache.set('abc', fake_analyzer(b''))
+        self.assertEqual(analysis.analysis_cache.get('abc')['tags'], '#test #image')
+        analysis.analysis_cache.clear()
+        self.assertEqual(analysis.analysis_cache.get('abc')['colors'], 'white black')
+        after = metrics.counters()
+        for name in ('analysis_cache_misses', 'analysis_cache_memory_hits', 'analysis_cache_db_hits'):
+            self.assertEqual(after.get(name, 0) - before.get(name, 0), 1)
+
+    def test_repeat_upload_cached(self):
+        """Test if a repeat upload gets the analysis without waiting for the worker (views.repo())"""
+        content_hash = hashlib.sha256(self.upload_image.file.getvalue()).hexdigest()
+        AnalysisResult.objects.create(content_hash=content_hash, **fake_analyzer(b''))
+        self.client.post(reverse('repo'), data={'image': self.upload_image})
+        new_img = Image.objects.get(user=self.user1)
+        self.assertEqual(new_img.analysis_status, Image.DONE)
+        self.assertEqual(new_img.description, 'A test image.')
+
+    def test_run_worker_analyzes_content_once(self):
+        """Test if images with the same content are analyzed once (jobs.process_images())"""
+        analyzer = mock.Mock(side_effect=fake_analyzer)
+        for _ in range(3):
+            self.upload_image.seek(0)
+            self.client.post(reverse('repo'), data={'image': self.upload_image})
+        self.assertEqual(run_worker(once=True, analyzer=analyzer), 3)
+        self.assertEqual(analyzer.call_count, 1)
+        self.assertFalse(Image.objects.exclude(analysis_status=Image.DONE).exists())
+
+    # IMAGING
+    def test_prepare_small_image(self):
+        """Test if small images are sent to the analyzer unchanged (imaging.prepare_for_analysis())"""
+        data = self.upload_image.file.getvalue()
+        self.assertIs(prepare_for_analysis(data), data)
+
+    @override_settings(IMAGE_REPO_ANALYSIS_MAX_SIDE=256)
+    def test_prepare_big_image(self):
+        """Test if big images are downscaled before analysis (imaging.prepare_for_analysis())"""
+        output = BytesIO()
+        PILImage.new('RGBA', (2000, 1000), (255, 0, 0, 128)).save(output, 'PNG')
+        prepared = PILImage.open(BytesIO(prepare_for_analysis(output.getvalue())))
+        self.assertEqual(prepared.format, 'JPEG')
+        self.assertEqual(prepared.size, (256, 128))
+
+    def test_upload_derivatives(self):
+        """Test if derivatives are stored at upload and listed in srcset (views.repo())"""
+        self.client.post(reverse('repo'), data={'image': self.upload_image})
+        new_img = Image.objects.get(user=self.user1)
+        # the test image is 576px wide, only the 400px copy is smaller
+        self.assertEqual(list(new_img.derivatives), ['400'])
+        derivative = PILImage.open(new_img.image.storage.open(new_img.derivatives['400']))
+        self.assertEqual((derivative.format, derivative.size), ('WEBP', (400, 400)))
+        resp = self.client.get(reverse('repo'))
+        self.assertContains(resp, 'srcset="/user1/test_400w.webp 400w"')
+
+    def test_backfill_derivatives_command(self):
+        """Test if derivatives of old images are created (commands.backfill_derivatives)"""
+        new_img = Image.objects.create(image=self.upload_image, user=self.user1)
+        call_command('backfill_derivatives', stdout=StringIO())
+        new_img.refresh_from_db()
+        self.assertEqual(list(new_img.derivatives), ['400'])
+        self.assertTrue(new_img.image.storage.exists(new_img.derivatives['400']))
+
+    # DUPLICATES
+    def converted_copy(self, size, format):
+        """Return the test image resized and saved in another format"""
+        output = BytesIO()
+        PILImage.open(self.upload_image).convert('RGB').resize(size).save(output, format, quality=70)
+        self.upload_image.seek(0)
+        return output.getvalue()
+
+    def test_perceptual_hash(self):
+        """Test if copies hash close and other images far (duplicates.perceptual_hash())"""
+        original = duplicates.perceptual_hash(self.upload_image)
+        copy = duplicates.perceptual_hash(BytesIO(self.converted_copy((300, 300), 'JPEG')))
+        other = PILImage.linear_gradient('L').convert('RGB')
+        output = BytesIO()
+        other.save(output, 'PNG')
+        self.assertLessEqual(duplicates.hamming(original, copy), settings.IMAGE_REPO_DUPLICATE_DISTANCE)
+        self.assertGreater(duplicates.hamming(original, duplicates.perceptual_hash(output)),
+                           settings.IMAGE_REPO_SIMILAR_DISTANCE)
+
+    def test_bk_tree(self):
+        """Test if the tree finds the same hashes as comparing with all of them (duplicates.BKTree())"""
+        hashes = [(value * 0x9E3779B97F4A7C15 % (1 << 64) - (1 << 63), i) for i, value in enumerate(range(500))]
+        hashes += [(value ^ 0b101, image_id + 500) for value, image_id in hashes[:50]]
+        tree = duplicates.BKTree(hashes)
+        for query, radius in ((hashes[0][0], 2), (hashes[7][0] ^ 1 << 40, 6), (12345, 20)):
+            self.assertEqual(tree.search(query, radius),
+                             sorted((duplicates.hamming(query, value), image_id) for value, image_id in hashes
+                                    if duplicates.hamming(query, value) <= radius))
+
+    def test_upload_duplicate(self):
+        """Test if a resized copy is flagged and gets the analysis of the original (uploads.register_image())"""
+        original = Image.objects.create(image=self.upload_image, user=self.user1,
+                                        phash=duplicates.perceptual_hash(self.upload_image), **fake_analyzer(b''),
+                                        analysis_status=Image.DONE)
+        copy = SimpleUploadedFile('copy.jpg', self.converted_copy((400, 400), 'JPEG'))
+        self.client.post(reverse('repo'), data={'image': copy})
+        new_img = Image.objects.exclude(id=original.id).get()
+        self.assertEqual(new_img.duplicate_of, original)
+        self.assertEqual((new_img.analysis_status, new_img.description), (Image.DONE, 'A test image.'))
+
+    def test_duplicate_index_updated(self):
+        """Test if an upload is added to the built tree at the version its save set (duplicates.add_to_index())"""
+        Image.objects.create(image='user1/a.png', user=self.user1, phash=0)
+        tree = duplicates.indexes.get(self.user1.id)
+        with mock.patch.object(pagecache, 'get_version', wraps=pagecache.get_version) as get_version:
+            self.client.post(reverse('repo'), data={'image': self.upload_image})
+        # once for the duplicate search, the saved upload and the rendered list use the version the save set
+        self.assertEqual(get_version.call_count, 1)
+        new_img = Image.objects.latest('id')
+        with self.assertNumQueries(0):
+            self.assertIs(duplicates.indexes.get(self.user1.id), tree)
+        self.assertEqual(duplicates.search_index(self.user1.id, new_img.phash, 0), [(0, new_img.id)])
+
+    @override_settings(IMAGE_REPO_REJECT_DUPLICATES=True)
+    def test_upload_duplicate_rejected(self):
+        """Test if a copy is refused and its files deleted when duplicates are rejected (views.repo())"""
+        self.client.post(reverse('repo'), data={'image': self.upload_image})
+        self.upload_image.seek(0)
+        resp = self.client.post(reverse('repo'), data={'image': SimpleUploadedFile('copy.png',
+                                                                                   self.upload_image.read())})
+        self.assertEqual(resp.context['error'], 'You already uploaded this image.')
+        self.assertEqual(Image.objects.filter(user=self.user1).count(), 1)
+        self.assertEqual(sorted(os.listdir(os.path.join(settings.MEDIA_ROOT, 'user1'))),
+                         ['test.png', 'test_400w.webp'])
+
+    def test_similar_view(self):
+        """Test if only the user's own similar images are listed, nearest first (views.similar())"""
+        user2 = User.objects.create_user(username='user2', password='Password')
+        image = Image.objects.create(image='user1/a.png', user=self.user1, phash=0)
+        far = Image.objects.create(image='user1/b.png', user=self.user1, phash=0b111)
+        near = Image.objects.create(image='user1/c.png', user=self.user1, phash=-(1 << 63))
+        Image.objects.create(image='user1/d.png', user=self.user1, phash=-1)
+        Image.objects.create(image='user2/a.png', user=user2, phash=0)
+        resp = self.client.get(reverse('similar', args=[image.id]))
+        self.assertEqual(resp.context['images'], [near, far])
+        self.assertEqual(self.client.get(reverse('similar', args=[image.id + 4])).status_code, 404)
+
+    def test_backfill_phashes_command(self):
+        """Test if perceptual hashes of old images are computed (commands.backfill_phashes)"""
+        new_img = Image.objects.create(image=self.upload_image, user=self.user1)
+        call_command('backfill_phashes', stdout=StringIO())
+        new_img.refresh_from_db()
+        self.upload_image.seek(0)
+        self.assertEqual(new_img.phash, duplicates.perceptual_hash(self.upload_image))
+        self.assertEqual(duplicates.find_duplicate(Image(user=self.user1, phash=new_img.phash)), new_img)
+
+    # PALETTES
+    def palette(self, *names):
+        """Return the palette of an image made of equal shares of the colors"""
+        return [1 / len(names) if name in names else 0 for name in COLOR_NAMES]
+
+    def test_palette_vector(self):
+        """Test if the palette holds the share of every color of the image (colors.palette_vector())"""
+        output = BytesIO()
+        img = PILImage.new('RGB', (40, 40), (200, 30, 30))
+        img.paste((40, 90, 210), (0, 0, 40, 10))
+        img.save(output, 'PNG')
+        palette = palette_vector(output)
+        self.assertEqual(len(palette), len(COLOR_NAMES))
+        self.assertAlmostEqual(palette[COLOR_NAMES.index('red')], 0.75, places=2)
+        self.assertAlmostEqual(palette[COLOR_NAMES.index('blue')], 0.25, places=2)
+
+    def test_palette_index(self):
+        """Test if the nearest palettes come first and similar colors count as near (palettes.PaletteIndex())"""
+        index = palettes.PaletteIndex([(self.palette('blue'), 1), (self.palette('orange'), 2)])
+        for image_id in range(3, 40):
+            index.add(self.palette('green'), image_id)
+        index.add(self.palette('red', 'white'), 40)
+        self.assertEqual([image_id for distance, image_id in index.search(self.palette('red'), 2)], [40, 2])
+        self.assertEqual(index.search(self.palette('blue'), 1), [(0, 1)])
+        self.assertEqual(palettes.PaletteIndex().search(self.palette('blue'), 1), [])
+
+    def test_similar_colors_view(self):
+        """Test if only the user's own images are listed, nearest palette first (views.similar_colors())"""
+        user2 = User.objects.create_user(username='user2', password='Password')
+        image = Image.objects.create(image='user1/a.png', user=self.user1, palette=self.palette('red'))
+        far = Image.objects.create(image='user1/b.png', user=self.user1, palette=self.palette('blue'))
+        near = Image.objects.create(image='user1/c.png', user=self.user1, palette=self.palette('red', 'white'))
+        Image.objects.create(image='user1/d.png', user=self.user1)
+        Image.objects.create(image='user2/a.png', user=user2, palette=self.palette('red'))
+        resp = self.client.get(reverse('similar_colors', args=[image.id]))
+        self.assertEqual(resp.context['images'], [near, far])
+        self.assertContains(resp, reverse('similar_colors', args=[near.id]))
+        self.assertEqual(self.client.get(reverse('similar_colors', args=[image.id + 4])).status_code, 404)
+
+    def test_upload_decoded_once(self):
+        """Test if the derivatives, hash and palette of an upload come from one decode (uploads.store_file())"""
+        image = Image(user=self.user1)
+        with mock.patch.object(PILImage, 'open', side_effect=PILImage.open) as pil_open:
+            store_file(image, self.upload_image)
+        self.assertEqual(pil_open.call_count, 1)
+        self.assertEqual(list(image.derivatives), ['400'])
+        self.upload_image.seek(0)
+        self.assertLessEqual(duplicates.hamming(image.phash, duplicates.perceptual_hash(self.upload_image)),
+                             settings.IMAGE_REPO_DUPLICATE_DISTANCE)
+        self.upload_image.seek(0)
+        for share, expected in zip(image.palette, palette_vector(self.upload_image)):
+            self.assertAlmostEqual(share, expected, delta=0.05)
+
+    def test_palette_index_updated(self):
+        """Test if an upload is added to the built index instead of rebuilding it (palettes.add_to_index())"""
+        image = Image.objects.create(image='user1/a.png', user=self.user1, palette=self.palette('red'))
+        index = palettes.indexes.get(self.user1.id)
+        self.client.post(reverse('repo'), data={'image': self.upload_image})
+        new_img = Image.objects.exclude(id=image.id).get()
+        self.assertIsNotNone(new_img.palette)
+        with self.assertNumQueries(0):
+            self.assertIs(palettes.indexes.get(self.user1.id), index)
+        self.assertEqual(palettes.similar_palettes(image), [new_img])
+
+    def test_backfill_palettes_command(self):
+        """Test if palettes of old images are computed (commands.backfill_palettes)"""
+        new_img = Image.objects.create(image=self.upload_image, user=self.user1)
+        call_command('backfill_palettes', stdout=StringIO())
+        new_img.refresh_from_db()
+        self.upload_image.seek(0)
+        self.assertEqual(new_img.palette, palette_vector(self.upload_image))
+
+    # EXPORT
+    def test_export(self):
+        """Test if the user's originals and manifest are packed by the worker and downloaded (views.export())"""
+        self.client.post(reverse('repo'), data={'image': self.get_upload_images(2)})
+        Image.objects.filter(image='user1/test0.png').update(description='A test image.', tags='#test',
+                                                             colors='white')
+        user2 = User.objects.create_user(username='user2', password='Password')
+        Image.objects.create(image='user2/other.png', user=user2)
+        self.assertContains(self.client.get(reverse('export')), 'Download all my images')
+        self.assertRedirects(self.client.post(reverse('export')), reverse('export'))
+        # a second click doesn't queue another export
+        self.client.post(reverse('export'))
+        self.assertContains(self.client.get(reverse('export')), 'being packed')
+        self.assertEqual(export.run_export_worker(once=True), 1)
+        archive_name = Export.objects.get().archive
+        self.assertEqual(archive_name, 'user1/exports/user1-image-repo.zip')
+        storage = Image.image.field.storage
+        self.assertRedirects(self.client.get(reverse('export')), storage.url(archive_name),
+                             fetch_redirect_response=False)
+        with storage.open(archive_name, 'rb') as file:
+            archive = zipfile.ZipFile(BytesIO(file.read()))
+        self.assertEqual(archive.namelist(), ['test0.png', 'test1.png', 'manifest.csv'])
+        self.assertEqual(archive.read('test1.png'), self.upload_image.file.getvalue())
+        self.assertEqual(archive.read('manifest.csv').decode().splitlines(),
+                         ['file,description,tags,colors', 'test0.png,A test image.,#test,white', 'test1.png,,,'])
+        # a new export replaces the archive
+        self.client.post(reverse('export'))
+        call_command('export_libraries', '--once', stdout=StringIO())
+        self.assertEqual(Export.objects.get().status, Export.DONE)
+        self.assertFalse(storage.exists(archive_name))
+
+    @override_settings(IMAGE_REPO_PROXY_IMAGES=True)
+    def test_export_proxied(self):
+        """Test if the archive is served by the app when the stored files are proxied (views.image_file())"""
+        self.client.post(reverse('repo'), data={'image': self.upload_image})
+        with override_settings(IMAGE_REPO_FILE_CACHE_DIR=os.path.join(settings.MEDIA_ROOT, 'cache')):
+            Image.image.field.storage = CachedFileSystemStorage(location=settings.MEDIA_ROOT)
+            self.client.post(reverse('export'))
+            export.run_export_worker(once=True)
+            url = reverse('image_file', args=['user1/exports/user1-image-repo.zip'])
+            self.assertRedirects(self.client.get(reverse('export')), url, fetch_redirect_response=False)
+            resp = self.client.get(url)
+            self.assertEqual(resp['Content-Type'], 'application/zip')
+            archive = zipfile.ZipFile(BytesIO(b''.join(resp.streaming_content)))
+            self.assertEqual(archive.namelist(), ['test.png', 'manifest.csv'])
+        # other users' archives stay private
+        user2 = User.objects.create_user(username='user2', password='Password')
+        self.client.force_login(user2)
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+    def test_export_failed(self):
+        """Test if a failed export can be asked for again (export.run_export_worker())"""
+        self.client.post(reverse('export'))
+        with mock.patch.object(export, 'zip_library', side_effect=OSError('storage down')):
+            export.run_export_worker(once=True)
+        self.assertEqual(Export.objects.get().status, Export.FAILED)
+        self.assertContains(self.client.get(reverse('export')), 'Kindly try again')
+        self.client.post(reverse('export'))
+        self.assertEqual(export.run_export_worker(once=True), 1)
+        self.assertEqual(Export.objects.get().status, Export.DONE)
+
+    @override_settings(IMAGE_REPO_EXPORT_PREFETCH=2, IMAGE_REPO_EXPORT_PAGE_SIZE=2,
+                       IMAGE_REPO_EXPORT_CHUNK_SIZE=1024)
+    def test_export_streamed(self):
+        """Test if the archive is sent in chunks and a missing file doesn't stop it (export.zip_library())"""
+        self.create_library(self.user1, 4)
+        names = list(Image.objects.order_by('id').values_list('image', flat=True))
+        storage = Image.image.field.storage
+        for name in names[1:]:
+            storage.save(name, SimpleUploadedFile(name, self.upload_image.file.getvalue()))
+        parts = list(export.zip_library(self.user1.id))
+        self.assertGreater(len(parts), len(self.upload_image.file.getvalue()) // 1024 * 3)
+        archive = zipfile.ZipFile(BytesIO(b''.join(parts)))
+        self.assertEqual(len(archive.namelist()), 4)
+        self.assertEqual(len(archive.read('manifest.csv').decode().splitlines()), 5)
+
+    # DELETION
+    def test_bulk_delete(self):
+        """Test if the selected images are deleted with their files and labels (views.bulk_delete())"""
+        self.client.post(reverse('repo'), data={'image': self.get_upload_images(2)})
+        deleted, kept = Image.objects.order_by('id')
+        index_image(deleted)
+        storage = Image.image.field.storage
+        names = [deleted.image.name, *deleted.derivatives.values()]
+        self.assertTrue(all(storage.exists(name) for name in names))
+        resp = self.client.post(reverse('bulk_delete'), data={'ids': [deleted.id]})
+        self.assertEqual(resp.json(), {'deleted': 1})
+        self.assertFalse(any(storage.exists(name) for name in names))
+        self.assertFalse(ImageLabel.objects.filter(image_id=deleted.id).exists())
+        self.assertEqual(list(Image.objects.all()), [kept])
+        self.assertTrue(storage.exists(kept.image.name))
+
+    def test_bulk_delete_own_images(self):
+        """Test if users can only delete their own images (views.bulk_delete())"""
+        user2 = User.objects.create_user(username='user2', password='Password')
+        other = Image.objects.create(image='user2/other.png', user=user2)
+        resp = self.client.post(reverse('bulk_delete'), data={'ids': [other.id, 'x']})
+        self.assertEqual(resp.json(), {'deleted': 0})
+        resp = self.client.post(reverse('bulk_delete'), data={'all': '1'})
+        self.assertEqual(resp.json(), {'deleted': 0})
+        self.assertTrue(Image.objects.filter(id=other.id).exists())
+
+    def test_bulk_delete_all(self):
+        """Test if the whole library is deleted and the cached list invalidated once (views.bulk_delete())"""
+        self.create_library(self.user1, 3)
+        self.assertContains(self.client.get(reverse('repo')), 'An image.', count=3)
+        with mock.patch.object(pagecache, 'bump_version', wraps=pagecache.bump_version) as bump_version:
+            resp = self.client.post(reverse('bulk_delete'), data={'all': 'Delete all', 'redirect': '1'})
+        self.assertRedirects(resp, reverse('repo'))
+        bump_version.assert_called_once_with(self.user1.id)
+        self.assertFalse(Image.objects.exists())
+        self.assertNotContains(self.client.get(reverse('repo')), 'An image.')
+
+    def test_bulk_delete_all_exports(self):
+        """Test if deleting the whole library deletes the exported archives too (deletion.delete_images())"""
+        self.create_library(self.user1, 1)
+        self.client.post(reverse('export'))
+        export.run_export_worker(once=True)
+        archive = Export.objects.get().archive
+        storage = Image.image.field.storage
+        self.assertTrue(storage.exists(archive))
+        self.client.post(reverse('bulk_delete'), data={'all': '1'})
+        self.assertFalse(storage.exists(archive))
+        self.assertFalse(Export.objects.exists())
+
+    @override_settings(IMAGE_REPO_DELETE_WORKERS=2)
+    def test_s3_delete_many(self):
+        """Test if S3 files are deleted in batches of 1000 keys (storage.S3Storage.delete_many())"""
+        storage = S3Storage(access_key='key', secret_key='secret', bucket_name='bucket', region_name='us-east-2')
+        storage._bucket = mock.Mock()
+        client = storage._bucket.meta.client
+        client.delete_objects.side_effect = lambda **kwargs: (
+            {'Errors': [{'Key': 'user1/image5.png', 'Message': 'Access Denied'}]}
+            if kwargs['Delete']['Objects'][0]['Key'] == 'user1/image0.png' else {})
+        failed = storage.delete_many([f'user1/image{i}.png' for i in range(2500)])
+        self.assertEqual(failed, ['user1/image5.png'])
+        batches = [call.kwargs['Delete']['Objects'] for call in client.delete_objects.call_args_list]
+        self.assertEqual(sorted(len(batch) for batch in batches), [500, 1000, 1000])
+        self.assertTrue(all(call.kwargs['Bucket'] == 'bucket' for call in client.delete_objects.call_args_list))
+
+    # API
+    @override_settings(IMAGE_REPO_API_PAGE_SIZE=4)
+    def test_api_images_pages(self):
+        """Test if the user's images are listed newest first with a cursor (views.api_images())"""
+        library = self.create_library(self.user1, 6)
+        user2 = User.objects.create_user(username='user2', password='Password')
+        Image.objects.create(image='user2/other.png', user=user2)
+        data = self.client.get(reverse('api_images')).json()
+        self.assertEqual([image['id'] for image in data['images']], [image.id for image in library[:4]])
+        self.assertEqual(data['images'][0], {'id': library[0].id, 'description': 'An image.', 'tags': ['#image'],
+                                             'colors': ['white'], 'status': 'done'})
+        data = self.client.get(reverse('api_images'), {'before': data['next_page'], 'limit': 1}).json()
+        self.assertEqual([image['id'] for image in data['images']], [library[4].id])
+        data = self.client.get(reverse('api_images'), {'before': data['next_page'], 'limit': 1000}).json()
+        self.assertEqual([image['id'] for image in data['images']], [library[5].id])
+        self.assertIsNone(data['next_page'])
+
+    def test_api_images_fields(self):
+        """Test if only the columns of the requested fields are selected (api.image_rows())"""
+        self.client.post(reverse('repo'), data={'image': self.upload_image})
+        image = Image.objects.get()
+        with CaptureQueriesContext(connection) as queries:
+            resp = self.client.get(reverse('api_images'), {'fields': 'tags,url,srcset'})
+        self.assertNotIn('description', queries[-1]['sql'])
+        self.assertEqual(list(resp.json()['images'][0]), ['tags', 'url', 'srcset'])
+        self.assertEqual(resp.json()['images'][0]['url'], image.image.url)
+        self.assertEqual(set(resp.json()['images'][0]['srcset']), set(image.derivatives))
+        resp = self.client.get(reverse('api_images'), {'fields': 'id,user'})
+        self.assertEqual(resp.status_code, 400)
+        self.assertIn('user', resp.json()['error'])
+
+    # STORAGE
+    def test_cached_url(self):
+        """Test if storage URLs are generated once and reused (storage.CachedURLMixin())"""
+        storage = CachedURLFileSystemStorage(location=settings.MEDIA_ROOT)
+        with mock.patch.object(FileSystemStorage, 'url', return_value='/signed') as url:
+            self.assertEqual(storage.url('user1/test.png'), '/signed')
+            self.assertEqual(storage.url('user1/test.png'), '/signed')
+            self.assertEqual(url.call_count, 1)
+            storage.url('user1/other.png')
+            self.assertEqual(url.call_count, 2)
+
+    # FILE CACHE
+    def test_file_cache_lru(self):
+        """Test if the least recently used copies are evicted by total size (filecache.FileCache())"""
+        file_cache = FileCache(os.path.join(settings.MEDIA_ROOT, 'cache'), 25)
+        file_cache.put('a', [b'a' * 10])
+        file_cache.put('b', [b'b' * 10])
+        with open(file_cache.get('a'), 'rb') as file:
+            self.assertEqual(file.read(), b'a' * 10)
+        file_cache.put('c', [b'c' * 10])
+        self.assertIsNone(file_cache.get('b'))
+        self.assertIsNotNone(file_cache.get('a'))
+        self.assertEqual(file_cache.size, 20)
+        # a new process finds the copies
+        self.assertEqual(FileCache(file_cache.directory, 25).size, 20)
+        file_cache.discard('a')
+        self.assertIsNone(file_cache.get('a'))
+
+    def test_file_cache_shared(self):
+        """Test if processes sharing a directory evict by its total size (filecache.FileCache())"""
+        directory = os.path.join(settings.MEDIA_ROOT, 'cache')
+        first, second = FileCache(directory, 100), FileCache(directory, 100)
+        first.put('kept', [b'k' * 10])
+        for i in range(20):
+            (first, second)[i % 2].put(str(i), [b'x' * 10])
+            # the copy read by the other process is the most recently used one
+            self.assertIsNotNone(second.get('kept'))
+        total = sum(entry.stat().st_size for entry in os.scandir(directory) if not entry.name.startswith('.'))
+        self.assertLessEqual(total, 100 + 2 * 10)
+        self.assertIsNotNone(first.get('kept'))
+
+    def test_file_cache_stale_temp(self):
+        """Test if partial copies of killed processes are removed by a scan (filecache.FileCache())"""
+        directory = os.path.join(settings.MEDIA_ROOT, 'cache')
+        file_cache = FileCache(directory, 100)
+        stale, fresh = os.path.join(directory, '.stale.tmp'), os.path.join(directory, '.fresh.tmp')
+        for path in (stale, fresh):
+            with open(path, 'wb') as file:
+                file.write(b'x' * 1000)
+        os.utime(stale, (time.time() - filecache.STALE_TEMP_AGE - 1,) * 2)
+        for i in range(10):
+            file_cache.put(str(i), [b'x' * 10])
+        # the partial copies never count toward the limit
+        self.assertEqual(file_cache.size, 100)
+        self.assertFalse(os.path.exists(stale))
+        self.assertTrue(os.path.exists(fresh))
+
+    def test_cached_file_reads(self):
+        """Test if stored files are read from the origin once (storage.FileCacheMixin())"""
+        with override_settings(IMAGE_REPO_FILE_CACHE_DIR=os.path.join(settings.MEDIA_ROOT, 'cache')):
+            storage = CachedFileSystemStorage(location=settings.MEDIA_ROOT)
+            name = storage.save('user1/test.png', self.upload_image)
+            with mock.patch.object(FileSystemStorage, '_open', autospec=True,
+                                   side_effect=FileSystemStorage._open) as origin_open:
+                for _ in range(3):
+                    with storage.open(name, 'rb') as file:
+                        self.assertEqual(file.read(), self.upload_image.file.getvalue())
+            self.assertEqual(origin_open.call_count, 1)
+            storage.delete(name)
+            self.assertIsNone(storage.file_cache.get(name))
+            with self.assertRaises(FileNotFoundError):
+                storage.open(name, 'rb')
+
+    def test_image_file(self):
+        """Test if stored files are served with ETags and ranges (views.image_file())"""
+        name = Image.image.field.storage.save('user1/test.png', self.upload_image)
+        data = self.upload_image.file.getvalue()
+        url = reverse('image_file', args=[name])
+        resp = self.client.get(url)
+        self.assertEqual(b''.join(resp.streaming_content), data)
+        self.assertEqual(resp['Content-Type'], 'image/png')
+        etag = resp['ETag']
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        resp = self.client.get(url, HTTP_RANGE='bytes=10-19')
+        self.assertEqual(resp.status_code, 206)
+        self.assertEqual(b''.join(resp.streaming_content), data[10:20])
+        self.assertEqual(resp['Content-Range'], f'bytes 10-19/{len(data)}')
+        self.assertEqual(resp['Content-Length'], '10')
+        self.assertEqual(b''.join(self.client.get(url, HTTP_RANGE='bytes=-5').streaming_content), data[-5:])
+        # big ranges are read in chunks
+        with mock.patch('image_repo.views.RANGE_CHUNK_SIZE', 1000):
+            resp = self.client.get(url, HTTP_RANGE='bytes=100-')
+            self.assertEqual([len(chunk) for chunk in resp.streaming_content][:2], [1000, 1000])
+        self.assertEqual(self.client.get(url, HTTP_RANGE=f'bytes={len(data)}-').status_code, 416)
+        # a range of another version gets the whole file
+        self.assertEqual(self.client.get(url, HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE='"old"').status_code, 200)
+        self.assertEqual(self.client.get(reverse('image_file', args=['user1/missing.png'])).status_code, 404)
+        name = Image.image.field.storage.save('user2/test.png', self.upload_image)
+        self.assertEqual(self.client.get(reverse('image_file', args=[name])).status_code, 404)
+
+    # SEARCH
+    def create_analyzed_image(self, user, description, tags, colors):
+        """Create an analyzed and indexed image of the user"""
+        self.upload_image.seek(0)
+        new_img = Image.objects.create(image=self.upload_image, user=user, description=description,
+                                       tags=tags, colors=colors, analysis_status=Image.DONE)
+        index_image(new_img)
+        return new_img
+
+    def test_index_image(self):
+        """Test if tags and colors are normalized into labels (search.index_image())"""
+        new_img = self.create_analyzed_image(self.user1, 'A dog.', '#Dog #grass #dog', 'white black')
+        labels = set(ImageLabel.objects.filter(image=new_img).values_list('kind', 'value'))
+        self.assertEqual(labels, {('tag', 'dog'), ('tag', 'grass'), ('color', 'white'), ('color', 'black')})
+        # indexing again replaces the labels
+        index_image(new_img)
+        self.assertEqual(ImageLabel.objects.filter(image=new_img).count(), 4)
+
+    def test_search_images(self):
+        """Test if images are found by description, tags and colors (search.search_images())"""
+        dog = self.create_analyzed_image(self.user1, 'A dog lying on the grass.', '#dog #grass', 'green white')
+        cat = self.create_analyzed_image(self.user1, 'A cat on a sofa.', '#cat #indoor', 'white grey')
+        user2 = User.objects.create_user(username='user2', password='passworD')
+        self.create_analyzed_image(user2, 'A dog in the snow.', '#dog #snow', 'white')
+        self.assertEqual(list(search_images(self.user1, tags=['dog'])), [dog])
+        self.assertEqual(list(search_images(self.user1, colors=['white'])), [cat, dog])
+        self.assertEqual(list(search_images(self.user1, colors=['white'], tags=['indoor'])), [cat])
+        self.assertEqual(list(search_images(self.user1, query='dog grass')), [dog])
+        self.assertEqual(list(search_images(self.user1, query='horse')), [])
+
+    def test_search_view(self):
+        """Test if the search view shows only matching images of the user (views.search())"""
+        dog = self.create_analyzed_image(self.user1, 'A dog lying on the grass.', '#dog #grass', 'green white')
+        self.create_analyzed_image(self.user1, 'A cat on a sofa.', '#cat #indoor', 'white grey')
+        resp = self.client.get(reverse('search'), {'q': 'lying #grass'})
+        self.assertEqual(list(resp.context['images']), [dog])
+        resp = self.client.get(reverse('search'), {'color': 'green'})
+        self.assertEqual(list(resp.context['images']), [dog])
+        self.assertNotContains(resp, 'Upload')
+
+    # PAGINATION
+    def create_library(self, user, size):
+        """Create `size` analyzed images of the user without storing files"""
+        Image.objects.bulk_create([Image(image=f'{user.username}/image{i}.png', user=user, description='An image.',
+                                         tags='#image', colors='white', analysis_status=Image.DONE)
+                                   for i in range(size)])
+        # bulk_create() doesn't send post_save
+        pagecache.bump_version(user.id)
+        return list(Image.objects.filter(user=user).order_by('-id'))
+
+    @override_settings(IMAGE_REPO_PAGE_SIZE=4, IMAGE_REPO_UPLOAD_LIMIT=100)
+    def test_repo_pages(self):
+        """Test if the repo is paginated newest first with a cursor (views.get_page())"""
+        library = self.create_library(self.user1, 10)
+        resp = self.client.get(reverse('repo'))
+        self.assertEqual(resp.context['images'], library[:4])
+        self.assertEqual(resp.context['next_page'], library[3].id)
+        self.assertContains(resp, f'?before={library[3].id}')
+        resp = self.client.get(reverse('repo'), {'before': resp.context['next_page']})
+        self.assertEqual(resp.context['images'], library[4:8])
+        resp = self.client.get(reverse('repo'), {'before': resp.context['next_page']})
+        self.assertEqual(resp.context['images'], library[8:])
+        self.assertIsNone(resp.context['next_page'])
+
+    @override_settings(IMAGE_REPO_PAGE_SIZE=5, IMAGE_REPO_UPLOAD_LIMIT=1000)
+    def test_repo_queries_constant(self):
+        """Test if the repo page costs the same queries for any library size (views.repo())"""
+        self.create_library(self.user1, 6)
+        # session, user, upload limit and the page
+        with self.assertNumQueries(4):
+            self.client.get(reverse('repo'))
+        self.create_library(self.user1, 500)
+        with self.assertNumQueries(4):
+            self.client.get(reverse('repo'))
+
+    # PAGE CACHE
+    def test_repo_cached(self):
+        """Test if the image list of the repo is rendered once until the images change (pagecache.get_or_render())"""
+        image = self.create_library(self.user1, 2)[0]
+        self.client.get(reverse('repo'))
+        hits = metrics.counters().get('repo_cache_hits', 0)
+        # session, user and upload limit, the list comes from the cache
+        with self.assertNumQueries(3):
+            resp = self.client.get(reverse('repo'))
+        self.assertEqual(metrics.counters()['repo_cache_hits'], hits + 1)
+        self.assertNotIn('images', resp.context)
+        self.assertContains(resp, 'An image.', count=2)
+        # the analysis worker saving a result invalidates the list
+        image.set_analysis({'description': 'a new description.', 'tags': '#new', 'colors': 'red'})
+        image.save()
+        self.assertContains(self.client.get(reverse('repo')), 'A new description.')
+        image.delete()
+        self.assertContains(self.client.get(reverse('repo')), 'An image.', count=1)
+
+    def test_repo_cache_many_users(self):
+        """Test if the lists of hundreds of users stay cached in the database cache (pagecache.get_or_render())"""
+        with override_settings(CACHES=dict(settings.CACHES, pages=DATABASE_PAGE_CACHE)):
+            call_command('createcachetable', stdout=StringIO())
+            renders = []
+            for _ in range(2):
+                for user_id in range(600):
+                    pagecache.get_or_render(user_id, None, lambda: renders.append(user_id) or f'list {user_id}')
+            self.assertEqual(len(renders), 600)
+            self.assertEqual(pagecache.get_or_render(0, None, lambda: 'rendered again'), 'list 0')
+
+    def test_repo_cache_per_user(self):
+        """Test if users never see the cached list of another user (pagecache.get_or_render())"""
+        self.create_library(self.user1, 1)
+        self.client.get(reverse('repo'))
+        User.objects.create_user(username='user2', password='passworD')
+        self.client.login(username='user2', password='passworD')
+        resp = self.client.get(reverse('repo'))
+        self.assertEqual(resp.context['images'], [])
+        self.assertNotContains(resp, 'An image.')
+
+    # CACHED AUTH
+    @override_settings(CACHES=dict(settings.CACHES,
+                                   sessions={'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                                             'LOCATION': 'sessions'}),
+                       **auth_benchmark.CACHED_AUTH)
+    def cached_auth(self, test):
+        """Run the test in the cached auth mode (see auth.py)"""
+        auth.get_cache().clear()
+        client = Client()
+        client.login(username='user1', password='Password')
+        test(client)
+
+    def test_cached_auth_queries(self):
+        """Test if the session and the user of a page view come from the cache (auth.CachedUserBackend())"""
+        def test(client):
+            client.get(reverse('repo'))
+            with CaptureQueriesContext(connection) as queries:
+                resp = client.get(reverse('repo'))
+            self.assertEqual(resp.context['user'], self.user1)
+            tables = ' '.join(query['sql'] for query in queries)
+            self.assertNotIn('django_session', tables)
+            self.assertNotIn('auth_user', tables)
+        self.cached_auth(test)
+
+    def test_cached_user_changed(self):
+        """Test if a changed password signs the other sessions out right away (auth.user_changed())"""
+        def test(client):
+            self.assertEqual(client.get(reverse('repo')).status_code, 200)
+            self.user1.set_password('Changed')
+            self.user1.save()
+            self.assertRedirects(client.get(reverse('repo')), '/?next=/repo/')
+        self.cached_auth(test)
+
+    def test_cached_auth_enabled(self):
+        """Test if sessions signed in before the cached auth mode stay signed in (auth.CachedUserBackend())"""
+        def test(client):
+            # self.client signed in with ModelBackend in setUp()
+            self.assertEqual(self.client.get(reverse('repo')).status_code, 200)
+            with mock.patch.object(User, 'check_password', autospec=True, return_value=False) as check_password:
+                self.assertFalse(Client().login(username='user1', password='Wrong'))
+            self.assertEqual(check_password.call_count, 1)
+        self.cached_auth(test)
+
+    # TIMING
+    def test_server_timing(self):
+        """Test if responses report the time of their phases (timing.timing_middleware())"""
+        resp = self.client.get(reverse('repo'))
+        phases = dict(entry.split(';', 1) for entry in resp['Server-Timing'].split(', '))
+        self.assertIn('db', phases)
+        self.assertIn('render', phases)
+        self.assertIn('total', phases)
+
+    def test_metrics_view(self):
+        """Test if the metrics are served to staff and the scraper only (views.metrics_view())"""
+        self.client.get(reverse('repo'))
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 403)
+        with override_settings(IMAGE_REPO_METRICS_TOKEN='secret'):
+            self.assertEqual(Client().get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+            resp = Client().get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer secret')
+        self.assertContains(resp, 'image_repo_repo_cache_misses_total')
+        self.assertContains(resp, 'image_repo_repo_cache_hit_ratio')
+        self.assertContains(resp, 'image_repo_request_seconds_bucket{view="repo",le="+Inf"}')
+        self.assertContains(resp, 'image_repo_phase_seconds_count{phase="db"}')
+        self.user1.is_staff = True
+        self.user1.save()
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 200)
+
+    def test_prometheus_histogram(self):
+        """Test if histogram buckets are cumulative (metrics.prometheus_text())"""
+        metrics.observe('test_seconds', 0.003, case='a')
+        metrics.observe('test_seconds', 2, case='a')
+        text = metrics.prometheus_text()
+        self.assertIn('test_seconds_bucket{case="a",le="0.001"} 0', text)
+        self.assertIn('test_seconds_bucket{case="a",le="0.005"} 1', text)
+        self.assertIn('test_seconds_bucket{case="a",le="+Inf"} 2', text)
+        self.assertIn('test_seconds_count{case="a"} 2', text)
+
+    @override_settings(IMAGE_REPO_UPLOAD_LIMIT=3)
+    def test_upload_limit(self):
+        """Test if uploads over the limit are refused (views.upload_limit_reached())"""
+        self.create_library(self.user1, 2)
+        resp = self.client.get(reverse('repo'))
+        self.assertIn('form', resp.context)
+        self.client.post(reverse('repo'), data={'image': self.upload_image})
+        resp = self.client.get(reverse('repo'))
+        self.assertNotIn('form', resp.context)
+        self.upload_image.seek(0)
+        resp = self.client.post(reverse('repo'), data={'image': self.upload_image})
+        self.assertEqual(resp.context['error'], "You've reached your upload limit.")
+        self.assertEqual(Image.objects.filter(user=self.user1).count(), 3)
+
+    # BULK UPLOAD
+    def get_upload_images(self, count):
+        """Return `count` uploadable copies of the test image"""
+        data = self.upload_image.file.getvalue()
+        return [SimpleUploadedFile(f'test{i}.png', data) for i in range(count)]
+
+    def test_bulk_upload(self):
+        """Test if every file of a bulk upload is reported (views.bulk_upload())"""
+        files = self.get_upload_images(2) + [SimpleUploadedFile('notes.txt', b'not an image')]
+        resp = self.client.post(reverse('bulk_upload'), data={'images': files})
+        results = resp.json()['results']
+        self.assertEqual([result['name'] for result in results], ['test0.png', 'test1.png', 'notes.txt'])
+        self.assertEqual(set(Image.objects.filter(user=self.user1).values_list('id', flat=True)),
+                         {results[0]['id'], results[1]['id']})
+        self.assertIn('valid image', results[2]['error'])
+        new_img = Image.objects.get(id=results[0]['id'])
+        self.assertEqual(new_img.image.name, 'user1/test0.png')
+        self.assertEqual(list(new_img.derivatives), ['400'])
+        self.assertTrue(new_img.image.storage.exists(new_img.image.name))
+
+    @override_settings(IMAGE_REPO_UPLOAD_LIMIT=3)
+    def test_bulk_upload_limit(self):
+        """Test if a bulk upload stops at the upload limit (views.repo())"""
+        self.create_library(self.user1, 1)
+        resp = self.client.post(reverse('repo'), data={'image': self.get_upload_images(3)})
+        self.assertEqual([result.get('error') for result in resp.context['results']],
+                         [None, None, "You've reached your upload limit."])
+        self.assertEqual(Image.objects.filter(user=self.user1).count(), 3)
+
+    # UPLOAD INSPECTION
+    def test_upload_inspector(self):
+        """Test if format and dimensions are read from the first chunk (uploadhandlers.UploadInspector)"""
+        data = self.upload_image.file.getvalue()
+        inspector = UploadInspector()
+        inspector.update(data[:1024])
+        self.assertEqual(tuple(inspector.image_info), ('PNG', 576, 576))
+        inspector.update(data[1024:])
+        self.assertEqual(inspector.content_hash, hashlib.sha256(data).hexdigest())
+
+    def test_sniffed_image_field(self):
+        """Test if inspected uploads are not decoded again (forms.SniffedImageField)"""
+        inspector = UploadInspector()
+        inspector.update(self.upload_image.file.getvalue())
+        self.upload_image.image_info = inspector.image_info
+        with mock.patch('PIL.Image.open') as pillow_open:
+            file = SniffedImageField().clean(self.upload_image)
+        pillow_open.assert_not_called()
+        self.assertEqual(file.content_type, 'image/png')
+
+    @override_settings(FILE_UPLOAD_MAX_MEMORY_SIZE=1000)
+    def test_big_upload_inspected_once(self):
+        """Test if uploads streamed to a temporary file are inspected by one handler (uploadhandlers.InspectingMixin)"""
+        fed = []
+        update = UploadInspector.update
+        with mock.patch.object(UploadInspector, 'update', autospec=True,
+                               side_effect=lambda inspector, chunk: fed.append(len(chunk)) or update(inspector, chunk)):
+            self.client.post(reverse('repo'), data={'image': self.upload_image})
+        self.assertEqual(sum(fed), len(self.upload_image.file.getvalue()))
+        self.assertEqual(Image.objects.get().content_hash,
+                         hashlib.sha256(self.upload_image.file.getvalue()).hexdigest())
+
+    @override_settings(IMAGE_REPO_MAX_UPLOAD_SIZE=10000)
+    def test_upload_too_big(self):
+        """Test if files over the size limit are skipped while streaming in (views.repo())"""
+        resp = self.client.post(reverse('repo'), data={'image': self.upload_image})
+        self.assertEqual(resp.context['error'], 'The file is bigger than 9.8\xa0KB.')
+        self.assertFalse(Image.objects.exists())
+
+    def test_upload_not_image(self):
+        """Test if files without an image header are refused (views.repo(), views.bulk_upload())"""
+        # big files are skipped once the header is read, small ones fail form validation
+        big = SimpleUploadedFile('big.png', b'not an image' * 30000)
+        resp = self.client.post(reverse('bulk_upload'), data={'images': [big] + self.get_upload_images(1)})
+        self.assertEqual([result['name'] for result in resp.json()['results']], ['test0.png', 'big.png'])
+        self.assertIn('valid image', resp.json()['results'][1]['error'])
+        resp = self.client.post(reverse('repo'), data={'image': SimpleUploadedFile('small.png', b'not an image')})
+        self.assertIn('valid image', str(resp.context['form'].errors))
+        self.assertEqual(Image.objects.filter(user=self.user1).count(), 1)
+
+    def test_upload_truncated(self):
+        """Test if files with a valid header but cut off are refused and their files deleted (uploads.store_file())"""
+        data = self.upload_image.file.getvalue()
+        resp = self.client.post(reverse('repo'), data={'image': SimpleUploadedFile('cut.png', data[:len(data) // 2])})
+        self.assertIn('valid image', resp.context['error'])
+        cut = SimpleUploadedFile('cut.png', data[:len(data) // 2])
+        resp = self.client.post(reverse('bulk_upload'), data={'images': [cut] + self.get_upload_images(1)})
+        self.assertIn('valid image', resp.json()['results'][0]['error'])
+        # only the files of the image that was saved are left
+        new_img = Image.objects.get(user=self.user1)
+        self.assertEqual(sorted(os.listdir(os.path.join(settings.MEDIA_ROOT, 'user1'))),
+                         sorted(os.path.basename(name) for name in [new_img.image.name, *new_img.derivatives.values()]))
+
+    # DIRECT UPLOAD
+    def test_direct_upload(self):
+        """Test if a browser can upload straight to storage and register the image (views.direct_upload())"""
+        target = self.client.post(reverse('direct_upload'), {'filename': 'test.png'}).json()
+        self.assertTrue(target['key'].startswith('direct-uploads/user1/'))
+        # concurrent uploads of a file name get keys of their own
+        self.assertNotEqual(self.client.post(reverse('direct_upload'), {'filename': 'test.png'}).json()['key'],
+                            target['key'])
+        # the browser posts the file with the signed fields, without the session
+        upload = Client().post(target['url'], dict(target['fields'], file=self.upload_image))
+        self.assertEqual(upload.status_code, 204)
+        resp = self.client.post(reverse('direct_upload_confirm'), {'key': target['key']})
+        new_img = Image.objects.get(id=resp.json()['id'])
+        self.assertEqual(new_img.image.name, 'user1/test.png')
+        self.assertEqual(new_img.analysis_status, Image.PENDING)
+        self.assertEqual(new_img.content_hash, hashlib.sha256(self.upload_image.file.getvalue()).hexdigest())
+        self.assertEqual(list(new_img.derivatives), ['400'])
+        self.assertFalse(Image.image.field.storage.exists(target['key']))
+        # a file can be registered once
+        resp = self.client.post(reverse('direct_upload_confirm'), {'key': target['key']})
+        self.assertEqual(resp.status_code, 400)
+        # posting again with the same fields can't replace the registered file
+        Client().post(target['url'], dict(target['fields'], file=SimpleUploadedFile('test.png', b'text')))
+        with new_img.image.open('rb') as file:
+            self.assertEqual(file.read(), self.upload_image.file.getvalue())
+
+    def test_direct_upload_refused(self):
+        """Test if direct uploads need a valid token and stay in the user's folder (views.direct_upload_local())"""
+        target = self.client.post(reverse('direct_upload'), {'filename': 'test.png'}).json()
+        fields = dict(target['fields'], key='user2/test.png', file=self.upload_image)
+        self.assertEqual(Client().post(target['url'], fields).status_code, 403)
+        Image.image.field.storage.save('user1/test.png', self.upload_image)
+        for key in ['user1/test.png', target['key'].replace('user1', 'user2'), target['key'] + '/../test.png']:
+            resp = self.client.post(reverse('direct_upload_confirm'), {'key': key})
+            self.assertEqual(resp.json()['error'], 'Invalid upload.')
+        resp = self.client.post(reverse('direct_upload_confirm'), {'key': target['key']})
+        self.assertEqual(resp.json()['error'], 'The file was not uploaded.')
+
+    def test_direct_upload_not_image(self):
+        """Test if files that aren't images are removed at confirmation (uploads.register_direct_upload())"""
+        target = self.client.post(reverse('direct_upload'), {'filename': 'notes.png'}).json()
+        Client().post(target['url'], dict(target['fields'], file=SimpleUploadedFile('notes.png', b'text')))
+        resp = self.client.post(reverse('direct_upload_confirm'), {'key': target['key']})
+        self.assertEqual(resp.status_code, 400)
+        self.assertFalse(Image.image.field.storage.exists(target['key']))
+        self.assertFalse(Image.image.field.storage.exists('user1/notes.png'))
+
+    def test_direct_upload_failed(self):
+        """Test if direct uploads that fail after the move leave no files behind (uploads.register_direct_upload())"""
+        data = self.upload_image.file.getvalue()
+        for file, error in [(SimpleUploadedFile('cut.png', data[:len(data) // 2]), 'valid image'),
+                            (self.upload_image, 'Some error occurred')]:
+            target = self.client.post(reverse('direct_upload'), {'filename': file.name}).json()
+            Client().post(target['url'], dict(target['fields'], file=file))
+            # the original is stored, the derivatives are not
+            with mock.patch('image_repo.imaging.PILImage.Image.save', side_effect=OSError('No space left')):
+                resp = self.client.post(reverse('direct_upload_confirm'), {'key': target['key']})
+            self.assertEqual(resp.status_code, 400)
+            self.assertIn(error, resp.json()['error'])
+            self.assertFalse(Image.image.field.storage.exists(target['key']))
+        self.assertEqual(os.listdir(os.path.join(settings.MEDIA_ROOT, 'user1')), [])
+        self.assertFalse(Image.objects.exists())
+
+    def test_s3_presigned_post(self):
+        """Test if the bucket's presigned POST is limited to the key and size (storage.S3Storage())"""
+        storage = S3Storage(access_key='key', secret_key='secret', bucket_name='bucket', region_name='us-east-2')
+        target = storage.presigned_post('user1/test.png', 1024, 60)
+        self.assertIn('bucket', target['url'])
+        self.assertEqual(target['fields']['key'], 'user1/test.png')
+        self.assertIn('policy', target['fields'])
+        with mock.patch.object(storage.bucket.meta.client, 'copy_object') as copy_object:
+            storage.copy('direct-uploads/user1/key/test.png', 'user1/test.png')
+        copy_object.assert_called_once_with(Bucket='bucket', Key='user1/test.png',
+                                            CopySource={'Bucket': 'bucket', 'Key': 'direct-uploads/user1/key/test.png'})
+
+    # ASYNC
+    def test_run_async_worker(self):
+        """Test if the async worker fills in the analysis of pending images (jobs.run_async_worker())"""
+        for i in range(3):
+            Image.objects.create(image=SimpleUploadedFile(f'test{i}.png', bytes([i]) * 10), user=self.user1)
+        with mock.patch('image_repo.jobs.prepare_for_analysis', side_effect=lambda data: data):
+            processed = async_to_sync(run_async_worker)(concurrency=2, once=True, analyzer=fake_async_analyzer)
+        self.assertEqual(processed, 3)
+        self.assertFalse(Image.objects.exclude(analysis_status=Image.DONE).exists())
+        self.assertEqual(ImageLabel.objects.filter(user=self.user1, value='test').count(), 3)
+
+    def test_azure_cv_api_async(self):
+        """Test if the async client parses the analysis result (analysis.azure_cv_api_async())"""
+        with StubAzureServer() as server, \
+                mock.patch.dict(os.environ, {'AZURE_CV_KEY': 'key', 'AZURE_CV_ENDPOINT': server.endpoint}):
+            result = async_to_sync(analysis.azure_cv_api_async)(b'image')
+        self.assertEqual(result['tags'], '#stub #image')
@@ -0,0 +1,56 @@
+"""
+Per-request timing of the phases recorded by metrics.timed() (Server-Timing header and histograms).
+
+Phases timed in sync_to_async() threads count toward the request, because the
+context is handed over with the call. Work submitted to other thread pools
+(bulk uploads, batched storage deletes) only feeds the histograms.
+"""
+import asyncio
+import time
+
+from django.conf import settings
+from django.utils.decorators import sync_and_async_middleware
+
+from . import metrics
+
+
+def server_timing(timings, total):
+    """Return the Server-Timing header value of the phase timings"""
+    entries = [f'{phase};desc="{calls} calls";dur={seconds * 1000:.1f}'
+               for phase, (seconds, calls) in sorted(timings.items())]
+    entries.append(f'total;dur={total * 1000:.1f}')
+    return ', '.join(entries)
+
+
+def finish_request(request, response, timings, start):
+    """Record the request duration and add the Server-Timing header"""
+    total = time.perf_counter() - start
+    match = request.resolver_match
+    metrics.observe('image_repo_request_seconds', total, view=match.url_name if match else 'none')
+    if settings.IMAGE_REPO_SERVER_TIMING:
+        response['Server-Timing'] = server_timing(timings, total)
+    return response
+
+
+@sync_and_async_middleware
+def timing_middleware(get_response):
+    """Time every request and the phases it spends in (database, Azure, storage, rendering, ...)"""
+    if asyncio.iscoroutinefunction(get_response):
+        async def middleware(request):
+            start = time.perf_counter()
+            timings, token = metrics.start_request()
+            try:
+                response = await get_response(request)
+            finally:
+                metrics.end_request(token)
+            return finish_request(request, response, timings, start)
+    else:
+        def middleware(request):
+            start = time.perf_counter()
+            timings, token = metrics.start_request()
+            try:
+                response = get_response(request)
+            finally:
+                metrics.end_request(token)
+            return finish_request(request, response, timings, start)
+    return middleware
@@ -0,0 +1,97 @@
+"""
+Upload handlers that inspect files in the same pass that streams them in.
+
+While the chunks arrive, the SHA-256 of the bytes is computed, the format and
+dimensions are read from the header bytes and the size limit is enforced. The
+results are stored on the uploaded file (`content_hash` and `image_info`), so
+the analysis cache and forms.SniffedImageField don't read the file again.
+Files that can't be accepted are skipped as soon as that is known and listed
+in `request.skipped_uploads`.
+"""
+import hashlib
+
+from django import forms
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.files.uploadhandler import MemoryFileUploadHandler, SkipFile, TemporaryFileUploadHandler
+from django.template.defaultfilters import filesizeformat
+from PIL import Image as PILImage
+
+from .imaging import sniff_image
+
+# the format and dimensions must be known within this many first bytes
+SNIFF_BYTES = 256 * 1024
+
+
+class UploadInspector:
+    """Hash, size limit and format sniffing of a file fed chunk by chunk"""
+
+    def __init__(self):
+        self.hasher = hashlib.sha256()
+        self.header = b''
+        self.image_info = None
+        self.size = 0
+
+    def update(self, chunk):
+        """Feed the next chunk, raise ValidationError as soon as the file can't be accepted"""
+        self.size += len(chunk)
+        if self.size > settings.IMAGE_REPO_MAX_UPLOAD_SIZE:
+            raise ValidationError(f'The file is bigger than {filesizeformat(settings.IMAGE_REPO_MAX_UPLOAD_SIZE)}.')
+        self.hasher.update(chunk)
+        if self.image_info is None:
+            # the first chunk is used as it is, later ones are only copied if the header is longer
+            self.header = self.header + chunk[:SNIFF_BYTES - len(self.header)] if self.header else chunk[:SNIFF_BYTES]
+            try:
+                self.image_info = sniff_image(self.header)
+            except PILImage.DecompressionBombError:
+                raise ValidationError('The image has too many pixels.')
+            if self.image_info is not None:
+                self.header = b''
+            elif len(self.header) >= SNIFF_BYTES:
+                raise ValidationError(forms.ImageField.default_error_messages['invalid_image'])
+
+    @property
+    def content_hash(self):
+        return self.hasher.hexdigest()
+
+
+def skipped_uploads(request):
+    """Return [{'name': ..., 'error': ...}] of the files of the request that were skipped"""
+    return getattr(request, 'skipped_uploads', [])
+
+
+class InspectingMixin:
+    def new_file(self, *args, **kwargs):
+        # set before super() as MemoryFileUploadHandler raises StopFutureHandlers
+        self.inspector = UploadInspector()
+        super().new_file(*args, **kwargs)
+
+    def receive_data_chunk(self, raw_data, start):
+        # requests too big for memory pass the chunks through the inactive memory handler first,
+        # they are inspected once, by the temporary file handler
+        if not getattr(self, 'activated', True):
+            return super().receive_data_chunk(raw_data, start)
+        try:
+            self.inspector.update(raw_data)
+        except ValidationError as e:
+            if self.request is not None:
+                self.request.skipped_uploads = skipped_uploads(self.request) + [
+                    {'name': self.file_name, 'error': ' '.join(e.messages)}]
+            # the rest of the file is read from the request but not kept
+            raise SkipFile
+        return super().receive_data_chunk(raw_data, start)
+
+    def file_complete(self, file_size):
+        file = super().file_complete(file_size)
+        if file is not None:
+            file.content_hash = self.inspector.content_hash
+            file.image_info = self.inspector.image_info
+        return file
+
+
+class InspectingMemoryFileUploadHandler(InspectingMixin, MemoryFileUploadHandler):
+    """Keep small uploads in memory and inspect them"""
+
+
+class InspectingTemporaryFileUploadHandler(InspectingMixin, TemporaryFileUploadHandler):
+    """Stream big uploads to a temporary file and inspect them"""
@@ -0,0 +1,154 @@
+"""
+Storing uploaded images.
+
+Storage writes and derivatives don't touch the database, so bulk uploads run
+them concurrently on a thread pool and save the Image rows in the request thread.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import posixpath
+from django import forms
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.files import File
+
+from . import metrics, pagecache, palettes
+from .analysis import analysis_cache
+from .colors import image_palette
+from .deletion import delete_stored_files, stored_names
+from .duplicates import add_to_index, find_duplicate, image_hash
+from .forms import SniffedImageField
+from .imaging import decode, save_derivatives
+from .models import Image
+from .search import index_image
+from .storage import move
+from .uploadhandlers import UploadInspector
+
+
+def store_file(image, file):
+    """Write the uploaded file and its derivatives to storage (no database access)"""
+    # the upload handler hashed the file while it was streaming in
+    image.content_hash = getattr(file, 'content_hash', '')
+    with metrics.timed('storage'):
+        image.image.save(file.name, file, save=False)
+    try:
+        file.seek(0)
+        derive(image, file)
+    except Exception:
+        # nothing points to the stored files
+        delete_files(image)
+        raise
+    return image
+
+
+def derive(image, file):
+    """Store the derivatives of the image file and compute its hash and palette, decoding it once"""
+    # downscaled copies for srcset, stored next to the original
+    with metrics.timed('derivatives'):
+        try:
+            img, widths = decode(file)
+        except Exception as e:
+            # the upload handler only read the header, a truncated or corrupt file fails here
+            raise ValidationError(forms.ImageField.default_error_messages['invalid_image'],
+                                  code='invalid_image') from e
+        smallest = save_derivatives(image, img, widths)
+    # the hash and the palette only need a small sample of the pixels
+    with metrics.timed('phash'):
+        image.phash = image_hash(smallest)
+    with metrics.timed('palette'):
+        image.palette = image_palette(smallest)
+
+
+def delete_files(image):
+    """Delete the stored original and derivatives of an image that isn't saved"""
+    delete_stored_files(image.image.storage, stored_names(image.image.name, image.derivatives))
+
+
+def register_image(image):
+    """Save a stored image, with the analysis right away if the same content or a near-duplicate was analyzed"""
+    try:
+        version = pagecache.get_version(image.user_id)
+        duplicate = find_duplicate(image, version)
+        if duplicate is not None and settings.IMAGE_REPO_REJECT_DUPLICATES:
+            raise ValidationError('You already uploaded this image.')
+        image.duplicate_of = duplicate
+        result = analysis_cache.get(image.content_hash)
+        if result is None and duplicate is not None and duplicate.analysis_status == Image.DONE:
+            # a resized or recompressed copy is described like the original
+            result = {'description': duplicate.description, 'tags': duplicate.tags, 'colors': duplicate.colors}
+        if result is not None:
+            image.set_analysis(result)
+        # otherwise the analysis worker (jobs.py) fills in description, tags and colors later
+        image.save()
+    except Exception:
+        # the stored files of an image that wasn't saved
+        delete_files(image)
+        raise
+    add_to_index(image, version)
+    palettes.add_to_index(image, version)
+    if result is not None:
+        index_image(image)
+    return image
+
+
+def validate_and_store(image, file):
+    """Check that the file is an image and store it (runs in a pool thread)"""
+    file = SniffedImageField().clean(file)
+    return store_file(image, file)
+
+
+def save_uploads(user, files, remaining):
+    """Store up to `remaining` files concurrently and register them, return a result for every file"""
+    results = [{'name': file.name} for file in files]
+    futures = []
+    with ThreadPoolExecutor(max_workers=settings.IMAGE_REPO_UPLOAD_WORKERS) as pool:
+        for result, file in zip(results, files):
+            if len(futures) < remaining:
+                futures.append((result, pool.submit(validate_and_store, Image(user=user), file)))
+            else:
+                result['error'] = "You've reached your upload limit."
+        for result, future in futures:
+            try:
+                image = register_image(future.result())
+                result['id'] = image.id
+                if image.duplicate_of_id is not None:
+                    result['duplicate_of'] = image.duplicate_of_id
+            except ValidationError as e:
+                result['error'] = ' '.join(e.messages)
+            except Exception as e:
+                print(e)
+                result['error'] = 'Some error occurred. Kindly try again.'
+    return results
+
+
+def register_direct_upload(user, staged):
+    """Register a file the browser uploaded straight to storage at a staging key, return the Image"""
+    image = Image(user=user)
+    field = Image.image.field
+    storage = field.storage
+    # the name the upload would get in views.repo(), the checks below read the moved file
+    name = storage.get_available_name(field.generate_filename(image, posixpath.basename(staged)),
+                                      max_length=field.max_length)
+    try:
+        name = image.image.name = move(storage, staged, name)
+        with storage.open(name, 'rb') as file:
+            # the bytes never passed through the app, inspect them from storage
+            inspector = UploadInspector()
+            for chunk in File(file).chunks():
+                inspector.update(chunk)
+            image.content_hash = inspector.content_hash
+            file.seek(0)
+            checked = File(file, name=name)
+            checked.image_info = inspector.image_info
+            SniffedImageField().clean(checked)
+            file.seek(0)
+            derive(image, file)
+    except Exception as e:
+        # nothing else points to the moved file and the derivatives stored so far,
+        # a staged file that wasn't moved expires with the staging folder
+        if image.image.name:
+            delete_files(image)
+        if isinstance(e, ValidationError):
+            raise
+        print(e)
+        raise ValidationError('Some error occurred. Kindly try again.') from e
+    return register_image(image)
@@ -1,17 +1,43 @@
+import functools
+import mimetypes
 import os
+import posixpath
+import re
 
+from asgiref.sync import sync_to_async
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.forms import UserCreationForm, AuthenticationForm
 from django.contrib.auth.models import User
 from django.contrib.auth.password_validation import validate_password, ValidationError
 from django.contrib.auth.validators import UnicodeUsernameValidator
+from django.contrib.auth.views import redirect_to_login
+from django.conf import settings
 from django.db import IntegrityError
-from django.shortcuts import redirect, render
-import requests
+from django.http import FileResponse, Http404, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.shortcuts import get_object_or_404, redirect, render, resolve_url
+from django.template.loader import render_to_string
+from django.utils.cache import get_conditional_response
+from django.utils.crypto import constant_time_compare
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
 
+from . import api, metrics, pagecache, palettes
+from .analysis import azure_circuit
+from .deletion import delete_images
+from .duplicates import similar_images
+from .export import EXPORTS_FOLDER, request_export
 from .forms import ImageForm
-from .models import Image
+from .models import Export, Image
+from .search import search_images
+from .storage import check_direct_upload_token, is_staging_name, open_local, presigned_post, staging_name
+from .uploadhandlers import skipped_uploads
+from .uploads import register_direct_upload, register_image, save_uploads, store_file
+
+# a single range of the Range header of image_file(), the first or the last byte may be omitted
+BYTE_RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+# bytes read at a time when a range of a file is sent
+RANGE_CHUNK_SIZE = 64 * 1024
 
 
 def homepage(request):
@@ -30,7 +56,6 @@ def user_sign_up(request):
                 UnicodeUsernameValidator(request.POST.get('username'))
                 validate_password(request.POST.get('password1'))
                 user = User.objects.create_user(request.POST.get('username'), password=request.POST.get('password1'))
-                user.save()
                 login(request, user)
                 # if user signed up, log him in and show the repo
                 return redirect('repo')
@@ -70,70 +95,336 @@ def user_sign_out(request):
         return redirect('homepage')
 
 
-@login_required(login_url='homepage')
-def repo(request):
+def upload_limit_reached(user):
+    """Check if the user has IMAGE_REPO_UPLOAD_LIMIT images, without counting all of them"""
+    limit = settings.IMAGE_REPO_UPLOAD_LIMIT
+    return Image.objects.filter(user=user).order_by('-id')[limit - 1:limit].exists()
+
+
+def get_cursor(request):
+    """Return the `before` cursor of the request, None on the first page"""
+    before = request.GET.get('before', '')
+    return int(before) if before.isdigit() else None
+
+
+def get_page(request, images):
+    """Return a page of images (newest first) older than the `before` cursor and the cursor of the next page"""
+    # keyset pagination over the (user, -id) index, the cost doesn't grow with the library
+    before = get_cursor(request)
+    if before is not None:
+        images = images.filter(id__lt=before)
+    page_size = settings.IMAGE_REPO_PAGE_SIZE
+    page = list(images.order_by('-id')[:page_size + 1])
+    if len(page) > page_size:
+        return page[:page_size], page[page_size - 1].id
+    return page, None
+
+
+def render_images(request):
+    """Render the list of a page of the user's images"""
+    images, next_page = get_page(request, Image.objects.filter(user=request.user))
+    # signing the image URLs is part of rendering
+    with metrics.timed('render'):
+        return render_to_string('image_repo/images.html', {'images': images, 'next_page': next_page}, request)
+
+
+def render_repo(request, version=None, **context):
+    """Render the repo page with a page of the user's images and the upload form if under the limit"""
+    # the list is rendered again only after the user's images change
+    context['images_html'] = pagecache.get_or_render(request.user.id, get_cursor(request),
+                                                     lambda: render_images(request), version)
+    context['direct_uploads'] = settings.IMAGE_REPO_DIRECT_UPLOADS
+    if not upload_limit_reached(request.user):
+        context.setdefault('form', ImageForm())
+    with metrics.timed('render'):
+        return render(request, 'image_repo/repo.html', context)
+
+
+def async_login_required(view):
+    """login_required(login_url='homepage') for async views, Django's decorator only wraps sync views"""
+    @functools.wraps(view)
+    async def wrapped_view(request, *args, **kwargs):
+        # request.user loads the session and the user from the database
+        if await sync_to_async(lambda: request.user.is_authenticated)():
+            return await view(request, *args, **kwargs)
+        return redirect_to_login(request.get_full_path(), resolve_url('homepage'))
+    return wrapped_view
+
+
+@async_login_required
+async def repo(request):
     """User Image Repo view"""
+    # database access goes through sync_to_async, storage writes and image
+    # validation run in other threads so the event loop is never blocked
     # open sign up page
     if request.method == 'GET':
-        # pass all user's images and data to the template
-        images = Image.objects.filter(user=request.user).order_by('id').reverse()
-        # limit number of uploads to 5
-        if len(images) >= 5:
-            return render(request, 'image_repo/repo.html', {'images': images})
-        return render(request, 'image_repo/repo.html', {'form': ImageForm(), 'images': images})
+        # pass a page of user's images and data to the template
+        return await sync_to_async(render_repo)(request)
     else:  # upload an image (POST method)
+        if await sync_to_async(upload_limit_reached)(request.user):
+            return await sync_to_async(render_repo)(request, error="You've reached your upload limit.")
+        files = await sync_to_async(request.FILES.getlist, thread_sensitive=False)('image')
+        # files the upload handlers refused (too big, not an image) are not in request.FILES
+        skipped = skipped_uploads(request)
+        # several files are stored concurrently, see bulk_upload()
+        if len(files) + len(skipped) > 1:
+            results = await sync_to_async(save_bulk_upload)(request, 'image')
+            return await sync_to_async(render_repo)(request, results=results)
+        if skipped:
+            return await sync_to_async(render_repo)(request, error=skipped[0]['error'])
         form = ImageForm(request.POST, request.FILES)
-        if form.is_valid():
+        if await sync_to_async(form.is_valid, thread_sensitive=False)():
             try:
-                # get the uploaded image from the form and save all data to the database
-                file = form.cleaned_data.get('image')
-                # analyze image with Azure Computer Vision API
-                result = azure_cv_api(file)
-                colors = ''
-                description = ''
-                tags = ''
-                if result is not None:
-                    colors = result['colors']
-                    description = result['description'].capitalize()
-                    tags = result['tags']
-                image_object = Image.objects.create(
-                    image=file,
-                    user=request.user,
-                    description=description,
-                    tags=tags,
-                    colors=colors
-                )
-                image_object.save()
-                # pass all user's images and data to the template
-                images = Image.objects.filter(user=request.user).order_by('id').reverse()
-                # limit number of uploads to 5
-                if len(images) >= 5:
-                    return render(request, 'image_repo/repo.html', {'images': images})
-                return render(request, 'image_repo/repo.html', {'images': images, 'form': ImageForm()})
+                # get the uploaded image from the form, store it and save all data to the database
+                image_object = Image(user=request.user)
+                await sync_to_async(store_file, thread_sensitive=False)(image_object, form.cleaned_data.get('image'))
+                await sync_to_async(register_image)(image_object)
+                # pass a page of user's images and data to the template, the list changed with the upload
+                return await sync_to_async(render_repo)(request, image_object.list_version)
+            except ValidationError as e:
+                # a near-duplicate when they are rejected
+                return await sync_to_async(render_repo)(request, error=' '.join(e.messages))
             except:
-                return render(request, 'image_repo/repo.html', {'form': ImageForm(),
-                                                                'error': 'Some error occurred. Kindly try again.'})
-
-
-def azure_cv_api(img):
-    """Helper func to call Azure Computer Vision API from repo view"""
-    api_key = os.environ['AZURE_CV_KEY']
-    endpoint = os.environ['AZURE_CV_ENDPOINT']
-    req_url = endpoint + "vision/v3.2/analyze"
-    headers = {'Ocp-Apim-Subscription-Key': api_key,
-               'Content-Type': 'application/octet-stream'}
-    params = {'visualFeatures': 'Description,Color'}
+                return await sync_to_async(render)(request, 'image_repo/repo.html', {
+                    'form': ImageForm(), 'error': 'Some error occurred. Kindly try again.'})
+        # show the errors of the form
+        return await sync_to_async(render_repo)(request, form=form)
+
+
+def save_bulk_upload(request, field):
+    """Store all files of the request field up to the upload limit, the skipped files are reported last"""
+    remaining = settings.IMAGE_REPO_UPLOAD_LIMIT - Image.objects.filter(user=request.user).count()
+    return save_uploads(request.user, request.FILES.getlist(field), remaining) + skipped_uploads(request)
+
+
+@login_required(login_url='homepage')
+@require_POST
+def bulk_upload(request):
+    """Upload many images in one request, the response reports every file (JSON)"""
+    return JsonResponse({'results': save_bulk_upload(request, 'images')})
+
+
+@login_required(login_url='homepage')
+@require_POST
+def direct_upload(request):
+    """Hand out a presigned POST for uploading an image straight to storage (JSON)"""
+    filename = os.path.basename(request.POST.get('filename', ''))
+    if not filename:
+        return JsonResponse({'error': 'Choose a file to upload.'}, status=400)
+    if upload_limit_reached(request.user):
+        return JsonResponse({'error': "You've reached your upload limit."}, status=403)
+    # the file is posted to a key of its own, moved to the user's folder once it is checked
+    # (uploads.register_direct_upload()), the POST can't replace the registered file
+    storage = Image.image.field.storage
+    name = staging_name(request.user.username, storage.get_valid_name(filename))
+    return JsonResponse(dict(presigned_post(storage, name), key=name))
+
+
+@login_required(login_url='homepage')
+@require_POST
+def direct_upload_confirm(request):
+    """Register an image uploaded straight to storage and queue its analysis (JSON)"""
+    key = request.POST.get('key', '')
+    # users can only register their own uploads, a staged file is moved away when it is registered
+    if not is_staging_name(key, request.user.username):
+        return JsonResponse({'error': 'Invalid upload.'}, status=400)
+    if upload_limit_reached(request.user):
+        return JsonResponse({'error': "You've reached your upload limit."}, status=403)
+    if not Image.image.field.storage.exists(key):
+        return JsonResponse({'error': 'The file was not uploaded.'}, status=400)
     try:
-        response = requests.post(req_url, headers=headers, params=params, data=img)
-        response.raise_for_status()
-        results = response.json()
-        description = results['description']['captions'][0]['text']+'.'
-        tags = '#'+' #'.join(results['description']['tags'])
-        colors = ' '.join(results['color']['dominantColors']).lower()
-        result_dict = dict()
-        result_dict['description'] = description
-        result_dict['tags'] = tags
-        result_dict['colors'] = colors
-        return result_dict
-    except Exception as e:
-        print(e)
+        image_object = register_direct_upload(request.user, key)
+    except ValidationError as e:
+        return JsonResponse({'error': ' '.join(e.messages)}, status=400)
+    return JsonResponse({'id': image_object.id})
+
+
+@csrf_exempt
+@require_POST
+def direct_upload_local(request):
+    """Stand-in for the bucket's presigned POST endpoint when files are stored locally"""
+    # the signed token authorizes the upload like the bucket policy does
+    key = request.POST.get('key', '')
+    max_size = check_direct_upload_token(request.POST.get('token', ''), key)
+    file = request.FILES.get('file')
+    if max_size is None or file is None or file.size > max_size:
+        return HttpResponse(status=403)
+    storage = Image.image.field.storage
+    name = storage.save(key, file)
+    if name != key:
+        storage.delete(name)
+        return HttpResponse(status=409)
+    return HttpResponse(status=204)
+
+
+@login_required(login_url='homepage')
+def search(request):
+    """User Image Repo search view"""
+    # words starting with # are tags, the rest is searched in descriptions
+    words = request.GET.get('q', '').split()
+    tags = [word.lstrip('#') for word in words if word.startswith('#')] + request.GET.getlist('tag')
+    query = ' '.join(word for word in words if not word.startswith('#'))
+    images, next_page = get_page(request, search_images(request.user, query, tags, request.GET.getlist('color')))
+    with metrics.timed('render'):
+        return render(request, 'image_repo/repo.html', {'images': images, 'next_page': next_page,
+                                                        'search': request.GET.get('q', '')})
+
+
+@login_required(login_url='homepage')
+def similar(request, image_id):
+    """Images of the user that look like the given one, nearest first"""
+    image = get_object_or_404(Image, id=image_id, user=request.user)
+    images = similar_images(image)[:settings.IMAGE_REPO_PAGE_SIZE]
+    with metrics.timed('render'):
+        return render(request, 'image_repo/repo.html', {'images': images, 'search': ''})
+
+
+@login_required(login_url='homepage')
+def similar_colors(request, image_id):
+    """Images of the user with the nearest palettes to the given one's, nearest first"""
+    image = get_object_or_404(Image, id=image_id, user=request.user)
+    images = palettes.similar_palettes(image)
+    with metrics.timed('render'):
+        return render(request, 'image_repo/repo.html', {'images': images, 'search': ''})
+
+
+@login_required(login_url='homepage')
+def api_images(request):
+    """A page of the user's images (newest first) as JSON with the requested fields, see api.py"""
+    try:
+        fields = api.parse_fields(request.GET.get('fields', ''))
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    limit = request.GET.get('limit', '')
+    page_size = settings.IMAGE_REPO_API_PAGE_SIZE
+    limit = min(int(limit), page_size) if limit.isdigit() and int(limit) > 0 else page_size
+    rows, next_page = api.image_rows(request.user.id, fields, get_cursor(request), limit)
+    # signing the image URLs is part of rendering, like in render_images()
+    with metrics.timed('render'):
+        return JsonResponse({'images': api.serialize(rows, fields), 'next_page': next_page},
+                            json_dumps_params={'separators': (',', ':')})
+
+
+def parse_range(header, size):
+    """Return (first, last) byte of a single `bytes=` range of a file of `size` bytes, None to send it whole"""
+    # several ranges or an invalid header: the whole file is a valid answer
+    match = BYTE_RANGE_RE.match(header.strip())
+    if match is None or not any(match.groups()):
+        return None
+    first, last = match.groups()
+    if not first:
+        # the last `last` bytes
+        if not int(last) or not size:
+            raise ValueError('Unsatisfiable range.')
+        return max(size - int(last), 0), size - 1
+    if last and int(last) < int(first):
+        return None
+    if int(first) >= size:
+        raise ValueError('Unsatisfiable range.')
+    return int(first), min(int(last), size - 1) if last else size - 1
+
+
+def read_range(file, first, length):
+    """Yield `length` bytes of the file from byte `first` in chunks, the file is closed when done"""
+    with file:
+        file.seek(first)
+        while length > 0:
+            chunk = file.read(min(RANGE_CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+@login_required(login_url='homepage')
+def image_file(request, name):
+    """A stored file of the user from the local file cache, with ETag and Range support"""
+    # users can only read the files in their own folder and their exported archives
+    username = request.user.username
+    if posixpath.dirname(name) not in (username, posixpath.join(username, EXPORTS_FOLDER)):
+        raise Http404
+    storage = Image.image.field.storage
+    try:
+        file = open_local(storage, name)
+    except FileNotFoundError:
+        raise Http404
+    if file is None:
+        # no local copies, the file comes from the bucket
+        return redirect(storage.url(name))
+    stat = os.fstat(file.fileno())
+    # stored names are never overwritten, a copy fetched again after a delete gets a new ETag
+    etag = f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+    response = get_conditional_response(request, etag=etag)
+    content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+    # a range of another version of the file is answered with the whole file
+    if response is None and request.headers.get('If-Range', etag) == etag:
+        try:
+            byte_range = parse_range(request.headers.get('Range', ''), stat.st_size)
+        except ValueError:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{stat.st_size}'
+        else:
+            if byte_range is not None:
+                first, last = byte_range
+                # a range of a big file is sent in chunks too, like the whole file
+                response = StreamingHttpResponse(read_range(file, first, last - first + 1),
+                                                 content_type=content_type, status=206)
+                response['Content-Length'] = last - first + 1
+                response['Content-Range'] = f'bytes {first}-{last}/{stat.st_size}'
+    if response is None:
+        # FileResponse closes the file
+        response = FileResponse(file, content_type=content_type)
+    elif not response.streaming:
+        # streamed ranges close the file when they are done
+        file.close()
+    response['ETag'] = etag
+    response['Accept-Ranges'] = 'bytes'
+    # the browser checks the ETag before reusing its copy
+    response['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+@login_required(login_url='homepage')
+def export(request):
+    """Queue a ZIP of all of the user's images and their descriptions, tags and colors (POST), then download it"""
+    # the archive is built by the export worker, not while the response is sent (see export.py)
+    if request.method == 'POST':
+        request_export(request.user)
+        return redirect('export')
+    latest = Export.objects.filter(user=request.user).order_by('-id').first()
+    if latest is not None and latest.status == Export.DONE:
+        return redirect(Image.image.field.storage.url(latest.archive))
+    return render(request, 'image_repo/export.html', {'export': latest})
+
+
+@login_required(login_url='homepage')
+@require_POST
+def bulk_delete(request):
+    """Delete the selected images (ids) or all images of the user, with their files (JSON or redirect)"""
+    # users can only delete their own images
+    images = Image.objects.filter(user=request.user)
+    exports = None
+    if 'all' not in request.POST:
+        ids = [image_id for image_id in request.POST.getlist('ids') if image_id.isdigit()]
+        images = images.filter(id__in=ids)
+    else:
+        # the exported archives hold the images too
+        exports = Export.objects.filter(user=request.user)
+    deleted = delete_images(images, exports)
+    if 'redirect' in request.POST:
+        return redirect('repo')
+    return JsonResponse({'deleted': deleted})
+
+
+def metrics_view(request):
+    """Counters and timing histograms of this process in Prometheus text format (staff or bearer token)"""
+    token = settings.IMAGE_REPO_METRICS_TOKEN
+    authorized = token and constant_time_compare(request.headers.get('Authorization', ''), f'Bearer {token}')
+    if not (authorized or request.user.is_staff):
+        return HttpResponse(status=403)
+    # a gauge of the repo page cache, the rest are counters and histograms
+    hit_ratio = metrics.ratio('repo_cache_hits', 'repo_cache_misses')
+    text = metrics.prometheus_text() + azure_circuit.prometheus_text()
+    if hit_ratio is not None:
+        text += f'# TYPE image_repo_repo_cache_hit_ratio gauge\nimage_repo_repo_cache_hit_ratio {hit_ratio}\n'
+    return HttpResponse(text, content_type='text/plain; version=0.0.4; charset=utf-8')
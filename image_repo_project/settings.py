@@ -13,6 +13,7 @@ https://docs.djangoproject.com/en/3.2/ref/settings/
 import os
 from pathlib import Path
 import sys
+import tempfile
 
 import dj_database_url
 import django_heroku
@@ -54,6 +55,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # first, so that the time of all other middleware is measured (see image_repo/timing.py)
+    'image_repo.timing.timing_middleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -103,6 +106,55 @@ if not DEBUG:
     db_heroku = dj_database_url.config(conn_max_age=600, ssl_require=True)
     DATABASES['default'].update(db_heroku)
 
+# Cache
+# https://docs.djangoproject.com/en/3.2/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'OPTIONS': {
+            # signed image URLs are cached per file (see image_repo/storage.py)
+            'MAX_ENTRIES': 50000,
+        },
+    },
+    # rendered repo pages (see image_repo/pagecache.py), shared by all processes so that
+    # the analysis worker invalidates them too; create the table with `manage.py createcachetable`
+    'pages': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'image_repo_page_cache',
+        'OPTIONS': {
+            # with the default 300 entries, every write past a few hundred users culls versions
+            # and lists of the others; past this limit expired entries go first, then a tenth
+            'MAX_ENTRIES': 200000,
+            'CULL_FREQUENCY': 10,
+        },
+    },
+    # state and counters of the circuit breakers (see image_repo/resilience.py), shared by all
+    # processes; a handful of keys kept apart from the pages so that they are never culled
+    'circuit': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'image_repo_circuit_cache',
+        'OPTIONS': {
+            'MAX_ENTRIES': 1000,
+        },
+    },
+}
+
+# High-throughput auth mode, on when memcached servers (comma separated, like from the MemCachier
+# add-on) are set: sessions are read from the 'sessions' cache and written through to the database,
+# and the signed-in user is cached too (see image_repo/auth.py). The cache has to be shared by all
+# processes, a per-process one would keep signed-out sessions alive in the others.
+MEMCACHED_SERVERS = os.environ.get('IMAGE_REPO_MEMCACHED_SERVERS', '')
+if MEMCACHED_SERVERS:
+    CACHES['sessions'] = {
+        'BACKEND': 'django.core.cache.backends.memcached.PyMemcacheCache',
+        'LOCATION': MEMCACHED_SERVERS.split(','),
+    }
+    SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'
+    SESSION_CACHE_ALIAS = 'sessions'
+    # sessions signed in before the mode was turned on name ModelBackend, they stay signed in
+    AUTHENTICATION_BACKENDS = ['image_repo.auth.CachedUserBackend', 'django.contrib.auth.backends.ModelBackend']
+
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
 
@@ -145,7 +197,7 @@ STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
 
 # Django storage S3 settings
 
-DEFAULT_FILE_STORAGE = 'storages.backends.s3boto3.S3Boto3Storage'
+DEFAULT_FILE_STORAGE = 'image_repo.storage.S3Storage'
 
 # The AWS access key to use.
 AWS_ACCESS_KEY_ID = os.environ['AWS_ACCESS_KEY_ID']
@@ -159,6 +211,134 @@ AWS_S3_REGION_NAME = 'us-east-2'
 AWS_S3_FILE_OVERWRITE = False
 # The number of seconds that a generated URL is valid for.
 AWS_QUERYSTRING_EXPIRE = 1800
+# Generated URLs are reused until they have this many seconds left (see image_repo/storage.py).
+IMAGE_REPO_URL_CACHE_MARGIN = 300
+# Local disk cache of the stored files the app reads (see image_repo/filecache.py): its directory
+# and its size in bytes, 0 turns it off.
+IMAGE_REPO_FILE_CACHE_DIR = os.environ.get('IMAGE_REPO_FILE_CACHE_DIR',
+                                           os.path.join(tempfile.gettempdir(), 'image_repo_files'))
+IMAGE_REPO_FILE_CACHE_SIZE = 512 * 2 ** 20
+# Serve the images through the app from the file cache (views.image_file()) instead of presigned URLs.
+IMAGE_REPO_PROXY_IMAGES = False
+
+# Image Repo settings
+
+# Dotted path to the callable or image_repo.analysis.Analyzer class that analyzes image bytes and
+# returns description, tags and colors: azure_cv_api (all from Azure), HybridAnalyzer (colors
+# computed locally) or LocalColorAnalyzer (colors only, no Azure).
+IMAGE_REPO_ANALYZER = 'image_repo.analysis.HybridAnalyzer'
+# Dotted path to the coroutine function (or Analyzer class) used instead by `analyze_images --async`.
+IMAGE_REPO_ASYNC_ANALYZER = 'image_repo.analysis.HybridAnalyzer'
+# Let the worker pass all claimed images to one Analyzer.analyze_batch() call (see jobs.process_batch()).
+IMAGE_REPO_ANALYSIS_BATCH = False
+# Side of the downsampled copy, number of colors and share of the pixels a color needs (see image_repo/colors.py).
+IMAGE_REPO_LOCAL_COLOR_SAMPLE_SIDE = 64
+IMAGE_REPO_LOCAL_COLORS = 3
+IMAGE_REPO_LOCAL_COLOR_MIN_SHARE = 0.1
+# The number of seconds to wait for a connection to the analysis endpoint.
+IMAGE_REPO_ANALYSIS_CONNECT_TIMEOUT = 3.05
+# The number of seconds to wait for the analysis endpoint to respond.
+IMAGE_REPO_ANALYSIS_READ_TIMEOUT = 15
+# The number of keep-alive connections to the analysis endpoint kept open per process.
+IMAGE_REPO_ANALYSIS_POOL_SIZE = 10
+# The number of connections to the analysis endpoint opened by the async worker.
+IMAGE_REPO_ANALYSIS_ASYNC_POOL_SIZE = 100
+# Calls per second and burst allowed by the Azure pricing tier (halved at every 429, see image_repo/resilience.py).
+IMAGE_REPO_ANALYSIS_RATE = 10
+IMAGE_REPO_ANALYSIS_BURST = 10
+# The number of worker processes calling Azure at the same time, each one gets its share of the rate and burst.
+IMAGE_REPO_ANALYSIS_PROCESSES = int(os.environ.get('IMAGE_REPO_ANALYSIS_PROCESSES', 1))
+# Retries of a failed analysis call, after a random delay of up to BACKOFF * 2^retry (at most BACKOFF_MAX) seconds.
+IMAGE_REPO_ANALYSIS_RETRIES = 2
+IMAGE_REPO_ANALYSIS_BACKOFF = 0.5
+IMAGE_REPO_ANALYSIS_BACKOFF_MAX = 8
+# Consecutive failed calls that open the circuit, and the seconds before a probe call is let through.
+IMAGE_REPO_CIRCUIT_FAILURES = 5
+IMAGE_REPO_CIRCUIT_RESET_TIMEOUT = 30
+# The cache the circuit state is shared in (not culled), so /metrics/ of the web processes shows the workers' circuits.
+IMAGE_REPO_CIRCUIT_CACHE = 'circuit'
+# Images bigger than this many bytes or pixels per side are downscaled before analysis.
+IMAGE_REPO_ANALYSIS_MAX_BYTES = 1024 * 1024
+IMAGE_REPO_ANALYSIS_MAX_SIDE = 1024
+# Format and quality of the downscaled copy sent to the analyzer ('JPEG' or 'WEBP').
+IMAGE_REPO_ANALYSIS_FORMAT = 'JPEG'
+IMAGE_REPO_ANALYSIS_QUALITY = 85
+# The number of analysis results kept in memory by each process (the database keeps all of them).
+IMAGE_REPO_ANALYSIS_CACHE_SIZE = 1024
+# The number of images the analysis worker analyzes concurrently.
+IMAGE_REPO_ANALYSIS_WORKERS = 4
+# The number of images the async analysis worker analyzes concurrently.
+IMAGE_REPO_ANALYSIS_ASYNC_CONCURRENCY = 200
+# The number of seconds the analysis worker waits before checking an empty queue again.
+IMAGE_REPO_ANALYSIS_POLL_INTERVAL = 2
+# The number of seconds after which an image stuck in processing is picked up by another worker.
+IMAGE_REPO_ANALYSIS_TIMEOUT = 300
+# The number of analysis attempts before an image is marked as failed.
+IMAGE_REPO_ANALYSIS_MAX_ATTEMPTS = 3
+
+# The number of images a user can upload.
+IMAGE_REPO_UPLOAD_LIMIT = 5
+# The number of files of a bulk upload stored concurrently.
+IMAGE_REPO_UPLOAD_WORKERS = 8
+# The maximum size of an uploaded image in bytes.
+IMAGE_REPO_MAX_UPLOAD_SIZE = 20 * 1024 * 1024
+# Let browsers upload straight to the bucket with presigned POSTs (the bucket needs a CORS rule for the site).
+IMAGE_REPO_DIRECT_UPLOADS = False
+# The number of seconds a presigned POST is valid for.
+IMAGE_REPO_DIRECT_UPLOAD_EXPIRE = 600
+# The number of images shown per page of the repo.
+IMAGE_REPO_PAGE_SIZE = 20
+# The number of images per page of the JSON API, also the largest `limit` a client may ask for.
+IMAGE_REPO_API_PAGE_SIZE = 100
+# Library exports: the number of files read ahead (and held in memory), the size of
+# the chunks they are read and sent in and the number of rows fetched per query.
+IMAGE_REPO_EXPORT_PREFETCH = 4
+IMAGE_REPO_EXPORT_CHUNK_SIZE = 64 * 1024
+IMAGE_REPO_EXPORT_PAGE_SIZE = 100
+# The number of seconds the export worker waits before checking for queued exports again.
+IMAGE_REPO_EXPORT_POLL_INTERVAL = 2
+# The number of seconds after which an export stuck in processing is picked up by another worker.
+IMAGE_REPO_EXPORT_TIMEOUT = 3600
+# The number of storage delete requests sent at a time when images are deleted
+# (batches of up to 1000 keys on S3, single files on other storages).
+IMAGE_REPO_DELETE_WORKERS = 4
+# The cache of the rendered image lists of the repo page and their lifetime in seconds,
+# shorter than IMAGE_REPO_URL_CACHE_MARGIN because the lists contain cached signed URLs.
+IMAGE_REPO_PAGE_CACHE = 'pages'
+IMAGE_REPO_PAGE_CACHE_TIMEOUT = 120
+# The number of seconds a user's list version is kept, an expired one only gets the lists rendered again.
+IMAGE_REPO_PAGE_VERSION_TIMEOUT = 30 * 24 * 3600
+# Send the per-phase request timings in the Server-Timing header (see image_repo/timing.py).
+IMAGE_REPO_SERVER_TIMING = True
+# Bearer token that lets a Prometheus scraper read /metrics/ (staff users can always read it).
+IMAGE_REPO_METRICS_TOKEN = os.environ.get('IMAGE_REPO_METRICS_TOKEN', '')
+
+# The cache of the signed-in users (see image_repo/auth.py) and the number of seconds after which
+# group and permission changes apply (saving or deleting a user applies right away).
+IMAGE_REPO_USER_CACHE = 'sessions'
+IMAGE_REPO_USER_CACHE_TIMEOUT = 300
+
+# Maximum number of different bits of the perceptual hashes of near-duplicates and of similar images.
+IMAGE_REPO_DUPLICATE_DISTANCE = 4
+IMAGE_REPO_SIMILAR_DISTANCE = 12
+# Refuse near-duplicate uploads instead of flagging them and reusing the analysis of the earlier image.
+IMAGE_REPO_REJECT_DUPLICATES = False
+# The number of users whose hash index is kept in memory.
+IMAGE_REPO_DUPLICATE_INDEX_USERS = 1000
+# The number of users whose palette vectors are kept in memory for color similarity search.
+IMAGE_REPO_PALETTE_INDEX_USERS = 1000
+
+# Widths of the downscaled copies made at upload and listed in srcset.
+IMAGE_REPO_DERIVATIVE_WIDTHS = [400, 800, 1200]
+# Format and quality of the downscaled copies.
+IMAGE_REPO_DERIVATIVE_FORMAT = 'WEBP'
+IMAGE_REPO_DERIVATIVE_QUALITY = 80
+
+# Hash, sniff and size-check uploaded files while they stream in (see image_repo/uploadhandlers.py)
+FILE_UPLOAD_HANDLERS = [
+    'image_repo.uploadhandlers.InspectingMemoryFileUploadHandler',
+    'image_repo.uploadhandlers.InspectingTemporaryFileUploadHandler',
+]
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/3.2/ref/settings/#default-auto-field
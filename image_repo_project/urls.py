@@ -29,6 +29,19 @@ urlpatterns = [
     path('signout/', views.user_sign_out, name='signout'),
     # image_repo
     path('repo/', views.repo, name='repo'),
+    path('repo/search/', views.search, name='search'),
+    path('repo/similar/<int:image_id>/', views.similar, name='similar'),
+    path('repo/similar-colors/<int:image_id>/', views.similar_colors, name='similar_colors'),
+    path('repo/api/images/', views.api_images, name='api_images'),
+    path('repo/files/<path:name>', views.image_file, name='image_file'),
+    path('repo/export/', views.export, name='export'),
+    path('repo/delete/', views.bulk_delete, name='bulk_delete'),
+    path('repo/upload/', views.bulk_upload, name='bulk_upload'),
+    path('repo/direct-upload/', views.direct_upload, name='direct_upload'),
+    path('repo/direct-upload/confirm/', views.direct_upload_confirm, name='direct_upload_confirm'),
+    path('repo/direct-upload/local/', views.direct_upload_local, name='direct_upload_local'),
+    # internal
+    path('metrics/', views.metrics_view, name='metrics'),
 ]
 
 urlpatterns += static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)